@@ -1,14 +1,31 @@
+import io
 import os
+import re
+import json
 import tempfile
-import ffmpeg
 import gc
-from flask import Flask, request, jsonify, send_file, url_for, render_template
+import shutil
+import logging
+import queue
+import time
+from contextlib import ExitStack
+from flask import Flask, Response, request, jsonify, send_file, url_for, render_template
 from werkzeug.utils import secure_filename
-from auto_subtitle.utils import filename, write_srt
-from auto_subtitle.ass_generator import AssGenerator
+from auto_subtitle.pipeline import process_video, rerender, transcript_path, get_transcript_cache, OUTPUT_MODES
+from auto_subtitle.transcript import load_transcript, render, RENDER_FORMATS
+from auto_subtitle.backends import BACKENDS, DEFAULT_BACKEND
+from auto_subtitle.burn import MAX_BURN_SEGMENTS, ENCODER_PROFILES, DEFAULT_ENCODER_PROFILE, PREVIEW_SECONDS
+from auto_subtitle.jobs import JobQueue, DEFAULT_JOBS_DIR
+from auto_subtitle.audio import AUDIO_FORMATS, DEFAULT_AUDIO_FORMAT, release_audio
+from auto_subtitle.ingest import StreamingUpload
+from auto_subtitle.metrics import JobTiming, render_metrics
+from auto_subtitle.probe import MediaInfo, MediaError, probe_media, MAX_MEDIA_SECONDS
+from auto_subtitle.storage import OutputStore, DEFAULT_OUTPUT_TTL, DEFAULT_OUTPUT_MAX_BYTES
+from auto_subtitle.live import LIVE_SOURCES, KEEPALIVE_SECONDS, subscribe_broadcast, sse_event
+from auto_subtitle.batch import DEFAULT_BATCH_JOBS, unique_name, extract_archive, stream_batch
+from auto_subtitle.uploads import UploadStore, UploadNotFound, OffsetMismatch, ChecksumMismatch, parse_checksum
 import openai
 from dotenv import load_dotenv
-import json
 
 # Load environment variables
 load_dotenv()
@@ -16,238 +33,908 @@ load_dotenv()
 # Set OpenAI API key
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
+# Log the per-request timing records
+logging.basicConfig(format="%(message)s")
+logging.getLogger("auto_subtitle").setLevel(logging.INFO)
+
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = os.path.join(tempfile.gettempdir(), 'auto_subtitle_uploads')
 app.config['OUTPUT_FOLDER'] = os.path.join(tempfile.gettempdir(), 'auto_subtitle_outputs')
+app.config['JOBS_FOLDER'] = DEFAULT_JOBS_DIR
 app.config['MAX_CONTENT_LENGTH'] = 500 * 1024 * 1024  # 500MB max upload size
+# Longest video or audio accepted, in seconds (0 for no limit)
+app.config['MAX_MEDIA_SECONDS'] = MAX_MEDIA_SECONDS
+# Results stay downloadable for OUTPUT_TTL seconds after their last download,
+# within OUTPUT_MAX_BYTES in total
+app.config['OUTPUT_TTL'] = DEFAULT_OUTPUT_TTL
+app.config['OUTPUT_MAX_BYTES'] = DEFAULT_OUTPUT_MAX_BYTES
+# Extract audio from /subtitle uploads while they are being received
+app.config['STREAMING_INGEST'] = os.getenv('AUTO_SUBTITLE_STREAMING_INGEST', 'true').lower() == 'true'
+app.config['STREAMING_AUDIO_FORMAT'] = DEFAULT_AUDIO_FORMAT
+# Videos per /batch request, and how many of them each pipeline stage works on at once
+app.config['BATCH_MAX_VIDEOS'] = 100
+app.config['BATCH_JOBS'] = DEFAULT_BATCH_JOBS
+# Longest excerpt /previews renders
+app.config['PREVIEW_MAX_SECONDS'] = 60
+# Seconds between checks of the job store by /jobs/<id>/events
+app.config['JOB_EVENTS_POLL_INTERVAL'] = 1.0
+# Streams that /live may subtitle, by name; clients can't open arbitrary URLs or files
+app.config['LIVE_SOURCES'] = LIVE_SOURCES
+# Event streams end after this many seconds and EventSource clients reconnect
+# on their own, so no stream outlives gunicorn's --timeout
+app.config['SSE_MAX_SECONDS'] = float(os.getenv('AUTO_SUBTITLE_SSE_MAX_SECONDS', 240))
+
+# Per-request workspaces under UPLOAD_FOLDER, and results kept for download in OUTPUT_FOLDER
+output_store = OutputStore(app.config['OUTPUT_FOLDER'], app.config['UPLOAD_FOLDER'],
+                           app.config['OUTPUT_TTL'], app.config['OUTPUT_MAX_BYTES'])
+output_store.start_sweeper()
+
+# Resumable uploads; abandoned ones are removed by the output store's sweeper
+upload_store = UploadStore(app.config['UPLOAD_FOLDER'], app.config['MAX_CONTENT_LENGTH'])
+
+# Durable queue for background jobs, processed by `auto_subtitle worker`
+job_queue = JobQueue(app.config['JOBS_FOLDER'])
 
-# Create necessary directories
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-os.makedirs(app.config['OUTPUT_FOLDER'], exist_ok=True)
+# Content types of the formats a transcript can be rendered to
+RENDER_MIMETYPES = {
+    'srt': 'application/x-subrip',
+    'vtt': 'text/vtt',
+    'ass': 'text/x-ssa',
+    'json': 'application/json',
+}
 
-# List of allowed file extensions
-ALLOWED_EXTENSIONS = {'mp4', 'avi', 'mov', 'mkv', 'webm'}
+# List of allowed file extensions; audio-only files get a subtitle file only
+ALLOWED_EXTENSIONS = {'mp4', 'avi', 'mov', 'mkv', 'webm', 'mp3', 'm4a', 'wav', 'ogg', 'opus', 'flac'}
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def get_audio(video_path):
-    """Extract audio from video file"""
-    temp_dir = tempfile.gettempdir()
-    output_path = os.path.join(temp_dir, f"{filename(video_path)}.wav")
-
-    ffmpeg.input(video_path).output(
-        output_path,
-        acodec="pcm_s16le", ac=1, ar="16k"
-    ).run(quiet=True, overwrite_output=True)
-
-    return output_path
-
-def get_subtitles(video_path, audio_path, output_dir, subtitle_format, ass_style, transcribe_func):
-    """Generate subtitles for the video"""
-    # Save subtitle file in the output directory
-    sub_path = os.path.join(output_dir, f"{filename(video_path)}.{subtitle_format}")
-    
-    result = transcribe_func(audio_path)
-
-    if subtitle_format == "srt":
-        with open(sub_path, "w", encoding="utf-8") as f:
-            write_srt(result["segments"], f)
-    else:
-        ass_generator = AssGenerator()
-        with open(sub_path, "w", encoding="utf-8") as f:
-            f.write(ass_generator.generate_ass(result["segments"], ass_style))
-
-    return sub_path
-
-def create_subtitled_video(video_path, sub_path, output_dir, subtitle_format):
-    """Burn subtitles into video"""
-    out_path = os.path.join(output_dir, f"{filename(video_path)}_subtitled.mp4")
-
-    # Get video stream info
-    probe = ffmpeg.probe(video_path)
-    video_info = next(s for s in probe['streams'] if s['codec_type'] == 'video')
-
-    # Set up ffmpeg inputs
-    video = ffmpeg.input(video_path)
-    audio = video.audio
-
-    if subtitle_format == "srt":
-        # For SRT, use subtitles filter
-        video_with_subs = video.filter('subtitles', sub_path, force_style="OutlineColour=&H40000000,BorderStyle=3")
-    else:
-        # For ASS, use ass filter which properly handles all styling
-        video_with_subs = video.filter('ass', sub_path)
-
-    # Hard encode the subtitles
-    (
-        ffmpeg
-        .concat(video_with_subs, audio, v=1, a=1)
-        .output(
-            out_path,
-            acodec='aac',
-            vcodec='h264',
-            crf=23,
-            preset='medium'
-        )
-        .overwrite_output()
-        .run(capture_stdout=True, capture_stderr=True)
-    )
+def get_subtitle_options(form, subtitle_formats=('srt', 'ass')):
+    """Read and validate the subtitle parameters of a request.
 
-    return out_path
+    Returns an ``(options, error)`` tuple where exactly one is set.
+    """
+    options = {
+        'backend': form.get('backend', DEFAULT_BACKEND),
+        'model': form.get('model', 'whisper-1'),  # Default to OpenAI's whisper-1 model
+        'subtitle_format': form.get('subtitle_format', 'ass'),
+        'ass_style': form.get('ass_style', 'default'),
+        'task': form.get('task', 'transcribe'),
+        'language': form.get('language', 'auto'),
+        'srt_only': form.get('srt_only', 'false').lower() == 'true',
+        'output_mode': form.get('output_mode', 'burn'),
+        'encoder_profile': form.get('encoder_profile', DEFAULT_ENCODER_PROFILE),
+        'segmented_burn': form.get('segmented_burn', 'false').lower() == 'true',  # Burn segments in parallel
+        'cache': form.get('cache', 'true').lower() != 'false',  # Reuse transcripts of identical audio
+        'chunked': form.get('chunked', 'false').lower() == 'true',  # Transcribe long audio in parallel chunks
+        'vad': form.get('vad', 'false').lower() == 'true',  # Only send the speech for transcription
+        'audio_format': form.get('audio_format', DEFAULT_AUDIO_FORMAT),
+    }
 
-def transcribe_with_openai_api(audio_path, model_name="whisper-1", task="transcribe", language="auto"):
-    """Transcribe audio using OpenAI's Whisper API"""
     try:
-        # Prepare parameters for API call
-        params = {
-            "model": model_name,
-            "response_format": "verbose_json"
-        }
-        
-        # Add language if specified and not auto
-        if language != "auto":
-            params["language"] = language
-        
-        # Set task (translate or transcribe)
-        if task == "translate":
-            # For translation, we always translate to English
-            params["response_format"] = "verbose_json"
-        
-        # Open the audio file
-        with open(audio_path, "rb") as audio_file:
-            # Call the OpenAI API
-            if task == "transcribe":
-                response = openai.audio.transcriptions.create(
-                    file=audio_file,
-                    **params
-                )
-            else:  # translate
-                response = openai.audio.translations.create(
-                    file=audio_file,
-                    **params
-                )
-        
-        # Convert response to dictionary if it's not already
-        if not isinstance(response, dict):
-            response = response.model_dump()
-        
-        # Process the response to match the format expected by our subtitle generator
-        # OpenAI API returns segments with start and end times
-        segments = []
-        
-        if "segments" in response:
-            # If the API already returns segments in the format we need
-            segments = response["segments"]
-        else:
-            # If we need to create segments from the response
-            # This is a simplified version - in a real implementation, 
-            # you might want to split the text into sentences or use other logic
-            segments = [
-                {
-                    "start": 0,
-                    "end": 10,  # Default duration if not provided
-                    "text": response.get("text", "")
-                }
-            ]
-        
-        # Return in the format expected by get_subtitles
-        return {
-            "segments": segments,
-            "text": response.get("text", "")
-        }
-    
-    except Exception as e:
-        print(f"Error in OpenAI API transcription: {str(e)}")
-        raise
+        options['chunk_seconds'] = float(form.get('chunk_seconds', 0)) or None
+    except ValueError:
+        return None, 'Invalid chunk_seconds. Use a number of seconds'
 
-@app.route('/subtitle', methods=['POST'])
-def subtitle_video():
+    try:
+        options['burn_segments'] = int(form.get('burn_segments', 0)) or None
+    except ValueError:
+        return None, 'Invalid burn_segments. Use a whole number'
+
+    # Validate parameters
+    if options['backend'] not in BACKENDS:
+        return None, f'Invalid backend. Use one of: {", ".join(BACKENDS)}'
+
+    if options['subtitle_format'] not in subtitle_formats:
+        return None, f'Invalid subtitle format. Use one of: {", ".join(subtitle_formats)}'
+
+    if options['ass_style'] not in ['default', 'highlight', 'karaoke']:
+        return None, 'Invalid ASS style. Use "default", "highlight" or "karaoke"'
+
+    if options['task'] not in ['transcribe', 'translate']:
+        return None, 'Invalid task. Use "transcribe" or "translate"'
+
+    if options['output_mode'] not in OUTPUT_MODES:
+        return None, 'Invalid output mode. Use "burn" or "mux"'
+
+    if options['encoder_profile'] not in ENCODER_PROFILES:
+        return None, f'Invalid encoder profile. Use one of: {", ".join(ENCODER_PROFILES)}'
+
+    if options['audio_format'] not in AUDIO_FORMATS:
+        return None, f'Invalid audio format. Use one of: {", ".join(AUDIO_FORMATS)}'
+
+    if options['chunk_seconds'] is not None and options['chunk_seconds'] < 30:
+        return None, 'Invalid chunk_seconds. Chunks must be at least 30 seconds long'
+
+    if options['burn_segments'] is not None and not 1 <= options['burn_segments'] <= MAX_BURN_SEGMENTS:
+        return None, f'Invalid burn_segments. Use a number from 1 to {MAX_BURN_SEGMENTS}'
+
+    return options, None
+
+def probe_upload(path, require_audio=True):
+    """Probe an uploaded file once. Returns ``(media, error)``, rejecting files
+    that can't be read, have no audio or are longer than MAX_MEDIA_SECONDS."""
+    try:
+        return probe_media(path, app.config['MAX_MEDIA_SECONDS'], require_audio), None
+    except MediaError as e:
+        return None, (jsonify({'error': str(e)}), 400)
+
+def get_uploaded_video():
+    """Return the uploaded video from the request, or an error response"""
     # Check if a file was uploaded
     if 'video' not in request.files:
-        return jsonify({'error': 'No video file provided'}), 400
-    
+        return None, (jsonify({'error': 'No video file provided'}), 400)
+
     file = request.files['video']
-    
+
     # Check if the file is valid
     if file.filename == '':
-        return jsonify({'error': 'No file selected'}), 400
-    
+        return None, (jsonify({'error': 'No file selected'}), 400)
+
     if not allowed_file(file.filename):
-        return jsonify({'error': f'File type not allowed. Allowed types: {", ".join(ALLOWED_EXTENSIONS)}'}), 400
-    
-    # Get parameters from request
-    model_name = request.form.get('model', 'whisper-1')  # Default to OpenAI's whisper-1 model
-    subtitle_format = request.form.get('subtitle_format', 'ass')
-    ass_style = request.form.get('ass_style', 'default')
-    task = request.form.get('task', 'transcribe')
-    language = request.form.get('language', 'auto')
-    srt_only = request.form.get('srt_only', 'false').lower() == 'true'
-    
-    # Validate parameters
-    if subtitle_format not in ['srt', 'ass']:
-        return jsonify({'error': 'Invalid subtitle format. Use "srt" or "ass"'}), 400
-    
-    if ass_style not in ['default', 'highlight']:
-        return jsonify({'error': 'Invalid ASS style. Use "default" or "highlight"'}), 400
-    
-    if task not in ['transcribe', 'translate']:
-        return jsonify({'error': 'Invalid task. Use "transcribe" or "translate"'}), 400
-    
-    # Save the uploaded file
+        return None, (jsonify({'error': f'File type not allowed. Allowed types: {", ".join(ALLOWED_EXTENSIONS)}'}), 400)
+
+    return file, None
+
+def receive_streaming_upload(work_dir):
+    """Save a multipart upload to ``work_dir`` while extracting its audio as the bytes arrive.
+
+    Returns ``(video_path, form, audio, error)``; ``audio`` is None if ffmpeg
+    could not read the video from a pipe and has to extract from the file.
+    """
+    def make_path(name):
+        if not allowed_file(name):
+            raise ValueError(f'File type not allowed. Allowed types: {", ".join(ALLOWED_EXTENSIONS)}')
+        if not secure_filename(name):
+            raise ValueError('Invalid file name')
+        return os.path.join(work_dir, secure_filename(name))
+
+    boundary = request.mimetype_params.get('boundary', '')
+    upload = StreamingUpload(request.stream, boundary.encode(), 'video', make_path,
+                             app.config['STREAMING_AUDIO_FORMAT'])
+    try:
+        upload.receive()
+    except ValueError as e:
+        return None, None, None, (jsonify({'error': str(e)}), 400)
+
+    return upload.video_path, upload.form, upload.audio, None
+
+def receive_upload(work_dir):
+    """Save an upload parsed by werkzeug to ``work_dir``. Returns ``(video_path, form, audio, error)``."""
+    file, error = get_uploaded_video()
+    if error:
+        return None, None, None, error
+
     video_filename = secure_filename(file.filename)
-    video_path = os.path.join(app.config['UPLOAD_FOLDER'], video_filename)
+    video_path = os.path.join(work_dir, video_filename)
     file.save(video_path)
-    
+    return video_path, request.form, None, None
+
+@app.route('/subtitle', methods=['POST'])
+def subtitle_video():
+    # Everything the request writes goes to its own workspace, removed afterwards
+    with output_store.workspace() as work_dir:
+        return subtitle_in_workspace(work_dir)
+
+def subtitle_in_workspace(work_dir):
+    timing = JobTiming(None)
     try:
-        # Extract audio
-        audio_path = get_audio(video_path)
-        
-        # Generate subtitles using OpenAI's Whisper API
-        sub_path = get_subtitles(
-            video_path, 
-            audio_path, 
-            app.config['OUTPUT_FOLDER'], 
-            subtitle_format, 
-            ass_style,
-            lambda audio_path: transcribe_with_openai_api(audio_path, model_name, task, language)
-        )
-        
-        # If srt_only is True, return the subtitle file
-        if srt_only:
-            return send_file(
-                sub_path,
-                as_attachment=True,
-                download_name=f"{filename(video_filename)}.{subtitle_format}"
-            )
-        
-        # Create subtitled video
-        output_video_path = create_subtitled_video(
-            video_path, 
-            sub_path, 
-            app.config['OUTPUT_FOLDER'], 
-            subtitle_format
+        with timing.stage('upload') as record:
+            record.bytes_in = request.content_length
+            if app.config['STREAMING_INGEST'] and request.mimetype == 'multipart/form-data':
+                # Extract audio while the upload is still arriving
+                video_path, form, audio, error = receive_streaming_upload(work_dir)
+            else:
+                video_path, form, audio, error = receive_upload(work_dir)
+    except Exception:
+        timing.log()
+        raise
+    if error:
+        timing.failed_stage = 'upload'
+        timing.log()
+        return error
+    timing.video = video_path
+
+    try:
+        # Get parameters from request
+        options, error = get_subtitle_options(form)
+        if error:
+            timing.failed_stage = 'options'
+            return jsonify({'error': error}), 400
+
+        with timing.stage('probe'):
+            media, error = probe_upload(video_path)
+        if error:
+            timing.failed_stage = 'probe'
+            return error
+
+        # Audio extracted during the upload is only usable in the default format
+        if audio is not None and options['audio_format'] != app.config['STREAMING_AUDIO_FORMAT']:
+            release_audio(audio)
+            audio = None
+
+        # process_video takes over releasing the audio
+        extracted_audio, audio = audio, None
+        output_path, download_name = process_video(
+            video_path, work_dir, options, extracted_audio, timing, media=media
         )
-        
-        # Return the subtitled video
-        return send_file(
-            output_video_path,
+
+        # Keep the result, so it can be downloaded again or resumed with Range requests
+        output_id = output_store.add(output_path, download_name)
+
+        # Return the subtitle file or the subtitled video
+        response = send_file(
+            output_store.get(output_id, download_name),
             as_attachment=True,
-            download_name=f"{filename(video_filename)}_subtitled.mp4"
+            download_name=download_name
         )
-        
+        response.headers['Content-Location'] = url_for('get_output', output_id=output_id, name=download_name)
+        return response
+
     except Exception as e:
+        # Failures outside a timed stage, e.g. while storing the output
+        timing.failed_stage = timing.failed_stage or 'output'
         return jsonify({'error': str(e)}), 500
     finally:
-        # Clean up temporary files
-        if os.path.exists(video_path):
-            os.remove(video_path)
-        if os.path.exists(audio_path):
-            os.remove(audio_path)
-        
+        timing.log()
+
+        # Clean up temporary files; the workspace itself is removed by the caller
+        if audio is not None:
+            release_audio(audio)
+
         # Force garbage collection to free memory
         gc.collect()
 
+@app.route('/batch', methods=['POST'])
+def subtitle_batch():
+    """Subtitle several videos with the same options and stream back a zip of the results.
+
+    Takes the videos as several ``video`` files and/or a zip ``archive`` of
+    videos. ``jobs`` sets how many videos each stage works on at once.
+    """
+    options, error = get_subtitle_options(request.form)
+    if error:
+        return jsonify({'error': error}), 400
+    try:
+        jobs = int(request.form.get('jobs', app.config['BATCH_JOBS']))
+    except ValueError:
+        jobs = 0
+    if not 1 <= jobs <= app.config['BATCH_JOBS']:
+        return jsonify({'error': f'Invalid jobs. Use a number from 1 to {app.config["BATCH_JOBS"]}'}), 400
+
+    # The workspace lives until the response has been streamed
+    workspace = ExitStack()
+    work_dir = workspace.enter_context(output_store.workspace())
+    try:
+        video_paths, error = receive_batch(work_dir)
+    except Exception:
+        workspace.close()
+        raise
+    if error:
+        workspace.close()
+        return error
+
+    output_dir = os.path.join(work_dir, 'outputs')
+    os.makedirs(output_dir)
+
+    def stream():
+        # The videos still in flight when a client goes away use the workspace
+        # until they are done; stream_batch closes it after them
+        yield from stream_batch(video_paths, output_dir, options, jobs, on_finished=workspace.close)
+
+    return Response(stream(), mimetype='application/zip', headers={
+        'Content-Disposition': 'attachment; filename=subtitles.zip',
+        'X-Accel-Buffering': 'no',
+    })
+
+def receive_batch(work_dir):
+    """Save the videos of a /batch request to ``work_dir``. Returns ``(video_paths, error)``."""
+    input_dir = os.path.join(work_dir, 'inputs')
+    os.makedirs(input_dir)
+    taken = set()
+
+    def accept(name):
+        name = secure_filename(name)
+        if not name or not allowed_file(name):
+            return None
+        return unique_name(name, taken)
+
+    video_paths = []
+    for file in request.files.getlist('video'):
+        if not file.filename:
+            continue
+        name = accept(file.filename)
+        if name is None:
+            return None, (jsonify({'error': f'File type not allowed: {file.filename}. Allowed types: {", ".join(ALLOWED_EXTENSIONS)}'}), 400)
+        video_paths.append(os.path.join(input_dir, name))
+        file.save(video_paths[-1])
+
+    archive = request.files.get('archive')
+    if archive is not None and archive.filename:
+        archive_path = os.path.join(work_dir, 'archive.zip')
+        archive.save(archive_path)
+        try:
+            video_paths += extract_archive(archive_path, input_dir, accept, app.config['MAX_CONTENT_LENGTH'])
+        except ValueError as e:
+            return None, (jsonify({'error': str(e)}), 400)
+        finally:
+            os.remove(archive_path)
+
+    if not video_paths:
+        return None, (jsonify({'error': 'No video files provided'}), 400)
+    if len(video_paths) > app.config['BATCH_MAX_VIDEOS']:
+        return None, (jsonify({'error': f'Too many videos. Send at most {app.config["BATCH_MAX_VIDEOS"]}'}), 400)
+    return video_paths, None
+
+# Previews keep their video and transcript in a workspace with this prefix
+# until the full encode is queued, or the sweeper removes them
+PREVIEW_PREFIX = 'preview-'
+
+def get_preview_range(form):
+    """Read preview_start and preview_seconds. Returns ``((start, seconds), error)``."""
+    try:
+        start = float(form.get('preview_start', 0))
+        seconds = float(form.get('preview_seconds', PREVIEW_SECONDS))
+    except ValueError:
+        return None, 'Invalid preview range. Use numbers of seconds'
+    if start < 0 or not 0 < seconds <= app.config['PREVIEW_MAX_SECONDS']:
+        return None, f'Invalid preview range. Previews start at 0 or later and last up to {app.config["PREVIEW_MAX_SECONDS"]} seconds'
+    return (start, seconds), None
+
+def check_preview_start(preview_range, media):
+    """An error response if the preview starts past the end of the video, else None"""
+    if media.duration is not None and preview_range[0] >= media.duration:
+        return jsonify({'error': f'Invalid preview range. The video is only {media.duration:.1f} seconds long'}), 400
+    return None
+
+def preview_options(options, preview_range):
+    start, seconds = preview_range
+    return dict(options, srt_only=False, preview=True, preview_start=start, preview_seconds=seconds,
+                save_transcript=True)
+
+def save_preview(preview_dir, video_path, options, media):
+    with open(os.path.join(preview_dir, 'preview.json'), 'w', encoding='utf-8') as f:
+        json.dump({'video': os.path.basename(video_path), 'options': options, 'media': media.probe}, f)
+    # The sweeper removes previews untouched for a day
+    os.utime(preview_dir)
+
+def load_preview(preview_id):
+    """The directory, video path, options and ``MediaInfo`` of a preview, or an error response"""
+    preview_dir = os.path.join(output_store.workspaces_dir, PREVIEW_PREFIX + preview_id)
+    try:
+        if not re.fullmatch(r'[A-Za-z0-9_]+', preview_id):
+            raise FileNotFoundError(preview_id)
+        with open(os.path.join(preview_dir, 'preview.json'), encoding='utf-8') as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return None, None, None, None, (jsonify({'error': 'Preview not found or expired'}), 404)
+    video_path = os.path.join(preview_dir, state['video'])
+    return preview_dir, video_path, state['options'], MediaInfo(video_path, state['media']), None
+
+def preview_response(preview_id, output_path, download_name):
+    output_id = output_store.add(output_path, download_name)
+    response = send_file(output_store.get(output_id, download_name), as_attachment=True,
+                         download_name=download_name)
+    response.headers['Content-Location'] = url_for('get_output', output_id=output_id, name=download_name)
+    response.headers['X-Preview-Id'] = preview_id
+    return response
+
+@app.route('/previews', methods=['POST'])
+def create_preview():
+    """Subtitle a video, but only burn a short low-resolution excerpt.
+
+    Takes the options of /subtitle plus ``preview_start`` and
+    ``preview_seconds``. The video and its transcript are kept, so another
+    preview (POST /previews/<id>) or the full encode (POST
+    /previews/<id>/encode) only runs the encode again.
+    """
+    options, error = get_subtitle_options(request.form)
+    if error:
+        return jsonify({'error': error}), 400
+    preview_range, error = get_preview_range(request.form)
+    if error:
+        return jsonify({'error': error}), 400
+
+    preview_dir = output_store.new_workspace(PREVIEW_PREFIX)
+    preview_id = os.path.basename(preview_dir)[len(PREVIEW_PREFIX):]
+    try:
+        video_path, _, _, error = receive_upload(preview_dir)
+        if not error:
+            media, error = probe_upload(video_path)
+        if not error and not media.has_video:
+            error = jsonify({'error': 'Previews need a video; audio files only get subtitles'}), 400
+        if not error:
+            error = check_preview_start(preview_range, media)
+        if error:
+            shutil.rmtree(preview_dir, ignore_errors=True)
+            return error
+
+        output_path, download_name = process_video(
+            video_path, preview_dir, preview_options(options, preview_range), media=media
+        )
+        save_preview(preview_dir, video_path, options, media)
+    except Exception as e:
+        shutil.rmtree(preview_dir, ignore_errors=True)
+        return jsonify({'error': str(e)}), 500
+
+    return preview_response(preview_id, output_path, download_name)
+
+@app.route('/previews/<preview_id>', methods=['POST'])
+def update_preview(preview_id):
+    """Render another preview from the stored transcript, with a new range or ``ass_style``"""
+    preview_dir, video_path, options, media, error = load_preview(preview_id)
+    if error:
+        return error
+    preview_range, error = get_preview_range(request.form)
+    if error:
+        return jsonify({'error': error}), 400
+    error = check_preview_start(preview_range, media)
+    if error:
+        return error
+    options = dict(options, ass_style=request.form.get('ass_style', options['ass_style']))
+    if options['ass_style'] not in ['default', 'highlight', 'karaoke']:
+        return jsonify({'error': 'Invalid ASS style. Use "default", "highlight" or "karaoke"'}), 400
+
+    try:
+        transcript = load_transcript(transcript_path(preview_dir, video_path))
+        output_path, download_name = rerender(
+            transcript, preview_dir, preview_options(options, preview_range), video_path, media=media
+        )
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+    # The full encode uses the style of the latest preview
+    save_preview(preview_dir, video_path, options, media)
+    return preview_response(preview_id, output_path, download_name)
+
+@app.route('/previews/<preview_id>/encode', methods=['POST'])
+def encode_preview(preview_id):
+    """Queue the full encode of a previewed video as a job, reusing its transcript and probe"""
+    preview_dir, video_path, options, media, error = load_preview(preview_id)
+    if error:
+        return error
+
+    stored_transcript = transcript_path(preview_dir, video_path)
+    if not os.path.exists(stored_transcript) or not os.path.exists(video_path):
+        # Moved by a concurrent request for the same encode
+        return jsonify({'error': 'Preview is already being encoded or has expired'}), 409
+
+    job_id = job_queue.new_job()
+    job_dir = job_queue.job_dir(job_id)
+    job_video_path = os.path.join(job_dir, os.path.basename(video_path))
+    moved = []
+    try:
+        for source, dest in ((stored_transcript, transcript_path(job_dir, video_path)), (video_path, job_video_path)):
+            shutil.move(source, dest)
+            moved.append((source, dest))
+        job_queue.submit(job_id, job_video_path, options, MediaInfo(job_video_path, media.probe))
+    except Exception as e:
+        # Give the preview its files back, so the encode can be queued again
+        for source, dest in reversed(moved):
+            shutil.move(dest, source)
+        shutil.rmtree(job_dir, ignore_errors=True)
+        return jsonify({'error': str(e)}), 500
+    shutil.rmtree(preview_dir, ignore_errors=True)
+
+    return job_created_response(job_id)
+
+@app.route('/outputs/<output_id>/<name>', methods=['GET'])
+def get_output(output_id, name):
+    """Download a result of /subtitle, in parts with Range requests if needed"""
+    path = output_store.get(output_id, name)
+    if path is None:
+        return jsonify({'error': 'Output not found or expired'}), 404
+
+    return send_file(path, as_attachment=True, download_name=name, conditional=True)
+
+def job_created_response(job_id):
+    return jsonify({
+        'job_id': job_id,
+        'status': 'queued',
+        'status_url': url_for('get_job', job_id=job_id),
+        'events_url': url_for('job_events', job_id=job_id),
+        'result_url': url_for('get_job_result', job_id=job_id),
+    }), 202
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    """Queue a subtitle job and return its id without waiting for the result"""
+    file, error = get_uploaded_video()
+    if error:
+        return error
+
+    options, error = get_subtitle_options(request.form)
+    if error:
+        return jsonify({'error': error}), 400
+
+    job_id = job_queue.new_job()
+    video_path = os.path.join(job_queue.job_dir(job_id), secure_filename(file.filename))
+    file.save(video_path)
+    # Reject what the worker couldn't process now, and spare the worker the probe
+    media, error = probe_upload(video_path)
+    if error:
+        shutil.rmtree(job_queue.job_dir(job_id), ignore_errors=True)
+        return error
+    job_queue.submit(job_id, video_path, options, media)
+
+    return job_created_response(job_id)
+
+def upload_status(upload, status=200):
+    response = jsonify({
+        'upload_id': upload['id'],
+        'filename': upload['filename'],
+        'offset': upload['offset'],
+        'length': upload['length'],
+        'upload_url': url_for('upload_chunk', upload_id=upload['id']),
+        'finalize_url': url_for('finalize_upload', upload_id=upload['id']),
+    })
+    response.status_code = status
+    response.headers['Upload-Offset'] = str(upload['offset'])
+    if upload['length'] is not None:
+        response.headers['Upload-Length'] = str(upload['length'])
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    """Start a resumable upload; takes the file name, its length and the subtitle parameters"""
+    name = request.form.get('filename', '')
+    if not allowed_file(name) or not secure_filename(name):
+        return jsonify({'error': f'Invalid file name. Allowed types: {", ".join(ALLOWED_EXTENSIONS)}'}), 400
+
+    try:
+        length = int(request.form.get('length', ''))
+    except ValueError:
+        return jsonify({'error': 'Missing or invalid length. Use the size of the file in bytes'}), 400
+    if not 0 < length <= app.config['MAX_CONTENT_LENGTH']:
+        return jsonify({'error': f'Invalid length. Uploads can be up to {app.config["MAX_CONTENT_LENGTH"]} bytes'}), 400
+
+    options, error = get_subtitle_options(request.form)
+    if error:
+        return jsonify({'error': error}), 400
+
+    upload_id = upload_store.create(secure_filename(name), length, options)
+    response = upload_status(upload_store.get(upload_id), 201)
+    response.headers['Location'] = url_for('upload_chunk', upload_id=upload_id)
+    return response
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def get_upload(upload_id):
+    """Current offset of an upload, also returned in the Upload-Offset header (HEAD works too)"""
+    try:
+        return upload_status(upload_store.get(upload_id))
+    except UploadNotFound:
+        return jsonify({'error': 'Upload not found'}), 404
+
+@app.route('/uploads/<upload_id>', methods=['PATCH'])
+def upload_chunk(upload_id):
+    """Append the request body to an upload at the offset in the Upload-Offset header.
+
+    An optional ``Upload-Checksum: <algorithm> <base64 digest>`` header
+    (md5, sha1 or sha256) rejects corrupted chunks with status 460.
+    """
+    try:
+        offset = int(request.headers.get('Upload-Offset', ''))
+    except ValueError:
+        return jsonify({'error': 'Missing or invalid Upload-Offset header'}), 400
+
+    try:
+        checksum = parse_checksum(request.headers['Upload-Checksum']) \
+            if 'Upload-Checksum' in request.headers else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        offset = upload_store.append(upload_id, offset, request.stream, checksum)
+    except UploadNotFound:
+        return jsonify({'error': 'Upload not found'}), 404
+    except OffsetMismatch as e:
+        response = jsonify({'error': str(e), 'offset': e.offset})
+        response.status_code = 409
+        response.headers['Upload-Offset'] = str(e.offset)
+        return response
+    except ChecksumMismatch as e:
+        return jsonify({'error': str(e)}), 460
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return '', 204, {'Upload-Offset': str(offset)}
+
+@app.route('/uploads/<upload_id>/finalize', methods=['POST'])
+def finalize_upload(upload_id):
+    """Queue a job for a complete upload, optionally verifying a checksum of the whole file"""
+    try:
+        checksum = parse_checksum(request.form['checksum']) if request.form.get('checksum') else None
+        upload = upload_store.get(upload_id)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except UploadNotFound:
+        return jsonify({'error': 'Upload not found'}), 404
+
+    def queue_job(video_path):
+        # Reject what the worker couldn't process now, and spare the worker the probe
+        media = probe_media(video_path, app.config['MAX_MEDIA_SECONDS'])
+        job_queue.submit(job_id, video_path, upload['options'], media)
+
+    job_id = job_queue.new_job()
+    video_path = os.path.join(job_queue.job_dir(job_id), upload['filename'])
+    try:
+        # The upload is kept if the job can't be queued, so it can be finalized again
+        upload_store.finalize(upload_id, video_path, checksum, queue_job)
+    except (UploadNotFound, ValueError) as e:
+        shutil.rmtree(job_queue.job_dir(job_id), ignore_errors=True)
+        if isinstance(e, UploadNotFound):
+            return jsonify({'error': 'Upload not found'}), 404
+        if isinstance(e, OffsetMismatch):
+            return jsonify({'error': f'Upload is incomplete: {e.offset} of {upload["length"]} bytes received'}), 409
+        if isinstance(e, ChecksumMismatch):
+            return jsonify({'error': str(e)}), 460
+        return jsonify({'error': str(e)}), 400
+    except Exception:
+        shutil.rmtree(job_queue.job_dir(job_id), ignore_errors=True)
+        raise
+
+    return job_created_response(job_id)
+
+@app.route('/uploads/<upload_id>', methods=['DELETE'])
+def delete_upload(upload_id):
+    try:
+        upload_store.delete(upload_id)
+    except UploadNotFound:
+        return jsonify({'error': 'Upload not found'}), 404
+    return '', 204
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    return jsonify({
+        'job_id': job['id'],
+        'status': job['status'],
+        'error': job['error'],
+        'attempts': job['attempts'],
+        'created_at': job['created_at'],
+        'started_at': job['started_at'],
+        'finished_at': job['finished_at'],
+        'progress': job['progress'] if job['status'] == 'running' else None,
+        'result_url': url_for('get_job_result', job_id=job_id) if job['status'] == 'done' else None,
+    })
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """Server-Sent Events with the progress of a job.
+
+    ``progress`` events carry the stage, percent complete, encode speed and
+    ETA while the job runs (``queued`` is sent while it waits), and the
+    stream ends with a ``done`` event with the result URL or a ``failed``
+    event with the error. Streams of longer jobs close after
+    SSE_MAX_SECONDS, and the client reconnects to get the current state.
+    """
+    if job_queue.get(job_id) is None:
+        return jsonify({'error': 'Job not found'}), 404
+    result_url = url_for('get_job_result', job_id=job_id)
+    ends_at = time.monotonic() + app.config['SSE_MAX_SECONDS']
+
+    def stream():
+        # Reconnect quickly once the stream reaches SSE_MAX_SECONDS
+        yield 'retry: 1000\n\n'
+        last = None
+        last_sent = time.monotonic()
+        while time.monotonic() < ends_at:
+            job = job_queue.get(job_id)
+            if job is None or job['status'] == 'failed':
+                yield sse_event('failed', {'error': job['error'] if job else 'Job not found'})
+                return
+            if job['status'] == 'done':
+                yield sse_event('done', {'result_url': result_url})
+                return
+
+            update = ('queued', {}) if job['status'] == 'queued' else ('progress', job['progress'] or {})
+            if update != last:
+                yield sse_event(*update)
+                last = update
+                last_sent = time.monotonic()
+            elif time.monotonic() - last_sent >= KEEPALIVE_SECONDS:
+                yield ': keepalive\n\n'
+                last_sent = time.monotonic()
+            time.sleep(app.config['JOB_EVENTS_POLL_INTERVAL'])
+
+    return Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+def load_job_transcript(job_id):
+    """The stored transcript of a finished job, or an error response"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return None, (jsonify({'error': 'Job not found'}), 404)
+    if job['status'] != 'done':
+        return None, (jsonify({'error': f'Job is {job["status"]}', 'status': job['status']}), 409)
+
+    try:
+        return load_transcript(transcript_path(job_queue.job_dir(job_id), job['input_path'])), None
+    except FileNotFoundError:
+        return None, (jsonify({'error': 'The job has no stored transcript'}), 404)
+
+@app.route('/jobs/<job_id>/transcript', methods=['GET'])
+def get_job_transcript(job_id):
+    """Render the transcript of a job as srt, vtt, ass (in any ``ass_style``) or json, without transcribing again"""
+    subtitle_format = request.args.get('format', 'json')
+    ass_style = request.args.get('ass_style', 'default')
+    if subtitle_format not in RENDER_FORMATS:
+        return jsonify({'error': f'Invalid format. Use one of: {", ".join(RENDER_FORMATS)}'}), 400
+    if ass_style not in ['default', 'highlight', 'karaoke']:
+        return jsonify({'error': 'Invalid ASS style. Use "default", "highlight" or "karaoke"'}), 400
+
+    transcript, error = load_job_transcript(job_id)
+    if error:
+        return error
+
+    buffer = io.StringIO()
+    render(transcript, subtitle_format, buffer, ass_style)
+    return Response(buffer.getvalue(), mimetype=RENDER_MIMETYPES[subtitle_format], headers={
+        'Content-Disposition': f'attachment; filename={job_id}.{subtitle_format}',
+    })
+
+@app.route('/render', methods=['POST'])
+def rerender_transcript():
+    """Render a stored transcript again, and add it to a ``video`` if one is uploaded.
+
+    The transcript is a ``transcript`` file (binary or JSON) or the
+    transcript of the job ``job_id``. Takes the subtitle and encoding
+    options of /subtitle; without a video, ``subtitle_format`` can also be
+    vtt or json.
+    """
+    video = request.files.get('video')
+    if video is not None and not video.filename:
+        video = None
+    options, error = get_subtitle_options(request.form, ('srt', 'ass') if video else RENDER_FORMATS)
+    if error:
+        return jsonify({'error': error}), 400
+    if video is not None and not allowed_file(video.filename):
+        return jsonify({'error': f'File type not allowed. Allowed types: {", ".join(ALLOWED_EXTENSIONS)}'}), 400
+
+    with output_store.workspace() as work_dir:
+        if request.form.get('job_id'):
+            transcript, error = load_job_transcript(request.form['job_id'])
+            if error:
+                return error
+            name = request.form['job_id']
+        elif request.files.get('transcript'):
+            upload = request.files['transcript']
+            path = os.path.join(work_dir, 'transcript')
+            upload.save(path)
+            try:
+                transcript = load_transcript(path)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            name = secure_filename(upload.filename) or 'transcript'
+        else:
+            return jsonify({'error': 'No transcript or job_id provided'}), 400
+
+        video_path = media = None
+        if video is not None:
+            video_path = os.path.join(work_dir, secure_filename(video.filename))
+            video.save(video_path)
+            # The transcript is there already; the video only needs a picture
+            media, error = probe_upload(video_path, require_audio=False)
+            if error:
+                return error
+
+        output_dir = os.path.join(work_dir, 'outputs')
+        os.makedirs(output_dir)
+        try:
+            output_path, download_name = rerender(transcript, output_dir, options, video_path, name, media=media)
+        except Exception as e:
+            return jsonify({'error': str(e)}), 500
+
+        output_id = output_store.add(output_path, download_name)
+        response = send_file(output_store.get(output_id, download_name), as_attachment=True,
+                             download_name=download_name)
+        response.headers['Content-Location'] = url_for('get_output', output_id=output_id, name=download_name)
+        return response
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    if job['status'] != 'done':
+        return jsonify({'error': f'Job is {job["status"]}', 'status': job['status']}), 409
+
+    return send_file(
+        job['output_path'],
+        as_attachment=True,
+        download_name=job['download_name'],
+        conditional=True
+    )
+
+@app.route('/live', methods=['GET'])
+def list_live_sources():
+    return jsonify({
+        'sources': [
+            {'name': name, 'events_url': url_for('live_events', name=name)}
+            for name in app.config['LIVE_SOURCES']
+        ]
+    })
+
+@app.route('/live/<name>/events', methods=['GET'])
+def live_events(name):
+    """Server-Sent Events with the subtitles of a live source.
+
+    ``cue`` events carry finalized cues, ``partial`` events the text at the
+    live edge that may still change, and ``end`` is sent when the source
+    ends. Takes the backend, model, task and language as query parameters.
+    The stream closes after SSE_MAX_SECONDS; clients reconnect with the id
+    of the last cue they received in ``Last-Event-ID``.
+    """
+    source = app.config['LIVE_SOURCES'].get(name)
+    if source is None:
+        return jsonify({'error': 'Unknown live source'}), 404
+
+    options = {
+        'backend': request.args.get('backend', DEFAULT_BACKEND),
+        'model': request.args.get('model', 'whisper-1'),
+        'task': request.args.get('task', 'transcribe'),
+        'language': request.args.get('language', 'auto'),
+    }
+    if options['backend'] not in BACKENDS:
+        return jsonify({'error': f'Invalid backend. Use one of: {", ".join(BACKENDS)}'}), 400
+    if options['task'] not in ['transcribe', 'translate']:
+        return jsonify({'error': 'Invalid task. Use "transcribe" or "translate"'}), 400
+
+    # Reconnecting EventSource clients send the id of the last cue they received
+    try:
+        last_event_id = int(request.headers.get('Last-Event-ID', ''))
+    except ValueError:
+        last_event_id = None
+
+    broadcast, subscription = subscribe_broadcast(source, options, last_event_id)
+    ends_at = time.monotonic() + app.config['SSE_MAX_SECONDS']
+
+    def stream():
+        try:
+            # Reconnect quickly once the stream reaches SSE_MAX_SECONDS
+            yield 'retry: 1000\n\n'
+            while True:
+                remaining = ends_at - time.monotonic()
+                if remaining <= 0:
+                    return
+                try:
+                    item = subscription.get(timeout=min(KEEPALIVE_SECONDS, remaining))
+                except queue.Empty:
+                    # Keeps proxies from closing an idle connection
+                    yield ': keepalive\n\n'
+                    continue
+
+                if item is None:
+                    yield sse_event('end', {})
+                    return
+                event, data = item
+                yield sse_event(event, data, data['id'] if event == 'cue' else None)
+        finally:
+            broadcast.unsubscribe(subscription)
+
+    return Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """Transcript cache counters of this worker process"""
+    return jsonify(get_transcript_cache().stats())
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Stage durations, bytes, in-flight work, errors and ffmpeg speed in Prometheus format"""
+    data, content_type = render_metrics()
+    return Response(data, content_type=content_type)
+
 @app.route('/', methods=['GET'])
 def index():
     return render_template('index.html')
@@ -0,0 +1,269 @@
+import os
+import json
+import asyncio
+import mimetypes
+from flask import render_template
+from werkzeug.http import parse_options_header, parse_range_header
+from werkzeug.security import safe_join
+from werkzeug.utils import secure_filename
+from app import app as flask_app, output_store, get_subtitle_options, allowed_file, ALLOWED_EXTENSIONS
+from auto_subtitle.aio import AsyncStreamingUpload, process_video_async, probe_media_async, shutdown_executors
+from auto_subtitle.audio import READ_BLOCK_SIZE, release_audio
+from auto_subtitle.metrics import JobTiming
+from auto_subtitle.probe import MediaError
+
+# asyncio serving mode: the routes of the upload form (/ and /subtitle, plus
+# the static files and /outputs they link to) as an ASGI application, run with
+# e.g. `uvicorn asgi:app`. Uploads are read as they arrive and ffmpeg runs as
+# asyncio subprocesses, so one process serves many connections at once; the
+# configuration and storage are those of the Flask app.
+
+
+class RequestTooLarge(Exception):
+    pass
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+async def send_response(send, status, body=b"", headers=(), content_type="application/json"):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode())]
+                   + [(name.encode(), value.encode()) for name, value in headers],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_json(send, data, status=200):
+    await send_response(send, status, json.dumps(data).encode())
+
+
+def request_range(scope):
+    """The request's Range header, or None. A Range with If-Range is ignored: the whole file is sent."""
+    headers = dict(scope["headers"])
+    if b"range" not in headers or b"if-range" in headers:
+        return None
+    return headers[b"range"].decode("latin-1")
+
+
+async def send_file(send, path, download_name=None, headers=(), head=False, range_header=None):
+    """Stream a file in READ_BLOCK_SIZE chunks, as an attachment named ``download_name`` if given.
+
+    Like Flask's ``send_file``, a single byte range in ``range_header`` is
+    answered with 206 and only that part of the file (416 if it lies past the
+    end); a header with several ranges, or one that doesn't parse, gets the
+    whole file. The file is opened and read on worker threads, off the loop.
+    """
+    f = await asyncio.to_thread(open, path, "rb")
+    try:
+        await _send_open_file(send, f, path, download_name, headers, head, range_header)
+    finally:
+        f.close()
+
+
+async def _send_open_file(send, f, path, download_name, headers, head, range_header):
+    size = os.fstat(f.fileno()).st_size
+    status, start, end = 200, 0, size
+    byte_range = parse_range_header(range_header) if range_header else None
+    if byte_range is not None and byte_range.units == "bytes" and len(byte_range.ranges) == 1:
+        bounds = byte_range.range_for_length(size)
+        if bounds is None:
+            return await send_response(send, 416, headers=[("content-range", f"bytes */{size}")],
+                                       content_type="text/plain")
+        status, (start, end) = 206, bounds
+
+    content_type = mimetypes.guess_type(download_name or path)[0] or "application/octet-stream"
+    headers = [("content-type", content_type), ("content-length", str(end - start)),
+               ("accept-ranges", "bytes")] + list(headers)
+    if status == 206:
+        headers.append(("content-range", f"bytes {start}-{end - 1}/{size}"))
+    if download_name is not None:
+        headers.append(("content-disposition", f"attachment; filename={download_name}"))
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(name.encode(), value.encode()) for name, value in headers],
+    })
+    if head:
+        await send({"type": "http.response.body", "body": b""})
+        return
+
+    f.seek(start)
+    remaining = end - start
+    while remaining:
+        block = await asyncio.to_thread(f.read, min(READ_BLOCK_SIZE, remaining))
+        if not block:
+            break
+        remaining -= len(block)
+        await send({"type": "http.response.body", "body": block, "more_body": True})
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def body_chunks(receive, max_bytes):
+    """The request body as it arrives, raising RequestTooLarge past ``max_bytes``"""
+    received = 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise ClientDisconnected()
+        chunk = message.get("body", b"")
+        received += len(chunk)
+        if received > max_bytes:
+            raise RequestTooLarge()
+        if chunk:
+            yield chunk
+        if not message.get("more_body"):
+            return
+
+
+_index_page = None
+
+
+async def index(scope, receive, send):
+    global _index_page
+    if _index_page is None:
+        with flask_app.test_request_context("/"):
+            _index_page = render_template("index.html").encode()
+    await send_response(send, 200, b"" if scope["method"] == "HEAD" else _index_page,
+                        content_type="text/html; charset=utf-8")
+
+
+async def static_file(scope, receive, send):
+    path = safe_join(flask_app.static_folder, scope["path"][len("/static/"):])
+    if path is None or not await asyncio.to_thread(os.path.isfile, path):
+        return await send_json(send, {"error": "Not found"}, 404)
+    await send_file(send, path, head=scope["method"] == "HEAD", range_header=request_range(scope))
+
+
+async def get_output(scope, receive, send):
+    """Download a result of /subtitle"""
+    _, _, output_id, name = (scope["path"].split("/", 3) + ["", ""])[:4]
+    path = await asyncio.to_thread(output_store.get, output_id, name) if output_id and name else None
+    if path is None:
+        return await send_json(send, {"error": "Output not found or expired"}, 404)
+    await send_file(send, path, name, head=scope["method"] == "HEAD", range_header=request_range(scope))
+
+
+async def subtitle_video(scope, receive, send):
+    headers = dict(scope["headers"])
+    mimetype, params = parse_options_header(headers.get(b"content-type", b"").decode("latin-1"))
+    if mimetype != "multipart/form-data" or not params.get("boundary"):
+        return await send_json(send, {"error": "No video file provided"}, 400)
+
+    max_bytes = flask_app.config["MAX_CONTENT_LENGTH"]
+    if int(headers.get(b"content-length") or 0) > max_bytes:
+        return await send_json(send, {"error": f"Uploads can be up to {max_bytes} bytes"}, 413)
+
+    # Everything the request writes goes to its own workspace, removed afterwards
+    with output_store.workspace() as work_dir:
+        await subtitle_in_workspace(work_dir, params["boundary"].encode(), headers, receive, send)
+
+
+async def subtitle_in_workspace(work_dir, boundary, headers, receive, send):
+    """/subtitle of app.py, with the audio extracted while the upload arrives"""
+    def make_path(name):
+        if not allowed_file(name):
+            raise ValueError(f'File type not allowed. Allowed types: {", ".join(ALLOWED_EXTENSIONS)}')
+        if not secure_filename(name):
+            raise ValueError('Invalid file name')
+        return os.path.join(work_dir, secure_filename(name))
+
+    timing = JobTiming(None)
+    upload = AsyncStreamingUpload(body_chunks(receive, flask_app.config["MAX_CONTENT_LENGTH"]), boundary, 'video',
+                                  make_path, flask_app.config['STREAMING_AUDIO_FORMAT'])
+    try:
+        with timing.stage('upload') as record:
+            record.bytes_in = int(headers.get(b"content-length") or 0) or None
+            await upload.receive()
+    except ValueError as e:
+        timing.log()
+        return await send_json(send, {'error': str(e)}, 400)
+    except RequestTooLarge:
+        timing.log()
+        return await send_json(send, {'error': f'Uploads can be up to {flask_app.config["MAX_CONTENT_LENGTH"]} bytes'},
+                               413)
+    except ClientDisconnected:
+        timing.log()
+        return
+    video_path, audio = upload.video_path, upload.audio
+    timing.video = video_path
+
+    try:
+        options, error = get_subtitle_options(upload.form)
+        if error:
+            timing.failed_stage = 'options'
+            return await send_json(send, {'error': error}, 400)
+
+        try:
+            with timing.stage('probe'):
+                media = await probe_media_async(video_path, flask_app.config['MAX_MEDIA_SECONDS'])
+        except MediaError as e:
+            return await send_json(send, {'error': str(e)}, 400)
+
+        # Audio extracted during the upload is only usable in the default format
+        if audio is not None and options['audio_format'] != flask_app.config['STREAMING_AUDIO_FORMAT']:
+            release_audio(audio)
+            audio = None
+
+        # process_video_async takes over releasing the audio
+        extracted_audio, audio = audio, None
+        try:
+            output_path, download_name = await process_video_async(
+                video_path, work_dir, options, extracted_audio, timing, media
+            )
+            # Keep the result, so it can be downloaded again
+            output_id = await asyncio.to_thread(output_store.add, output_path, download_name)
+        except Exception as e:
+            # Failures outside a timed stage, e.g. while storing the output
+            timing.failed_stage = timing.failed_stage or 'output'
+            return await send_json(send, {'error': str(e)}, 500)
+
+        stored_path = await asyncio.to_thread(output_store.get, output_id, download_name)
+        await send_file(send, stored_path, download_name,
+                        [('content-location', f'/outputs/{output_id}/{download_name}')])
+    finally:
+        timing.log()
+        if audio is not None:
+            release_audio(audio)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            shutdown_executors()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+# Path (or path prefix, ending in /) -> methods -> handler
+ROUTES = {
+    "/": {"GET": index, "HEAD": index},
+    "/subtitle": {"POST": subtitle_video},
+    "/static/": {"GET": static_file, "HEAD": static_file},
+    "/outputs/": {"GET": get_output, "HEAD": get_output},
+}
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+
+    path = scope["path"]
+    methods = ROUTES.get(path) or next(
+        (methods for prefix, methods in ROUTES.items() if prefix.endswith("/") and prefix != "/"
+         and path.startswith(prefix)),
+        None
+    )
+    if methods is None:
+        return await send_json(send, {"error": "Not found"}, 404)
+    if scope["method"] not in methods:
+        return await send_json(send, {"error": "Method not allowed"}, 405)
+    await methods[scope["method"]](scope, receive, send)
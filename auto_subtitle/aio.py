@@ -0,0 +1,300 @@
+import os
+import json
+import asyncio
+import tempfile
+import threading
+from asyncio.subprocess import PIPE, DEVNULL
+from concurrent.futures import ThreadPoolExecutor
+import ffmpeg
+from werkzeug.sansio.multipart import MultipartDecoder, Epilogue, NeedData
+from .utils import filename
+from .audio import (
+    AUDIO_FORMATS, COPY_CODECS, DEFAULT_AUDIO_FORMAT, DEFAULT_SPOOL_BYTES, READ_BLOCK_SIZE,
+    can_copy_audio, new_audio_path, copy_audio_output, wav_audio_output, compressed_audio_output,
+    audio_size, release_audio
+)
+from .ingest import MAX_FORM_MEMORY_SIZE, StreamingUpload, extractor_args
+from .probe import MediaInfo, MAX_MEDIA_SECONDS, check_media, media_error
+from .pipeline import transcribe_audio, render_transcript, add_subtitles, output_stage
+from .metrics import JobTiming
+
+# Encodes (burn-in or mux) running at once. Each is an ffmpeg process that can
+# keep a core or more busy; the rest wait their turn.
+ASYNC_ENCODES = int(os.getenv("AUTO_SUBTITLE_ASYNC_ENCODES", os.cpu_count() or 1))
+
+# Transcriptions running at once. The backends block, so they run on threads
+# that mostly wait for the API.
+ASYNC_TRANSCRIPTIONS = int(os.getenv("AUTO_SUBTITLE_ASYNC_TRANSCRIPTIONS", 64))
+
+# Created on first use so that importing the module has no side effects
+_executors = None
+_executors_lock = threading.Lock()
+
+
+def get_executors():
+    """Return the process-wide ``(transcribe, encode)`` thread pools"""
+    global _executors
+    with _executors_lock:
+        if _executors is None:
+            _executors = (
+                ThreadPoolExecutor(ASYNC_TRANSCRIPTIONS, thread_name_prefix="transcribe"),
+                ThreadPoolExecutor(ASYNC_ENCODES, thread_name_prefix="encode"),
+            )
+    return _executors
+
+
+def shutdown_executors():
+    global _executors
+    with _executors_lock:
+        if _executors is not None:
+            for executor in _executors:
+                executor.shutdown(wait=False, cancel_futures=True)
+            _executors = None
+
+
+async def _kill(process):
+    if process.returncode is None:
+        process.kill()
+        await process.wait()
+
+
+async def run_ffmpeg_async(stream):
+    """Run an ffmpeg-python output stream as an asyncio subprocess, raising ``ffmpeg.Error`` if it fails"""
+    process = await asyncio.create_subprocess_exec(*stream.compile(), stdin=DEVNULL, stdout=DEVNULL, stderr=PIPE)
+    try:
+        _, stderr = await process.communicate()
+    finally:
+        await _kill(process)
+    if process.returncode != 0:
+        raise ffmpeg.Error("ffmpeg", b"", stderr)
+
+
+async def probe_media_async(path: str, max_seconds: float = MAX_MEDIA_SECONDS,
+                            require_audio: bool = True) -> MediaInfo:
+    """``probe_media`` with ffprobe run as an asyncio subprocess"""
+    process = await asyncio.create_subprocess_exec(
+        "ffprobe", "-show_format", "-show_streams", "-of", "json", path, stdout=PIPE, stderr=PIPE
+    )
+    try:
+        out, err = await process.communicate()
+    finally:
+        await _kill(process)
+    if process.returncode != 0:
+        raise media_error(path, ffmpeg.Error("ffprobe", out, err))
+    return check_media(MediaInfo(path, json.loads(out)), max_seconds, require_audio)
+
+
+async def get_audio_async(video_path, audio_format=DEFAULT_AUDIO_FORMAT, media=None,
+                          spool_bytes=DEFAULT_SPOOL_BYTES):
+    """``get_audio`` with ffmpeg run as an asyncio subprocess"""
+    if audio_format not in AUDIO_FORMATS:
+        raise ValueError(f"Unknown audio format {audio_format}. Use one of {', '.join(AUDIO_FORMATS)}")
+
+    codec = AUDIO_FORMATS[audio_format]
+    if codec is None or (media is not None and can_copy_audio(media)):
+        if codec is None:
+            output_path = new_audio_path(video_path, "wav")
+            stream = wav_audio_output(video_path, output_path)
+        else:
+            output_path = new_audio_path(video_path, COPY_CODECS[media.audio_codec][1])
+            stream = copy_audio_output(video_path, media.audio_codec, output_path)
+        try:
+            await run_ffmpeg_async(stream)
+        except BaseException:
+            os.remove(output_path)
+            raise
+        return output_path
+
+    buffer = tempfile.SpooledTemporaryFile(max_size=spool_bytes)
+    process = await asyncio.create_subprocess_exec(
+        *compressed_audio_output(video_path, audio_format).compile(), stdin=DEVNULL, stdout=PIPE, stderr=PIPE
+    )
+    try:
+        stderr = asyncio.ensure_future(process.stderr.read())
+        while True:
+            block = await process.stdout.read(READ_BLOCK_SIZE)
+            if not block:
+                break
+            buffer.write(block)
+        returncode = await process.wait()
+        if returncode != 0:
+            raise ffmpeg.Error("ffmpeg", b"", await stderr)
+        await stderr
+    except BaseException:
+        buffer.close()
+        raise
+    finally:
+        await _kill(process)
+
+    buffer.seek(0)
+    return (f"{filename(video_path)}.{codec['extension']}", buffer)
+
+
+class AsyncAudioExtractor:
+    """``StreamingAudioExtractor`` for asyncio: ffmpeg extracting audio from a video fed to its stdin.
+
+    ``start()`` launches ffmpeg. ``finish()`` returns None if ffmpeg couldn't
+    read the video from a pipe, and the caller extracts from the saved file.
+    """
+
+    def __init__(self, audio_format: str = DEFAULT_AUDIO_FORMAT, spool_bytes: int = DEFAULT_SPOOL_BYTES):
+        self.audio_format = audio_format
+        self.spool_bytes = spool_bytes
+        self.failed = False
+        self.process = None
+        self._tasks = []
+
+    async def start(self):
+        args, self.output_path, self.name = extractor_args(self.audio_format)
+        self.buffer = tempfile.SpooledTemporaryFile(max_size=self.spool_bytes) if self.output_path is None else None
+        self.process = await asyncio.create_subprocess_exec(
+            *args, stdin=PIPE, stdout=PIPE if self.buffer is not None else DEVNULL, stderr=PIPE
+        )
+
+        # Drain ffmpeg's output pipes so it never blocks on them
+        self._tasks = [asyncio.ensure_future(self.process.stderr.read())]
+        if self.buffer is not None:
+            self._tasks.append(asyncio.ensure_future(self._read_stdout()))
+        return self
+
+    async def _read_stdout(self):
+        while True:
+            block = await self.process.stdout.read(READ_BLOCK_SIZE)
+            if not block:
+                return
+            self.buffer.write(block)
+
+    async def feed(self, data: bytes):
+        if self.failed:
+            return
+        try:
+            self.process.stdin.write(data)
+            await self.process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError, OSError):
+            # ffmpeg gave up on the input; keep saving the upload regardless
+            self.failed = True
+
+    async def finish(self):
+        """Wait for ffmpeg and return the extracted audio, or None if extraction failed"""
+        try:
+            self.process.stdin.close()
+            await self.process.stdin.wait_closed()
+        except (BrokenPipeError, ConnectionResetError, OSError):
+            pass
+        returncode = await self.process.wait()
+        await asyncio.gather(*self._tasks)
+
+        if returncode != 0 or self.failed:
+            await self.abort()
+            return None
+
+        if self.buffer is None:
+            return self.output_path
+
+        self.buffer.seek(0)
+        return (self.name, self.buffer)
+
+    async def abort(self):
+        if self.process is not None:
+            await _kill(self.process)
+        for task in self._tasks:
+            task.cancel()
+        if self.buffer is not None:
+            self.buffer.close()
+        if self.output_path is not None and os.path.exists(self.output_path):
+            os.remove(self.output_path)
+
+
+class AsyncStreamingUpload(StreamingUpload):
+    """``StreamingUpload`` reading the request body from an async iterator of chunks"""
+
+    async def receive(self):
+        """Consume the request body. Raises ValueError if the upload is unusable."""
+        decoder = MultipartDecoder(self.boundary, max_form_memory_size=MAX_FORM_MEMORY_SIZE)
+        extractor = None
+
+        try:
+            while True:
+                event = decoder.next_event()
+                if isinstance(event, NeedData):
+                    decoder.receive_data(await anext(self.stream, None))
+                    continue
+                if isinstance(event, Epilogue):
+                    break
+
+                data = self._handle(event)
+                if extractor is None and self._video_file is not None:
+                    extractor = await AsyncAudioExtractor(self.audio_format).start()
+                if data:
+                    await extractor.feed(data)
+            self._close_video()
+        except BaseException:
+            if extractor is not None:
+                await extractor.abort()
+            self._discard_video()
+            raise
+
+        self.audio = await extractor.finish()
+        return self
+
+
+async def process_video_async(video_path, output_dir, options, audio=None, timing=None, media=None):
+    """``process_video`` for an asyncio event loop.
+
+    Probing and extraction run ffmpeg as asyncio subprocesses. Transcription
+    is awaited on a pool of ASYNC_TRANSCRIPTIONS threads, and the subtitle
+    file is written on the loop's default executor. The burn-in goes to
+    a pool of ASYNC_ENCODES threads, so at most that many encodes compete for
+    the cores.
+    """
+    subtitle_format = options["subtitle_format"]
+    log_timing = timing is None
+    timing = timing or JobTiming(video_path)
+    transcribe_pool, encode_pool = get_executors()
+    loop = asyncio.get_running_loop()
+
+    try:
+        if media is None:
+            with timing.stage("probe"):
+                media = await probe_media_async(video_path)
+
+        audio_path = audio
+        if audio_path is None:
+            with timing.stage("extract") as record:
+                record.bytes_in = os.path.getsize(video_path)
+                audio_path = await get_audio_async(
+                    video_path, options.get("audio_format", DEFAULT_AUDIO_FORMAT), media
+                )
+                record.bytes_out = audio_size(audio_path)
+
+        transcription = None
+        try:
+            with timing.stage("transcribe") as record:
+                record.bytes_in = audio_size(audio_path)
+                transcription = loop.run_in_executor(transcribe_pool, transcribe_audio, audio_path, options, timing)
+                result = await transcription
+        finally:
+            # The thread may still be reading the audio if we were cancelled
+            if transcription is not None and not transcription.done():
+                transcription.add_done_callback(lambda _: release_audio(audio_path))
+            else:
+                release_audio(audio_path)
+
+        with timing.stage("render") as record:
+            # Long transcripts take a while to render; keep the loop serving
+            sub_path = await loop.run_in_executor(None, render_transcript, video_path, result, output_dir, options)
+            record.bytes_out = os.path.getsize(sub_path)
+
+        if options["srt_only"] or not media.has_video:
+            return sub_path, f"{filename(video_path)}.{subtitle_format}"
+
+        with timing.stage(output_stage(options)) as record:
+            record.bytes_in = os.path.getsize(video_path)
+            output_video_path = await loop.run_in_executor(
+                encode_pool, add_subtitles, video_path, sub_path, output_dir, options, None, media.probe
+            )
+            record.bytes_out = os.path.getsize(output_video_path)
+        return output_video_path, os.path.basename(output_video_path)
+    finally:
+        if log_timing:
+            timing.log()
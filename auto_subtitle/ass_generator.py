@@ -1,7 +1,12 @@
+import io
+import logging
 from dataclasses import dataclass
-from random import randint
-from typing import List, Dict
-import datetime
+from typing import List, Dict, Iterable, Iterator, TextIO
+
+logger = logging.getLogger(__name__)
+
+# Segments with word timings are split into lines of at most this many characters
+MAX_LINE_CHARS = 20
 
 # ASS file section templates
 ASS_SCRIPT_INFO_TEMPLATE = """[Script Info]
@@ -25,11 +30,18 @@ ASS_FILE_TEMPLATE = """{script_info}
 {events_section}"""
 
 # Event line templates
-ASS_DIALOGUE_TEMPLATE = "Dialogue: 0,{start},{end},Default,,0,0,0,,{text}"
+ASS_DIALOGUE_TEMPLATE = "Dialogue: 0,{start},{end},{style},,0,0,0,,{text}"
 ASS_EFFECT_TEMPLATE = "{{\\t(0, {half}, \\fscx125\\fscy125)}}{{\\t({half}, {full}, \\fscx105\\fscy105)}}"
 ASS_HIGHLIGHT_TEMPLATE = "{effect_template}{{\c{color}}}{word}{{\\r}}"
+ASS_EFFECT = ASS_EFFECT_TEMPLATE.format(half=100, full=200)
+# Karaoke timing: \k waits without highlighting, \kf sweeps the highlight over the word
+ASS_KARAOKE_GAP_TEMPLATE = "{{\\k{duration}}}"
+ASS_KARAOKE_WORD_TEMPLATE = "{{\\kf{duration}}}{word}"
 
-color_random = lambda: f"&H{randint(0, 255):02x}{randint(0, 255):02x}{randint(0, 255):02x}&"
+# Colors cycled through for highlighted words (&HBBGGRR&)
+HIGHLIGHT_COLORS = [
+    "&H00ffff&", "&H00ff00&", "&Hffff00&", "&Hff80ff&", "&H0080ff&", "&Hff8000&", "&H80ff80&", "&H8080ff&",
+]
 
 @dataclass
 class AssStyle:
@@ -101,6 +113,17 @@ class AssGenerator:
                 outline_color="&H60000000",  # Semi-transparent black outline
                 outline=2.0,
                 bold=True
+            ),
+            # One event per line; words are highlighted in turn with \kf tags,
+            # sweeping from SecondaryColour (not yet spoken) to PrimaryColour
+            "karaoke": AssStyle(
+                name="Karaoke",
+                font_size=20,
+                primary_color="&H0000FFFF",  # Yellow for spoken words
+                secondary_color="&H00FFFFFF",  # White for upcoming words
+                outline_color="&H60000000",
+                outline=2.0,
+                bold=True
             )
         }
 
@@ -116,7 +139,7 @@ class AssGenerator:
 
     def _time_to_centiseconds(self, time: float) -> int:
         """Convert time in seconds to centiseconds"""
-        return int(time * 100)
+        return int(round(time * 100))
 
     def _create_ass_header(self, style_name: str = "default") -> str:
         # Generate styles string
@@ -133,132 +156,150 @@ class AssGenerator:
         )
 
     def generate_ass(self, segments: List[Dict], style_name: str = "default") -> str:
-        header = self._create_ass_header(style_name)
-        events = []
-        
-        # Preprocess segments to split long ones
-        processed_segments = []
+        """Render a complete ASS document as a string. Prefer write_ass() for large transcripts."""
+        buffer = io.StringIO()
+        self.write_ass(segments, buffer, style_name)
+        return buffer.getvalue()
+
+    def write_ass(self, segments: Iterable[Dict], file: TextIO, style_name: str = "default"):
+        """Stream an ASS document to ``file``, one Dialogue line at a time"""
+        file.write(self._create_ass_header(style_name))
+        for line in self.iter_events(segments, style_name):
+            file.write(line)
+            file.write("\n")
+
+    def _split_segments(self, segments: Iterable[Dict]) -> Iterator[Dict]:
+        """Split segments with word timings into lines of at most MAX_LINE_CHARS characters"""
         for segment in segments:
             text = segment.get("text", "").strip()
-            
+
             # If no words or text is short enough, keep as is
-            if "words" not in segment or not segment["words"] or len(text) <= 20:
-                processed_segments.append(segment)
+            if "words" not in segment or not segment["words"] or len(text) <= MAX_LINE_CHARS:
+                yield segment
                 continue
-            
+
             # Split long segments based on words
-            words = segment["words"]
             current_segment = {
                 "start": segment["start"],
                 "text": "",
                 "words": []
             }
-            
+            line_words = []
+
             char_count = 0
-            for i, word in enumerate(words):
+            for word in segment["words"]:
                 word_text = word.get("word", "").strip()
                 if not word_text:
                     continue
-                
+
                 # Check if adding this word would exceed the limit
-                if char_count + len(word_text) + (1 if char_count > 0 else 0) > 20 and char_count > 0:
+                if char_count + len(word_text) + (1 if char_count > 0 else 0) > MAX_LINE_CHARS and char_count > 0:
                     # Finalize current segment
-                    if current_segment["words"]:
-                        # Set end time to the start time of the next word
-                        current_segment["end"] = current_segment["words"][-1].get("end", segment["end"])
-                        processed_segments.append(current_segment)
-                    
+                    current_segment["text"] = " ".join(line_words)
+                    current_segment["end"] = current_segment["words"][-1].get("end", segment["end"])
+                    yield current_segment
+
                     # Start a new segment
                     current_segment = {
                         "start": word["start"],
-                        "text": word_text,
-                        "words": [word.copy()]
+                        "text": "",
+                        "words": []
                     }
+                    line_words = []
                     char_count = len(word_text)
                 else:
-                    # Add word to current segment
-                    if char_count > 0:
-                        current_segment["text"] += " " + word_text
-                        char_count += len(word_text) + 1  # +1 for space
-                    else:
-                        current_segment["text"] = word_text
-                        char_count = len(word_text)
-                    
-                    current_segment["words"].append(word.copy())
-            
+                    char_count += len(word_text) + (1 if char_count > 0 else 0)  # +1 for space
+
+                current_segment["words"].append(word)
+                line_words.append(word_text)
+
             # Add the last segment if it has content
             if current_segment["words"]:
+                current_segment["text"] = " ".join(line_words)
                 current_segment["end"] = segment["end"]
-                processed_segments.append(current_segment)
-        
-        # Process the reorganized segments
-        for segment in processed_segments:
+                yield current_segment
+
+    def iter_events(self, segments: Iterable[Dict], style_name: str = "default") -> Iterator[str]:
+        """Yield the Dialogue lines for ``segments``.
+
+        Work is linear in the number of words: each line's text is joined once
+        and every highlighted variant is assembled from slices of it.
+        """
+        word_index = 0
+        for segment in self._split_segments(segments):
             start_time = self._format_time(segment["start"])
             end_time = self._format_time(segment["end"])
             text = segment.get("text", "").strip()
-            
-            print(f"\nProcessing segment: {text}")
-            
-            # If word-level timing is available
-            if "words" in segment and text:
-                words = segment["words"]
-                
-                # If no words timing available, just show the text normally
-                if not words:
-                    line = ASS_DIALOGUE_TEMPLATE.format(start=start_time, end=end_time, text=text)
-                    events.append(line)
+
+            logger.debug("Processing segment: %s", text)
+
+            # Regular subtitle without word timing
+            if "words" not in segment or not segment["words"] or not text:
+                yield ASS_DIALOGUE_TEMPLATE.format(start=start_time, end=end_time, style="Default", text=text)
+                continue
+
+            if style_name == "karaoke":
+                yield ASS_DIALOGUE_TEMPLATE.format(
+                    start=start_time, end=end_time, style="Karaoke", text=self._karaoke_text(segment)
+                )
+                continue
+
+            words = segment["words"]
+
+            # Join the full sentence once and remember where each word starts
+            line_words = []
+            offsets = []
+            position = 0
+            for i, word in enumerate(words):
+                word_text = word.get("word", "").strip()
+                if not word_text:
                     continue
-                
-                # Get the full sentence first
-                full_text = " ".join(w.get("word", "").strip() for w in words if w.get("word", "").strip())
-                print(f"Full text: {full_text}")
-                
-                # Recalculate word timelines
-                for i, word in enumerate(words):
-                    word_text = word.get("word", "").strip()
-                    if not word_text:
-                        continue
-                    
-                    # Get the timing for this word
-                    wordStartTime = word["start"]
-                    # Calculate end time based on next word or segment end
-                    wordEndTime = words[i + 1]["start"] if i < len(words) - 1 else segment["end"]
-                    word["end"] = wordEndTime  # Store end time for future reference
-                    
-                    word_start = self._format_time(wordStartTime)
-                    word_end = self._format_time(wordEndTime)
-                    fullTime = self._time_to_centiseconds(min(wordEndTime - wordStartTime, 100))
-                    halfTime = self._time_to_centiseconds(min(wordEndTime - wordStartTime, 100) / 2)
-                    
-                    # Split the full text into parts: before current word, current word, and after current word
-                    words_list = full_text.split()
-                    highlighted_text = []
-                    
-                    # Build the text with highlighting
-                    for j, w in enumerate(words_list):
-                        if j < i:
-                            highlighted_text.append(w)
-                        elif j == i:
-                            effectStr = ASS_EFFECT_TEMPLATE.format(half=100,
-                                                                 full=200)
-                            highlighted_text.append(ASS_HIGHLIGHT_TEMPLATE
-                                                 .format(word=w, 
-                                                         effect_template=effectStr, 
-                                                         color=color_random()))
-                        else:
-                            highlighted_text.append(w)
-                    
-                    final_text = " ".join(highlighted_text)
-                    print(f"Generated line {i}: {final_text}")
-                    
-                    line = ASS_DIALOGUE_TEMPLATE.format(start=word_start, end=word_end, text=final_text)
-                    events.append(line)
-            
-            else:
-                # Regular subtitle without word timing
-                line = ASS_DIALOGUE_TEMPLATE.format(start=start_time, end=end_time, text=text)
-                events.append(line)
-        
-        # Replace the empty events section in the header with actual events
-        events_section = ASS_EVENTS_SECTION_TEMPLATE.format(events="\n".join(events))
-        return header.replace(ASS_EVENTS_SECTION_TEMPLATE.format(events=""), events_section)
+                line_words.append((i, word_text))
+                offsets.append(position)
+                position += len(word_text) + 1
+            full_text = " ".join(word_text for _, word_text in line_words)
+            logger.debug("Full text: %s", full_text)
+
+            for (i, word_text), offset in zip(line_words, offsets):
+                # Word runs until the next word starts, or until the segment ends
+                word_start_time = words[i]["start"]
+                word_end_time = words[i + 1]["start"] if i < len(words) - 1 else segment["end"]
+
+                highlighted = ASS_HIGHLIGHT_TEMPLATE.format(
+                    word=word_text,
+                    effect_template=ASS_EFFECT,
+                    color=HIGHLIGHT_COLORS[word_index % len(HIGHLIGHT_COLORS)]
+                )
+                word_index += 1
+                final_text = full_text[:offset] + highlighted + full_text[offset + len(word_text):]
+
+                yield ASS_DIALOGUE_TEMPLATE.format(
+                    start=self._format_time(word_start_time),
+                    end=self._format_time(word_end_time),
+                    style="Default",
+                    text=final_text
+                )
+
+    def _karaoke_text(self, segment: Dict) -> str:
+        """Text of a single karaoke event, with \\k/\\kf timing in front of every word"""
+        words = segment["words"]
+        parts = []
+        # Work on rounded absolute times so durations don't drift along the line
+        cursor = self._time_to_centiseconds(segment["start"])
+
+        for i, word in enumerate(words):
+            word_text = word.get("word", "").strip()
+            if not word_text:
+                continue
+
+            start = max(self._time_to_centiseconds(word["start"]), cursor)
+            end_time = words[i + 1]["start"] if i < len(words) - 1 else segment["end"]
+            end = max(self._time_to_centiseconds(end_time), start)
+
+            if start > cursor:
+                parts.append(ASS_KARAOKE_GAP_TEMPLATE.format(duration=start - cursor))
+            parts.append(ASS_KARAOKE_WORD_TEMPLATE.format(duration=end - start, word=word_text))
+            parts.append(" ")
+            cursor = end
+
+        return "".join(parts[:-1])
@@ -0,0 +1,311 @@
+import io
+import os
+import wave
+import hashlib
+import tempfile
+from contextlib import contextmanager
+import ffmpeg
+import numpy as np
+from .utils import filename
+from .progress import media_duration
+
+# Extraction formats. "wav" writes 16 kHz PCM to a temporary file; the others
+# encode to a compact speech codec and keep the result in memory.
+AUDIO_FORMATS = {
+    "wav": None,
+    "opus": {"format": "ogg", "acodec": "libopus", "audio_bitrate": "24k", "extension": "ogg"},
+    "mp3": {"format": "mp3", "acodec": "libmp3lame", "audio_bitrate": "32k", "extension": "mp3"},
+}
+
+DEFAULT_AUDIO_FORMAT = os.getenv("AUTO_SUBTITLE_AUDIO_FORMAT", "opus")
+
+# Compressed audio larger than this is spooled to an anonymous temporary file
+# instead of being kept in memory
+DEFAULT_SPOOL_BYTES = int(os.getenv("AUTO_SUBTITLE_AUDIO_SPOOL_BYTES", 16 * 1024 * 1024))
+
+# Audio tracks in these codecs are copied into a container the transcription
+# backends accept instead of being decoded and encoded again: (format, extension)
+COPY_CODECS = {
+    "aac": ("ipod", "m4a"),
+    "mp3": ("mp3", "mp3"),
+    "opus": ("ogg", "ogg"),
+}
+
+# Only copy tracks up to this size, below the API's 25 MB upload limit, so a
+# copied track is still sent in one request
+DEFAULT_COPY_BYTES = int(os.getenv("AUTO_SUBTITLE_AUDIO_COPY_BYTES", 24 * 1024 * 1024))
+
+SAMPLE_RATE = 16000
+
+READ_BLOCK_SIZE = 64 * 1024
+
+
+def get_audio(video_path, audio_format=DEFAULT_AUDIO_FORMAT, spool_bytes=DEFAULT_SPOOL_BYTES, media=None):
+    """Extract audio from video file
+
+    Returns the path of a WAV file for the "wav" format, or an in-memory
+    ``(filename, file)`` tuple for compressed formats. With the ``MediaInfo``
+    of the input as ``media``, a compressed track in one of COPY_CODECS is
+    copied to a file as it is (see ``copy_audio``).
+    """
+    if audio_format not in AUDIO_FORMATS:
+        raise ValueError(f"Unknown audio format {audio_format}. Use one of {', '.join(AUDIO_FORMATS)}")
+
+    if AUDIO_FORMATS[audio_format] is None:
+        return get_wav_audio(video_path)
+
+    if media is not None and can_copy_audio(media):
+        return copy_audio(video_path, media.audio_codec)
+
+    return get_compressed_audio(video_path, audio_format, spool_bytes)
+
+
+def can_copy_audio(media, max_bytes=DEFAULT_COPY_BYTES):
+    """Whether the audio track of ``media`` can be sent for transcription without re-encoding"""
+    size = media.audio_bytes()
+    return media.audio_codec in COPY_CODECS and size is not None and size <= max_bytes
+
+
+def new_audio_path(video_path, extension):
+    """A uniquely named temporary file for audio extracted from ``video_path``"""
+    fd, output_path = tempfile.mkstemp(prefix=f"{filename(video_path)}-", suffix=f".{extension}")
+    os.close(fd)
+    return output_path
+
+
+def copy_audio_output(video_path, codec, output_path):
+    """The ffmpeg-python stream copying the audio track to ``output_path``"""
+    container, _ = COPY_CODECS[codec]
+    # The index of an M4A file goes first, so it can be decoded from a pipe
+    container_args = {"movflags": "+faststart"} if container == "ipod" else {}
+    return ffmpeg.input(video_path).output(
+        output_path,
+        format=container, acodec="copy", vn=None, map="0:a:0", map_metadata=-1,
+        # Identical input gives identical output, so the transcript cache recognizes it
+        fflags="+bitexact", **container_args
+    ).overwrite_output()
+
+
+def wav_audio_output(video_path, output_path):
+    """The ffmpeg-python stream extracting 16 kHz mono WAV to ``output_path``"""
+    return ffmpeg.input(video_path).output(
+        output_path,
+        acodec="pcm_s16le", ac=1, ar="16k"
+    ).overwrite_output()
+
+
+def compressed_audio_output(video_path, audio_format="opus"):
+    """The ffmpeg-python stream encoding the audio with a speech codec to stdout"""
+    codec = AUDIO_FORMATS[audio_format]
+    return (
+        ffmpeg
+        .input(video_path)
+        .output(
+            "pipe:",
+            format=codec["format"],
+            acodec=codec["acodec"],
+            audio_bitrate=codec["audio_bitrate"],
+            ac=1, ar="16k", vn=None,
+            # Without this the Ogg stream serial is random, so the same audio
+            # would hash differently and never hit the transcript cache
+            fflags="+bitexact"
+        )
+        # Keep stderr small enough that it can't block ffmpeg while we read stdout
+        .global_args("-loglevel", "error")
+    )
+
+
+def copy_audio(video_path, codec):
+    """Copy the audio track into a uniquely named file without decoding it"""
+    output_path = new_audio_path(video_path, COPY_CODECS[codec][1])
+    copy_audio_output(video_path, codec, output_path).run(quiet=True)
+    return output_path
+
+
+def get_wav_audio(video_path):
+    """Extract audio to a uniquely named 16 kHz WAV file"""
+    output_path = new_audio_path(video_path, "wav")
+    wav_audio_output(video_path, output_path).run(quiet=True)
+    return output_path
+
+
+def get_compressed_audio(video_path, audio_format="opus", spool_bytes=DEFAULT_SPOOL_BYTES):
+    """Encode the audio track with a speech codec, streaming ffmpeg's output into a buffer"""
+    codec = AUDIO_FORMATS[audio_format]
+    buffer = tempfile.SpooledTemporaryFile(max_size=spool_bytes)
+
+    process = compressed_audio_output(video_path, audio_format).run_async(pipe_stdout=True, pipe_stderr=True)
+
+    for block in iter(lambda: process.stdout.read(READ_BLOCK_SIZE), b""):
+        buffer.write(block)
+    stderr = process.stderr.read()
+
+    if process.wait() != 0:
+        buffer.close()
+        raise ffmpeg.Error("ffmpeg", b"", stderr)
+
+    buffer.seek(0)
+    return (f"{filename(video_path)}.{codec['extension']}", buffer)
+
+
+@contextmanager
+def open_audio(audio):
+    """Yield an object the OpenAI client can upload, for a path or an in-memory tuple"""
+    if isinstance(audio, str):
+        with open(audio, "rb") as f:
+            yield f
+        return
+
+    name, data = audio
+    if hasattr(data, "seek"):
+        data.seek(0)
+    yield (name, data)
+
+
+def _iter_audio_blocks(audio):
+    if isinstance(audio, str):
+        with open(audio, "rb") as f:
+            yield from iter(lambda: f.read(READ_BLOCK_SIZE), b"")
+        return
+
+    _, data = audio
+    if isinstance(data, bytes):
+        yield data
+        return
+
+    data.seek(0)
+    yield from iter(lambda: data.read(READ_BLOCK_SIZE), b"")
+    data.seek(0)
+
+
+def read_audio(audio) -> bytes:
+    return b"".join(_iter_audio_blocks(audio))
+
+
+def audio_size(audio) -> int:
+    """Size of the audio in bytes"""
+    if isinstance(audio, str):
+        return os.path.getsize(audio)
+
+    _, data = audio
+    if isinstance(data, bytes):
+        return len(data)
+
+    size = data.seek(0, os.SEEK_END)
+    data.seek(0)
+    return size
+
+
+def audio_duration(audio) -> float:
+    """Duration of the audio in seconds, estimated from the bitrate for compressed formats"""
+    name = audio if isinstance(audio, str) else audio[0]
+    extension = os.path.splitext(name)[1].lstrip(".").lower()
+
+    if isinstance(audio, str) and extension != "wav":
+        # Copied from the input, at whatever bitrate it had
+        return media_duration(ffmpeg.probe(audio)) or 0.0
+
+    if extension == "wav":
+        if isinstance(audio, str):
+            source = audio
+        else:
+            _, data = audio
+            source = io.BytesIO(data) if isinstance(data, bytes) else data
+            source.seek(0)
+        with wave.open(source, "rb") as f:
+            duration = f.getnframes() / f.getframerate()
+        if hasattr(source, "seek"):
+            source.seek(0)
+        return duration
+
+    for codec in AUDIO_FORMATS.values():
+        if codec is not None and codec["extension"] == extension:
+            bits_per_second = int(codec["audio_bitrate"].rstrip("k")) * 1000
+            return audio_size(audio) * 8 / bits_per_second
+
+    # Unknown format; assume 16 kHz 16-bit PCM
+    return audio_size(audio) / (SAMPLE_RATE * 2)
+
+
+def audio_digest(audio) -> str:
+    """SHA-256 of the audio contents"""
+    digest = hashlib.sha256()
+    for block in _iter_audio_blocks(audio):
+        digest.update(block)
+    return digest.hexdigest()
+
+
+def load_pcm(audio):
+    """Decode audio into a mono int16 array, returning (samples, sample_rate)"""
+    if isinstance(audio, str) and audio.endswith(".wav"):
+        with wave.open(audio, "rb") as f:
+            if f.getsampwidth() != 2 or f.getnchannels() != 1:
+                raise ValueError(f"Expected mono 16-bit PCM audio, got {audio}")
+            sample_rate = f.getframerate()
+            samples = np.frombuffer(f.readframes(f.getnframes()), dtype=np.int16)
+        return samples, sample_rate
+
+    out, _ = (
+        ffmpeg
+        .input("pipe:")
+        .output("pipe:", format="s16le", acodec="pcm_s16le", ac=1, ar=SAMPLE_RATE)
+        .run(input=read_audio(audio), capture_stdout=True, capture_stderr=True)
+    )
+    return np.frombuffer(out, dtype=np.int16), SAMPLE_RATE
+
+
+def encode_wav(samples, sample_rate: int) -> bytes:
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(samples.tobytes())
+    return buffer.getvalue()
+
+
+def reencode_codec(name):
+    """The AUDIO_FORMATS codec that decoded samples of the audio file ``name``
+    are encoded with again, or None for WAV. Compressed audio stays compressed:
+    formats we don't encode (e.g. a copied AAC track) become opus."""
+    extension = os.path.splitext(name)[1].lstrip(".").lower()
+    if extension == "wav":
+        return None
+    return next(
+        (codec for codec in AUDIO_FORMATS.values() if codec and codec["extension"] == extension),
+        AUDIO_FORMATS["opus"]
+    )
+
+
+def encode_audio(samples, sample_rate: int, name: str):
+    """Encode PCM samples in the format of the audio file ``name`` (see ``reencode_codec``),
+    as an in-memory tuple"""
+    codec = reencode_codec(name)
+    if codec is None:
+        return (f"{filename(name)}.wav", encode_wav(samples, sample_rate))
+
+    out, _ = (
+        ffmpeg
+        .input("pipe:", format="s16le", ac=1, ar=sample_rate)
+        .output(
+            "pipe:",
+            format=codec["format"],
+            acodec=codec["acodec"],
+            audio_bitrate=codec["audio_bitrate"],
+            fflags="+bitexact"
+        )
+        .run(input=samples.tobytes(), capture_stdout=True, capture_stderr=True)
+    )
+    return (f"{filename(name)}.{codec['extension']}", out)
+
+
+def release_audio(audio):
+    """Delete or close extracted audio once it is no longer needed"""
+    if isinstance(audio, str):
+        if os.path.exists(audio):
+            os.remove(audio)
+        return
+
+    _, data = audio
+    if hasattr(data, "close"):
+        data.close()
@@ -0,0 +1,176 @@
+import os
+import json
+import queue
+import zipfile
+import threading
+import ffmpeg
+from .pipeline import run_pipeline
+
+# Videos of a batch that each pipeline stage works on at once
+DEFAULT_BATCH_JOBS = int(os.getenv("AUTO_SUBTITLE_BATCH_JOBS", 4))
+
+COPY_CHUNK_BYTES = 1024 * 1024
+
+# Already compressed; deflating them again only costs time
+STORED_EXTENSIONS = {".mp4", ".mkv", ".mov", ".avi", ".webm"}
+
+
+def unique_name(name: str, taken: set) -> str:
+    """``name``, or ``name-2.ext`` etc. if a name with the same stem was taken.
+
+    Outputs are named after the stem of their video, so ``clip.mp4`` and
+    ``clip.mkv`` would otherwise both produce ``clip.ass``.
+    """
+    stem, extension = os.path.splitext(name)
+    candidate, number = stem, 1
+    while candidate.lower() in taken:
+        number += 1
+        candidate = f"{stem}-{number}"
+    taken.add(candidate.lower())
+    return candidate + extension
+
+
+def extract_archive(archive_path: str, dest_dir: str, accept, max_bytes: int) -> list:
+    """Extract the videos in a zip archive to ``dest_dir`` and return their paths.
+
+    ``accept(name)`` returns the safe file name to extract a member to, or
+    None to skip it. Raises ValueError if the archive can't be read or its
+    videos add up to more than ``max_bytes``.
+    """
+    try:
+        archive = zipfile.ZipFile(archive_path)
+    except zipfile.BadZipFile:
+        raise ValueError("The archive is not a valid zip file")
+
+    with archive:
+        members = [
+            (info, accept(os.path.basename(info.filename)))
+            for info in archive.infolist() if not info.is_dir()
+        ]
+        members = [(info, name) for info, name in members if name]
+        if sum(info.file_size for info, _ in members) > max_bytes:
+            raise ValueError("The videos in the archive are too large")
+
+        paths = []
+        for info, name in members:
+            path = os.path.join(dest_dir, name)
+            try:
+                with archive.open(info) as source, open(path, "wb") as target:
+                    for chunk in iter(lambda: source.read(COPY_CHUNK_BYTES), b""):
+                        target.write(chunk)
+            except (zipfile.BadZipFile, NotImplementedError, RuntimeError) as e:
+                raise ValueError(f"Can't extract {info.filename} from the archive: {e}")
+            paths.append(path)
+    return paths
+
+
+def _error_message(error) -> str:
+    # ffmpeg.Error only says to look at stderr, whose last line is the actual error
+    if isinstance(error, ffmpeg.Error) and error.stderr:
+        lines = error.stderr.decode("utf-8", "replace").strip().splitlines()
+        if lines:
+            return lines[-1]
+    return str(error)
+
+
+class _ZipSink:
+    """Write-only file for ZipFile that hands out what was written so far"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        """Yield the bytes written since the last call, if any"""
+        if self.buffer:
+            data = bytes(self.buffer)
+            self.buffer.clear()
+            yield data
+
+
+def _add_file(archive: zipfile.ZipFile, sink: _ZipSink, path: str):
+    """Copy a file into the archive, yielding the zip bytes as they are produced"""
+    info = zipfile.ZipInfo.from_file(path, os.path.basename(path))
+    stored = os.path.splitext(path)[1].lower() in STORED_EXTENSIONS
+    info.compress_type = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+    with open(path, "rb") as source, \
+            archive.open(info, "w", force_zip64=info.file_size > zipfile.ZIP64_LIMIT) as entry:
+        for chunk in iter(lambda: source.read(COPY_CHUNK_BYTES), b""):
+            entry.write(chunk)
+            yield from sink.take()
+
+
+def stream_batch(video_paths, output_dir, options, jobs: int = DEFAULT_BATCH_JOBS, on_finished=None):
+    """Subtitle several videos and yield a zip archive of the results as each one finishes.
+
+    The videos go through ``run_pipeline``, so up to ``jobs`` of them are in
+    each stage at once. The subtitle file and the subtitled video of every
+    video are added to the archive (and deleted) as soon as the video is
+    done. A failed video doesn't stop the others; ``results.json`` at the
+    end of the archive lists the status, files or error of every video.
+
+    If the generator is closed early (the client went away), the videos not
+    started yet are cancelled and the generator returns without waiting for
+    the ones in flight. ``on_finished`` is called once the archive is done
+    and no video is in flight any more, e.g. to remove ``output_dir``.
+    """
+    finished = queue.Queue()
+    cancel = threading.Event()
+    # Whichever of the generator and the pipeline thread ends last calls on_finished
+    users = [2]
+    users_lock = threading.Lock()
+
+    def release():
+        with users_lock:
+            users[0] -= 1
+            last = users[0] == 0
+        if last and on_finished is not None:
+            on_finished()
+
+    def run():
+        try:
+            run_pipeline(video_paths, output_dir, options, jobs, on_done=finished.put, cancel=cancel)
+        finally:
+            finished.put(None)
+            release()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+
+    sink = _ZipSink()
+    results = {}
+    completed = False
+    try:
+        with zipfile.ZipFile(sink, "w") as archive:
+            for item in iter(finished.get, None):
+                result = {"video": os.path.basename(item["video"])}
+                if item["error"] is not None:
+                    result.update(status="failed", failed_stage=item["failed_stage"], error=_error_message(item["error"]))
+                else:
+                    result.update(status="done", files=[])
+                    for path in (item["sub_path"], item["output"]):
+                        if path is None:
+                            continue
+                        yield from _add_file(archive, sink, path)
+                        result["files"].append(os.path.basename(path))
+                        os.remove(path)
+                results[item["video"]] = result
+                yield from sink.take()
+
+            manifest = [
+                results.get(path) or {"video": os.path.basename(path), "status": "failed", "error": "not processed"}
+                for path in video_paths
+            ]
+            archive.writestr("results.json", json.dumps({"results": manifest}, indent=2))
+        yield from sink.take()
+        completed = True
+    finally:
+        if not completed:
+            cancel.set()
+        release()
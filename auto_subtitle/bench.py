@@ -0,0 +1,278 @@
+"""Benchmarks for the subtitle pipeline.
+
+    python -m auto_subtitle.bench [--suite micro,ffmpeg,e2e] [--quick]
+
+Results are written as JSON and compared with a stored baseline; the command
+exits with status 1 if a benchmark got slower than the regression threshold.
+"""
+import io
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+from datetime import datetime, timezone
+import ffmpeg
+from .utils import format_timestamp, write_srt
+from .ass_generator import AssGenerator
+from .audio import get_audio, release_audio
+from .burn import create_subtitled_video
+from .storage import OutputStore
+
+SUITES = ["micro", "ffmpeg", "e2e"]
+
+WORD_COUNTS = [10, 100, 1000, 10000, 100000]
+QUICK_WORD_COUNTS = [10, 100, 1000, 10000]
+
+# (name, width, height, seconds)
+CLIPS = [
+    ("240p-10s", 320, 240, 10),
+    ("240p-60s", 320, 240, 60),
+    ("720p-10s", 1280, 720, 10),
+    ("720p-60s", 1280, 720, 60),
+    ("1080p-10s", 1920, 1080, 10),
+]
+QUICK_CLIPS = [CLIPS[0], CLIPS[2]]
+
+DEFAULT_BASELINE = os.path.join("benchmarks", "baseline.json")
+DEFAULT_THRESHOLD = 0.25
+# Differences smaller than this are timer noise, whatever the ratio
+NOISE_SECONDS = 0.005
+
+WORDS = ["subtitle", "video", "the", "a", "quick", "transcript", "of", "speech", "and", "words", "timing", "line"]
+
+
+def synthetic_segments(word_count: int, words_per_segment: int = 12, word_seconds: float = 0.4, seed: int = 0):
+    """A transcript of ``word_count`` words with word timestamps, the same for every run"""
+    rng = random.Random(seed)
+    segments = []
+    time_position = 0.0
+    for first in range(0, word_count, words_per_segment):
+        words = []
+        for _ in range(min(words_per_segment, word_count - first)):
+            duration = word_seconds * rng.uniform(0.5, 1.5)
+            words.append({"word": f" {rng.choice(WORDS)}", "start": time_position, "end": time_position + duration})
+            time_position += duration
+        segments.append({
+            "id": len(segments),
+            "start": words[0]["start"],
+            "end": words[-1]["end"],
+            "text": "".join(word["word"] for word in words),
+            "words": words,
+        })
+        # Pause between segments
+        time_position += word_seconds
+    return segments
+
+
+def make_clip(path: str, width: int, height: int, seconds: float):
+    """Generate a test video with a tone, so every machine benchmarks the same input"""
+    video = ffmpeg.input(f"testsrc=size={width}x{height}:rate=30:duration={seconds}", f="lavfi")
+    audio = ffmpeg.input(f"sine=frequency=440:duration={seconds}", f="lavfi")
+    (
+        ffmpeg
+        .output(video, audio, path, vcodec="libx264", preset="veryfast", pix_fmt="yuv420p", acodec="aac", g=60)
+        .overwrite_output()
+        .run(capture_stdout=True, capture_stderr=True)
+    )
+    return path
+
+
+class Bench:
+    """Runs benchmark cases and collects their timings"""
+
+    def __init__(self, repeat: int = None):
+        self.repeat = repeat
+        self.results = {}
+
+    def run(self, name: str, func, repeat: int = 5):
+        repeat = self.repeat or repeat
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - started)
+
+        self.results[name] = {
+            "seconds": statistics.median(timings),
+            "min": min(timings),
+            "runs": repeat,
+        }
+        print(f"{name:<48} {self.results[name]['seconds']:>10.4f}s")
+
+
+def bench_micro(bench: Bench, word_counts):
+    generator = AssGenerator()
+    for word_count in word_counts:
+        segments = synthetic_segments(word_count)
+        timestamps = [time for segment in segments for word in segment["words"] for time in (word["start"], word["end"])]
+        # Fewer repetitions for the largest transcripts
+        repeat = 5 if word_count <= 10000 else 2
+
+        for style in ("default", "highlight", "karaoke"):
+            bench.run(f"micro/generate_ass/{style}/{word_count}", lambda: generator.generate_ass(segments, style), repeat)
+        bench.run(f"micro/write_srt/{word_count}", lambda: write_srt(segments, io.StringIO()), repeat)
+        bench.run(
+            f"micro/format_timestamp/{word_count}",
+            lambda: [format_timestamp(t, always_include_hours=True) for t in timestamps],
+            repeat
+        )
+
+
+def bench_ffmpeg(bench: Bench, work_dir: str, clips):
+    generator = AssGenerator()
+    for name, width, height, seconds in clips:
+        print(f"Generating {name} clip...")
+        clip = make_clip(os.path.join(work_dir, f"{name}.mp4"), width, height, seconds)
+
+        for audio_format in ("opus", "wav"):
+            bench.run(f"ffmpeg/extract/{audio_format}/{name}", lambda: release_audio(get_audio(clip, audio_format)), 3)
+
+        # Roughly one word every 0.4 seconds
+        segments = synthetic_segments(int(seconds / 0.4))
+        for style in ("default", "highlight", "karaoke"):
+            sub_path = os.path.join(work_dir, f"{name}-{style}.ass")
+            with open(sub_path, "w", encoding="utf-8") as f:
+                generator.write_ass(segments, f, style)
+            bench.run(
+                f"ffmpeg/burn/{style}/{name}",
+                lambda: create_subtitled_video(clip, sub_path, work_dir, "ass"),
+                1
+            )
+
+
+def bench_e2e(bench: Bench, work_dir: str):
+    try:
+        import app as web
+    except ImportError:
+        print("Skipping end-to-end benchmarks: app.py can't be imported (run from the repository root)")
+        return
+
+    web.output_store = OutputStore(os.path.join(work_dir, "outputs"), os.path.join(work_dir, "uploads"))
+    client = web.app.test_client()
+
+    clip = make_clip(os.path.join(work_dir, "e2e.mp4"), 320, 240, 10)
+
+    def post(**fields):
+        with open(clip, "rb") as f:
+            response = client.post(
+                "/subtitle",
+                data={"video": (f, "e2e.mp4"), "backend": "fake", "cache": "false", **fields},
+                content_type="multipart/form-data"
+            )
+        if response.status_code != 200:
+            raise RuntimeError(f"/subtitle returned {response.status_code}: {response.get_data(as_text=True)}")
+        response.close()
+
+    bench.run("e2e/subtitle/srt_only", lambda: post(subtitle_format="srt", srt_only="true"), 3)
+    bench.run("e2e/subtitle/burn", lambda: post(encoder_profile="fast"), 3)
+    bench.run("e2e/subtitle/mux", lambda: post(output_mode="mux"), 3)
+
+
+def ffmpeg_version() -> str:
+    try:
+        output = subprocess.run(["ffmpeg", "-version"], capture_output=True, text=True).stdout
+        return output.splitlines()[0] if output else "unknown"
+    except OSError:
+        return "unknown"
+
+
+def compare(results: dict, baseline: dict, threshold: float):
+    """Print how each benchmark changed against the baseline and return the regressed ones"""
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+
+        ratio = result["seconds"] / previous["seconds"] if previous["seconds"] else float("inf")
+        regressed = ratio > 1 + threshold and result["seconds"] - previous["seconds"] > NOISE_SECONDS
+        if regressed:
+            regressions.append(name)
+        print(f"{name:<48} {previous['seconds']:>10.4f}s -> {result['seconds']:>10.4f}s "
+              f"({ratio:>5.2f}x){'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m auto_subtitle.bench",
+        description="Benchmark the subtitle pipeline and compare against a baseline",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--suite", type=str, default=",".join(SUITES),
+                        help="comma separated suites to run: micro, ffmpeg, e2e")
+    parser.add_argument("--quick", action="store_true",
+                        help="skip the largest transcripts and clips")
+    parser.add_argument("--repeat", type=int, default=None,
+                        help="runs per benchmark; by default cheap benchmarks run more often than expensive ones")
+    parser.add_argument("--output", "-o", type=str, default="bench_results.json",
+                        help="file to write the results to")
+    parser.add_argument("--baseline", type=str, default=DEFAULT_BASELINE,
+                        help="results to compare against")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="fraction by which a benchmark may get slower than the baseline")
+    parser.add_argument("--save_baseline", action="store_true",
+                        help="store the results as the new baseline")
+
+    args = parser.parse_args()
+    suites = [suite.strip() for suite in args.suite.split(",") if suite.strip()]
+    unknown = set(suites) - set(SUITES)
+    if unknown:
+        parser.error(f"unknown suites: {', '.join(sorted(unknown))}")
+
+    # Keep the per-request timing records out of the benchmark output
+    logging.getLogger("auto_subtitle.metrics").setLevel(logging.WARNING)
+
+    bench = Bench(args.repeat)
+    with tempfile.TemporaryDirectory(prefix="auto_subtitle_bench-") as work_dir:
+        if "micro" in suites:
+            bench_micro(bench, QUICK_WORD_COUNTS if args.quick else WORD_COUNTS)
+        if "ffmpeg" in suites:
+            bench_ffmpeg(bench, work_dir, QUICK_CLIPS if args.quick else CLIPS)
+        if "e2e" in suites:
+            bench_e2e(bench, work_dir)
+
+    report = {
+        "meta": {
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "ffmpeg": ffmpeg_version(),
+            "suites": suites,
+            "quick": args.quick,
+        },
+        "results": bench.results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {os.path.abspath(args.output)}")
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved baseline to {os.path.abspath(args.baseline)}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}; run with --save_baseline to create one")
+        return
+
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    print(f"\nCompared with the baseline from {baseline['meta']['created_at']}:")
+    regressions = compare(bench.results, baseline["results"], args.threshold)
+    if regressions:
+        print(f"{len(regressions)} benchmark(s) regressed by more than {args.threshold:.0%}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+import os
+import bisect
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import ffmpeg
+from .utils import filename
+from .progress import run_ffmpeg, media_duration, Progress
+
+logger = logging.getLogger(__name__)
+
+# Encoder threads per burn; 0 lets x264 pick, or shares the cores between the
+# segments of a segmented burn
+ENCODER_THREADS = int(os.getenv("AUTO_SUBTITLE_ENCODER_THREADS", 0))
+
+# x264 settings for burned-in subtitles. Segments of a segmented burn are
+# encoded with the same profile so they can be joined without re-encoding.
+ENCODER_PROFILES = {
+    "fast": {"preset": "veryfast", "crf": 23, "threads": ENCODER_THREADS, "tune": None},
+    "balanced": {"preset": "medium", "crf": 23, "threads": ENCODER_THREADS, "tune": None},
+    "archive": {"preset": "slow", "crf": 18, "threads": ENCODER_THREADS, "tune": "film"},
+}
+
+DEFAULT_ENCODER_PROFILE = os.getenv("AUTO_SUBTITLE_ENCODER_PROFILE", "balanced")
+
+# Audio codecs that can be copied into the MP4 output as they are; anything
+# else is encoded to AAC
+MP4_AUDIO_CODECS = {"aac", "mp3", "ac3", "eac3", "alac"}
+
+DEFAULT_BURN_SEGMENTS = int(os.getenv("AUTO_SUBTITLE_BURN_SEGMENTS", os.cpu_count() or 1))
+
+# Most segments a request may ask for, whatever the default
+MAX_BURN_SEGMENTS = int(os.getenv("AUTO_SUBTITLE_MAX_BURN_SEGMENTS", max(os.cpu_count() or 1, DEFAULT_BURN_SEGMENTS)))
+
+# Previews burn the subtitles into this many seconds of the video, at most
+# this many lines high, as fast as x264 can encode
+PREVIEW_SECONDS = float(os.getenv("AUTO_SUBTITLE_PREVIEW_SECONDS", 15))
+PREVIEW_HEIGHT = int(os.getenv("AUTO_SUBTITLE_PREVIEW_HEIGHT", 360))
+PREVIEW_ENCODER_ARGS = {"vcodec": "h264", "preset": "ultrafast", "crf": 28}
+
+# Don't split videos into segments shorter than this; the per-process startup
+# cost would outweigh the gain
+MIN_SEGMENT_SECONDS = 10.0
+
+
+def subtitle_filter(stream, sub_path, subtitle_format):
+    if subtitle_format == "srt":
+        # For SRT, use subtitles filter
+        return stream.filter('subtitles', sub_path, force_style="OutlineColour=&H40000000,BorderStyle=3")
+    # For ASS, use ass filter which properly handles all styling
+    return stream.filter('ass', sub_path)
+
+
+def video_encoder_args(profile=DEFAULT_ENCODER_PROFILE, threads=None):
+    """ffmpeg output arguments for encoding the video with an encoder profile"""
+    if profile not in ENCODER_PROFILES:
+        raise ValueError(f"Unknown encoder profile {profile}. Use one of {', '.join(ENCODER_PROFILES)}")
+
+    settings = ENCODER_PROFILES[profile]
+    args = {"vcodec": "h264", "preset": settings["preset"], "crf": settings["crf"]}
+    if settings["tune"]:
+        args["tune"] = settings["tune"]
+    threads = settings["threads"] or threads
+    if threads:
+        args["threads"] = threads
+    return args
+
+
+def audio_codec(video_path, probe=None):
+    """Codec to write the audio with: "copy" when the source codec fits in MP4,
+    "aac" otherwise, or None if the video has no audio"""
+    probe = probe or ffmpeg.probe(video_path)
+    audio = next((s for s in probe['streams'] if s['codec_type'] == 'audio'), None)
+    if audio is None:
+        return None
+    return "copy" if audio.get('codec_name') in MP4_AUDIO_CODECS else "aac"
+
+
+def _output_streams(video, source, acodec):
+    """Output streams and audio arguments for the filtered video plus the source audio"""
+    if acodec is None:
+        return [video], {}
+    return [video, source['a:0']], {"acodec": acodec}
+
+
+def create_subtitled_video(video_path, sub_path, output_dir, subtitle_format,
+                           profile=DEFAULT_ENCODER_PROFILE, on_progress=None, probe=None):
+    """Burn subtitles into video, passing ``Progress`` snapshots to ``on_progress``.
+
+    ``probe`` is the output of ``ffmpeg.probe`` for the video, if it was already probed.
+    """
+    out_path = os.path.join(output_dir, f"{filename(video_path)}_subtitled.mp4")
+
+    # Set up ffmpeg inputs
+    source = ffmpeg.input(video_path)
+    video_with_subs = subtitle_filter(source['v:0'], sub_path, subtitle_format)
+
+    # Only the video goes through the filter graph; the audio is copied
+    # whenever its codec allows
+    probe = probe or ffmpeg.probe(video_path)
+    streams, audio_args = _output_streams(video_with_subs, source, audio_codec(video_path, probe))
+
+    # Hard encode the subtitles
+    run_ffmpeg(
+        ffmpeg
+        .output(
+            *streams,
+            out_path,
+            **audio_args,
+            **video_encoder_args(profile)
+        )
+        .overwrite_output(),
+        "burn", media_duration(probe), on_progress
+    )
+
+    return out_path
+
+
+def create_preview(video_path, sub_path, output_dir, subtitle_format, start=0.0,
+                   seconds=PREVIEW_SECONDS, height=PREVIEW_HEIGHT, on_progress=None, probe=None):
+    """Burn subtitles into a short, downscaled excerpt of the video from ``start``,
+    encoded with x264's ultrafast preset so it is ready within seconds"""
+    out_path = os.path.join(output_dir, f"{filename(video_path)}_preview.mp4")
+
+    probe = probe or ffmpeg.probe(video_path)
+    stream = next((s for s in probe['streams'] if s['codec_type'] == 'video'), {})
+    source = ffmpeg.input(video_path, ss=f"{start:.6f}", t=f"{seconds:.6f}") if start \
+        else ffmpeg.input(video_path, t=f"{seconds:.6f}")
+    video = source['v:0']
+    if start:
+        # Seeking restarts the timestamps at zero; move them back so the
+        # subtitle events line up, as in a segmented burn
+        video = video.filter('setpts', f"PTS+{start:.6f}/TB")
+    if stream.get('height', 0) > height:
+        # Scale first, so the subtitles are drawn at the preview size
+        video = video.filter('scale', -2, height)
+    video = subtitle_filter(video, sub_path, subtitle_format).filter('setpts', 'PTS-STARTPTS')
+
+    streams, audio_args = _output_streams(video, source, audio_codec(video_path, probe))
+    duration = media_duration(probe)
+    run_ffmpeg(
+        ffmpeg
+        .output(*streams, out_path, movflags='+faststart', **audio_args, **PREVIEW_ENCODER_ARGS)
+        .overwrite_output(),
+        "preview", min(seconds, duration - start) if duration else seconds, on_progress
+    )
+
+    return out_path
+
+
+def video_frames(video_path):
+    """Presentation times of the video frames, relative to the start of the file, and
+    the indices of the keyframes among them"""
+    probe = ffmpeg.probe(video_path, select_streams='v:0', show_entries='packet=pts_time,flags')
+    start_time = float(probe['format'].get('start_time') or 0)
+
+    packets = sorted(
+        (float(packet['pts_time']) - start_time, 'K' in packet.get('flags', ''))
+        for packet in probe.get('packets', [])
+        if packet.get('pts_time') not in (None, 'N/A')
+    )
+    times = [time for time, _ in packets]
+    keyframes = [index for index, (_, key) in enumerate(packets) if key]
+    return times, keyframes
+
+
+def plan_segments(times, keyframes, segments, min_seconds=MIN_SEGMENT_SECONDS):
+    """Frame index ranges of up to ``segments`` roughly equal parts, each starting at a keyframe"""
+    if len(times) < 2:
+        return [(0, len(times))]
+
+    duration = times[-1] - times[0]
+    segments = max(1, min(segments, int(duration // min_seconds)))
+
+    keyframe_times = [times[index] for index in keyframes]
+    starts = set()
+    for part in range(1, segments):
+        position = bisect.bisect_left(keyframe_times, times[0] + duration * part / segments)
+        if position < len(keyframes) and keyframes[position] > 0:
+            starts.add(keyframes[position])
+
+    bounds = [0] + sorted(starts) + [len(times)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _seek_time(times, index):
+    # Halfway between the segment's first frame and the one before it, so
+    # rounding can't move the cut by a frame in either direction
+    return (times[index - 1] + times[index]) / 2 if index > 0 else None
+
+
+def _burn_segment(video_path, sub_path, subtitle_format, seek, frame_count, segment_path, encoder_args,
+                  on_progress=None):
+    stream = ffmpeg.input(video_path, ss=f"{seek:.6f}") if seek is not None else ffmpeg.input(video_path)
+    video = stream.video
+    if seek is not None:
+        # Seeking restarts the timestamps at zero; move them back onto the
+        # original timeline so the subtitle events line up, then restart them
+        # at zero for the concat demuxer
+        video = video.filter('setpts', f"PTS+{seek:.6f}/TB")
+    video = subtitle_filter(video, sub_path, subtitle_format).filter('setpts', 'PTS-STARTPTS')
+
+    run_ffmpeg(
+        ffmpeg
+        .output(video, segment_path, an=None, fps_mode='passthrough',
+                **{'frames:v': frame_count}, **encoder_args)
+        .overwrite_output(),
+        "burn_segment", on_progress=on_progress
+    )
+    return segment_path
+
+
+def _frames_match(times, out_times):
+    if len(times) != len(out_times):
+        return False
+    intervals = [b - a for a, b in zip(times, times[1:]) if b > a]
+    tolerance = min(intervals) / 2 if intervals else 0.001
+    return all(abs((a - times[0]) - (b - out_times[0])) < tolerance for a, b in zip(times, out_times))
+
+
+def burn_segmented(video_path, sub_path, output_dir, subtitle_format, segments=DEFAULT_BURN_SEGMENTS,
+                   profile=DEFAULT_ENCODER_PROFILE, on_progress=None, probe=None):
+    """Burn subtitles into video by encoding keyframe-aligned segments in parallel.
+
+    The segments are joined with the concat demuxer without re-encoding and
+    the original audio track is copied (or encoded once) over the whole file,
+    so it stays continuous. The joined video is checked to have the same frames at the
+    same times as the source; if it doesn't, or the video is too short to
+    split, the video is burned in a single pass instead. The progress of
+    the segments is passed to ``on_progress`` as one combined snapshot.
+    """
+    times, keyframes = video_frames(video_path)
+    ranges = plan_segments(times, keyframes, segments)
+    if len(ranges) < 2:
+        return create_subtitled_video(video_path, sub_path, output_dir, subtitle_format, profile, on_progress, probe)
+
+    out_path = os.path.join(output_dir, f"{filename(video_path)}_subtitled.mp4")
+    # Share the cores between the segment encoders unless the profile sets a thread count
+    encoder_args = video_encoder_args(profile, threads=max(1, (os.cpu_count() or 1) // len(ranges)))
+
+    progress = Progress("burn", times[-1] - times[0])
+    positions = [0.0] * len(ranges)
+    progress_lock = threading.Lock()
+
+    def segment_progress(index):
+        if on_progress is None:
+            return None
+
+        def report(snapshot):
+            with progress_lock:
+                positions[index] = snapshot["out_seconds"]
+                on_progress(progress.snapshot(sum(positions)))
+        return report
+
+    with tempfile.TemporaryDirectory(prefix=f"{filename(video_path)}-segments-", dir=output_dir) as work_dir:
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = [
+                executor.submit(
+                    _burn_segment, video_path, sub_path, subtitle_format,
+                    _seek_time(times, first), last - first,
+                    os.path.join(work_dir, f"segment{index}.mp4"), encoder_args,
+                    segment_progress(index)
+                )
+                for index, (first, last) in enumerate(ranges)
+            ]
+            segment_paths = [future.result() for future in futures]
+
+        list_path = os.path.join(work_dir, "segments.txt")
+        with open(list_path, "w", encoding="utf-8") as f:
+            for path, (first, last) in zip(segment_paths, ranges):
+                escaped = path.replace("'", "'\\''")
+                f.write(f"file '{escaped}'\n")
+                if last < len(times):
+                    # The encoded segment doesn't record how long its last
+                    # frame lasts; take the exact span from the source so the
+                    # next segment starts where it did in the original
+                    f.write(f"duration {times[last] - times[first]:.6f}\n")
+
+        joined = ffmpeg.input(list_path, format='concat', safe=0)
+        source = ffmpeg.input(video_path)
+        streams, audio_args = _output_streams(joined['v'], source, audio_codec(video_path, probe))
+        run_ffmpeg(
+            ffmpeg
+            .output(*streams, out_path, vcodec='copy', **audio_args)
+            .overwrite_output(),
+            "burn_join"
+        )
+
+    out_times, _ = video_frames(out_path)
+    if not _frames_match(times, out_times):
+        logger.warning(
+            "Frames of the segmented burn of %s don't line up with the source, re-encoding in one pass",
+            video_path
+        )
+        return create_subtitled_video(video_path, sub_path, output_dir, subtitle_format, profile, on_progress, probe)
+
+    return out_path
@@ -0,0 +1,164 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from .audio import audio_digest
+
+DEFAULT_CACHE_DIR = os.getenv(
+    "AUTO_SUBTITLE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "auto_subtitle_cache")
+)
+DEFAULT_CACHE_MAX_BYTES = int(os.getenv("AUTO_SUBTITLE_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+DEFAULT_CACHE_MEMORY_ITEMS = int(os.getenv("AUTO_SUBTITLE_CACHE_MEMORY_ITEMS", 64))
+
+
+def cache_key(audio_digest: str, model_name: str, task: str, language: str) -> str:
+    """Key of a transcript: the audio content plus everything that changes the result"""
+    params = json.dumps([audio_digest, model_name, task, language])
+    return hashlib.sha256(params.encode("utf-8")).hexdigest()
+
+
+class TranscriptCache:
+    """Content-addressed transcript cache.
+
+    Transcripts are stored as JSON files under ``cache_dir`` and evicted in
+    least-recently-used order (by file mtime) once they take up more than
+    ``max_bytes``. An optional in-memory tier keeps the ``memory_items`` most
+    recent transcripts. Concurrent lookups of the same key in one process
+    share a single in-flight transcription.
+    """
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_CACHE_MAX_BYTES,
+                 memory_items: int = DEFAULT_CACHE_MEMORY_ITEMS):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.memory_items = memory_items
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+        self._lock = threading.Lock()
+        # Serialized transcripts, so callers can't mutate the cached copy
+        self._memory = OrderedDict()
+        self._inflight = {}
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _remember(self, key: str, data: bytes):
+        if self.memory_items <= 0:
+            return
+        self._memory[key] = data
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def _load(self, key: str):
+        """Look a key up in memory, then on disk. Must be called with the lock held."""
+        data = self._memory.get(key)
+        if data is not None:
+            self._memory.move_to_end(key)
+            return data
+
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # Refresh the mtime so eviction treats this entry as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+
+        self._remember(key, data)
+        return data
+
+    def get(self, key: str):
+        with self._lock:
+            data = self._load(key)
+        return json.loads(data) if data is not None else None
+
+    def put(self, key: str, result: dict):
+        data = json.dumps(result, ensure_ascii=False).encode("utf-8")
+
+        # Write atomically so other processes never read a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self._path(key))
+
+        with self._lock:
+            self._remember(key, data)
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def get_or_transcribe(self, key: str, transcribe):
+        """Return the cached transcript for ``key``, calling ``transcribe()`` on a miss"""
+        with self._lock:
+            data = self._load(key)
+            if data is not None:
+                self.hits += 1
+                return json.loads(data)
+
+            future = self._inflight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                self.misses += 1
+                future = self._inflight[key] = Future()
+                leader = True
+
+        if not leader:
+            return json.loads(future.result())
+
+        try:
+            result = transcribe()
+            self.put(key, result)
+            future.set_result(json.dumps(result, ensure_ascii=False))
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    def transcribe(self, audio, model_name: str, task: str, language: str, transcribe):
+        """Cached ``transcribe(audio)`` keyed by the audio content and parameters"""
+        key = cache_key(audio_digest(audio), model_name, task, language)
+        return self.get_or_transcribe(key, lambda: transcribe(audio))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "memory_items": len(self._memory),
+            }
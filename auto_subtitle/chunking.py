@@ -0,0 +1,177 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from .audio import load_pcm, encode_audio, reencode_codec
+
+# The transcription API rejects uploads larger than 25 MB
+MAX_UPLOAD_BYTES = 25 * 1024 * 1024
+
+DEFAULT_CHUNK_SECONDS = float(os.getenv("AUTO_SUBTITLE_CHUNK_SECONDS", 600))
+DEFAULT_CHUNK_BYTES = int(os.getenv("AUTO_SUBTITLE_CHUNK_BYTES", 24 * 1024 * 1024))
+DEFAULT_CHUNK_WORKERS = int(os.getenv("AUTO_SUBTITLE_CHUNK_WORKERS", 8))
+
+# Length of the energy analysis frames, and how far back from the maximum
+# chunk length to look for a quiet frame to cut at
+FRAME_SECONDS = 0.03
+SEARCH_SECONDS = 30.0
+
+# Every chunk after the first starts this many seconds before its cut, so a
+# word that crosses the cut is heard whole by one of the two chunks
+OVERLAP_SECONDS = 2.0
+
+# Tolerance used when dropping repeated text at chunk boundaries
+BOUNDARY_TOLERANCE = 1.0
+
+WAV_HEADER_BYTES = 44
+
+
+def frame_energy(samples, frame_length: int):
+    """Mean power of consecutive frames, computed in one vectorized pass"""
+    n_frames = len(samples) // frame_length
+    frames = samples[:n_frames * frame_length].reshape(n_frames, frame_length).astype(np.float32)
+    return np.einsum("ij,ij->i", frames, frames) / frame_length
+
+
+def find_split_points(samples, sample_rate: int, max_chunk_seconds: float,
+                      search_seconds: float = SEARCH_SECONDS):
+    """Sample offsets at which to cut the audio into chunks of at most max_chunk_seconds.
+
+    Each cut is placed at the quietest frame within ``search_seconds`` before
+    the chunk would exceed its maximum length, so cuts land in pauses between
+    words rather than in the middle of speech.
+    """
+    frame_length = max(1, int(FRAME_SECONDS * sample_rate))
+    energy = frame_energy(samples, frame_length)
+
+    max_frames = max(1, int(max_chunk_seconds * sample_rate) // frame_length)
+    # Look in the second half of the chunk at most, so chunks stay much longer than their overlap
+    search_frames = max(1, min(max_frames // 2, int(search_seconds * sample_rate) // frame_length))
+
+    splits = [0]
+    position = 0
+    while len(samples) - position * frame_length > max_frames * frame_length:
+        window_end = position + max_frames
+        window_start = window_end - search_frames
+        quietest = window_start + int(np.argmin(energy[window_start:window_end]))
+        # Always make progress, even if the quietest frame is the first one
+        position = max(quietest, position + 1)
+        splits.append(position * frame_length)
+
+    splits.append(len(samples))
+    return splits
+
+
+def _shift(item: dict, offset: float) -> dict:
+    item = dict(item)
+    for key in ("start", "end"):
+        if key in item:
+            item[key] = item[key] + offset
+    return item
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def _keep_between(segment: dict, start: float, end: float):
+    """The part of a segment that starts in ``[start, end)``, or None.
+
+    Words are kept by their start; a segment without words by its midpoint,
+    so that of two copies cut at different places the more complete one wins.
+    """
+    words = segment.get("words")
+    if not words:
+        return segment if start <= (segment["start"] + segment["end"]) / 2 < end else None
+
+    kept = [word for word in words if start <= word["start"] < end]
+    if not kept:
+        return None
+    if len(kept) < len(words):
+        segment = dict(segment, words=kept, start=kept[0]["start"], end=kept[-1]["end"],
+                       text=" ".join(w.get("word", "").strip() for w in kept))
+    return segment
+
+
+def stitch_results(results, offsets, overlap: float = 0.0):
+    """Combine per-chunk transcripts into one, shifting timestamps by each chunk's offset.
+
+    Consecutive chunks overlap by ``overlap`` seconds: each chunk keeps what
+    starts before the middle of its overlap with the next one, and the next
+    chunk keeps the rest. Near a chunk boundary, segments that repeat the
+    previous segment and words that start before the previous segment ended
+    are dropped.
+    """
+    # Where the text of each chunk ends and that of the next begins
+    boundaries = [float("-inf")] + [offset + overlap / 2 for offset in offsets[1:]] + [float("inf")]
+
+    segments = []
+    for index, (result, offset) in enumerate(zip(results, offsets)):
+        for segment in result["segments"]:
+            segment = _shift(segment, offset)
+            if segment.get("words"):
+                segment["words"] = [_shift(word, offset) for word in segment["words"]]
+
+            segment = _keep_between(segment, boundaries[index], boundaries[index + 1])
+            if segment is None:
+                continue
+
+            at_boundary = segments and segment["start"] < offset + BOUNDARY_TOLERANCE
+            if at_boundary:
+                previous = segments[-1]
+                if _normalize(segment.get("text", "")) == _normalize(previous.get("text", "")):
+                    continue
+
+                if segment.get("words") and segment["start"] < previous["end"]:
+                    words = [w for w in segment["words"] if w["start"] >= previous["end"]]
+                    if not words:
+                        continue
+                    segment["words"] = words
+                    segment["start"] = words[0]["start"]
+                    segment["text"] = " ".join(w.get("word", "").strip() for w in words)
+
+                segment["start"] = max(segment["start"], previous["end"])
+                segment["end"] = max(segment["end"], segment["start"])
+
+            segment["id"] = len(segments)
+            segments.append(segment)
+
+    return {
+        "segments": segments,
+        "text": " ".join(text for text in (s.get("text", "").strip() for s in segments) if text)
+    }
+
+
+def transcribe_chunked(audio, transcribe,
+                       max_chunk_seconds: float = DEFAULT_CHUNK_SECONDS,
+                       max_chunk_bytes: int = DEFAULT_CHUNK_BYTES,
+                       max_workers: int = DEFAULT_CHUNK_WORKERS):
+    """Transcribe audio in silence-aligned, slightly overlapping chunks, in parallel.
+
+    ``transcribe`` is called with an in-memory ``(filename, bytes)`` tuple per
+    chunk, in the format of ``audio`` (compressed audio stays compressed), and
+    must return a result dict with ``segments`` and ``text``.
+    """
+    samples, sample_rate = load_pcm(audio)
+    name = audio if isinstance(audio, str) else audio[0]
+
+    # Respect both the duration and the upload size limit, overlap included
+    codec = reencode_codec(name)
+    if codec is None:
+        max_bytes_seconds = (max_chunk_bytes - WAV_HEADER_BYTES) / (2 * sample_rate)
+    else:
+        max_bytes_seconds = max_chunk_bytes * 8 / (int(codec["audio_bitrate"].rstrip("k")) * 1000)
+    max_chunk_seconds = min(max_chunk_seconds, max_bytes_seconds - OVERLAP_SECONDS)
+    splits = find_split_points(samples, sample_rate, max_chunk_seconds)
+    overlap = int(OVERLAP_SECONDS * sample_rate)
+    chunks = [(max(0, start - overlap) if index else start, end)
+              for index, (start, end) in enumerate(zip(splits[:-1], splits[1:]))]
+
+    def transcribe_chunk(index):
+        start, end = chunks[index]
+        return transcribe(encode_audio(samples[start:end], sample_rate, f"chunk{index}{os.path.splitext(name)[1]}"))
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(chunks)))) as executor:
+        results = list(executor.map(transcribe_chunk, range(len(chunks))))
+
+    offsets = [start / sample_rate for start, _ in chunks]
+    return stitch_results(results, offsets, OVERLAP_SECONDS)
@@ -1,12 +1,24 @@
 import os
+import sys
 import ffmpeg
 import argparse
+import logging
 import warnings
-import tempfile
 import openai
 from dotenv import load_dotenv
-from .utils import filename, str2bool, write_srt
-from .ass_generator import AssGenerator
+from .utils import filename, str2bool
+from .jobs import DEFAULT_JOBS_DIR, run_worker
+from .pipeline import run_pipeline, rerender, get_transcript_cache, OUTPUT_MODES
+from .transcript import load_transcript, RENDER_FORMATS
+from .backends import BACKENDS, DEFAULT_BACKEND
+from .burn import DEFAULT_BURN_SEGMENTS, ENCODER_PROFILES, DEFAULT_ENCODER_PROFILE, PREVIEW_SECONDS
+from .chunking import DEFAULT_CHUNK_SECONDS, DEFAULT_CHUNK_WORKERS
+from .audio import AUDIO_FORMATS, DEFAULT_AUDIO_FORMAT
+from .probe import MediaError
+from .progress import ProgressBar
+from .live import (
+    LiveTranscriber, CueWriter, DEFAULT_STEP, DEFAULT_HOLDBACK, DEFAULT_MAX_DELAY, DEFAULT_IDLE_TIMEOUT
+)
 
 # Load environment variables
 load_dotenv()
@@ -14,90 +26,204 @@ load_dotenv()
 # Set OpenAI API key
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
-def transcribe_with_openai_api(audio_path, model_name="whisper-1", task="transcribe", language="auto"):
-    """Transcribe audio using OpenAI's Whisper API"""
+def worker_main(argv):
+    parser = argparse.ArgumentParser(
+        prog="auto_subtitle worker",
+        description="Process jobs submitted through the API's /jobs endpoint",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--concurrency", "-c", type=int, default=1,
+                        help="number of worker processes to run on this node")
+    parser.add_argument("--jobs_dir", type=str, default=DEFAULT_JOBS_DIR,
+                        help="job store directory shared with the web service (AUTO_SUBTITLE_JOBS_DIR)")
+    parser.add_argument("--poll_interval", type=float, default=1.0,
+                        help="seconds to wait before polling an empty queue again")
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(format="%(message)s")
+    logging.getLogger("auto_subtitle").setLevel(logging.INFO)
+    run_worker(args.jobs_dir, args.concurrency, args.poll_interval)
+
+
+def live_main(argv):
+    parser = argparse.ArgumentParser(
+        prog="auto_subtitle live",
+        description="Subtitle a growing file, a pipe (-) or a stream URL while it is being recorded",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("input", type=str, help="file that is being written, - for stdin, or a stream URL")
+    parser.add_argument("--output", "-o", type=str, default=None,
+                        help="subtitle file to write cues to as they are finalized (default: stdout)")
+    parser.add_argument("--subtitle_format", type=str, default=None, choices=["srt", "vtt"],
+                        help="cue format (default: from the output file extension, else srt)")
+    parser.add_argument("--backend", type=str, default=DEFAULT_BACKEND, choices=list(BACKENDS),
+                        help="transcription backend")
+    parser.add_argument("--model", default="whisper-1", help="name of the Whisper model to use")
+    parser.add_argument("--task", type=str, default="transcribe", choices=["transcribe", "translate"])
+    parser.add_argument("--language", type=str, default="auto", help="language code, or auto")
+    parser.add_argument("--step", type=float, default=DEFAULT_STEP,
+                        help="seconds of new audio between transcriptions")
+    parser.add_argument("--holdback", type=float, default=DEFAULT_HOLDBACK,
+                        help="seconds at the live edge that are only finalized by a later window")
+    parser.add_argument("--max_delay", type=float, default=DEFAULT_MAX_DELAY,
+                        help="seconds after which audio is finalized regardless")
+    parser.add_argument("--keep_up", type=str2bool, default=True,
+                        help="skip audio when transcription can't keep up, instead of falling further behind")
+    parser.add_argument("--idle_timeout", type=float, default=DEFAULT_IDLE_TIMEOUT,
+                        help="seconds without growth after which an input file is considered finished")
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(format="%(message)s")
+    logging.getLogger("auto_subtitle").setLevel(logging.INFO)
+
+    subtitle_format = args.subtitle_format
+    if subtitle_format is None:
+        subtitle_format = "vtt" if args.output and args.output.endswith(".vtt") else "srt"
+
+    options = {"backend": args.backend, "model": args.model, "task": args.task, "language": args.language}
+    output = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    try:
+        writer = CueWriter(output, subtitle_format)
+        transcriber = LiveTranscriber(
+            args.input, options, writer.write,
+            step=args.step, holdback=args.holdback, max_delay=args.max_delay,
+            keep_up=args.keep_up, idle_timeout=args.idle_timeout
+        )
+        try:
+            transcriber.run()
+        except KeyboardInterrupt:
+            pass
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+def render_main(argv):
+    parser = argparse.ArgumentParser(
+        prog="auto_subtitle render",
+        description="Render a transcript saved with --output_transcript (or rendered as JSON) again, "
+                    "in another format or style, and optionally add it to a video, without transcribing",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("transcript", type=str, help="path to a .transcript or .json transcript")
+    parser.add_argument("--video", type=str, default=None,
+                        help="video to burn (or mux) the subtitles into; only the subtitle file is written without one")
+    parser.add_argument("--output_dir", "-o", type=str, default=".", help="directory to save the outputs")
+    parser.add_argument("--subtitle_format", type=str, default="ass", choices=RENDER_FORMATS,
+                        help="subtitle format to render; only srt and ass can be added to a video")
+    parser.add_argument("--ass_style", type=str, default="default", choices=["default", "highlight", "karaoke"],
+                        help="ASS subtitle style template")
+    parser.add_argument("--output_mode", type=str, default="burn", choices=OUTPUT_MODES,
+                        help="burn the subtitles into the picture, or mux them as a track")
+    parser.add_argument("--encoder_profile", type=str, default=DEFAULT_ENCODER_PROFILE, choices=list(ENCODER_PROFILES),
+                        help="x264 settings for burning")
+    parser.add_argument("--segmented_burn", type=str2bool, default=False,
+                        help="split the video at keyframes and burn the segments in parallel processes")
+    parser.add_argument("--burn_segments", type=int, default=DEFAULT_BURN_SEGMENTS,
+                        help="number of segments to burn in parallel in segmented mode")
+    parser.add_argument("--preview", type=str2bool, default=False,
+                        help="only burn a short low-resolution excerpt of the video")
+    parser.add_argument("--preview_start", type=float, default=0.0,
+                        help="second of the video the preview starts at")
+    parser.add_argument("--preview_seconds", type=float, default=PREVIEW_SECONDS,
+                        help="length of the preview")
+
+    args = parser.parse_args(argv)
+    if args.video and args.subtitle_format not in ("srt", "ass"):
+        parser.error("only srt and ass subtitles can be added to a video")
+
     try:
-        # Prepare parameters for API call
-        params = {
-            "model": model_name,
-            "response_format": "verbose_json"
-        }
-        
-        # Add language if specified and not auto
-        if language != "auto":
-            params["language"] = language
-        
-        # Set task (translate or transcribe)
-        if task == "translate":
-            # For translation, we always translate to English
-            params["response_format"] = "verbose_json"
-        
-        # Open the audio file
-        with open(audio_path, "rb") as audio_file:
-            # Call the OpenAI API
-            if task == "transcribe":
-                response = openai.audio.transcriptions.create(
-                    file=audio_file,
-                    **params
-                )
-            else:  # translate
-                response = openai.audio.translations.create(
-                    file=audio_file,
-                    **params
-                )
-        
-        # Convert response to dictionary if it's not already
-        if not isinstance(response, dict):
-            response = response.model_dump()
-        
-        # Process the response to match the format expected by our subtitle generator
-        # OpenAI API returns segments with start and end times
-        segments = []
-        
-        if "segments" in response:
-            # If the API already returns segments in the format we need
-            segments = response["segments"]
-        else:
-            # If we need to create segments from the response
-            # This is a simplified version - in a real implementation, 
-            # you might want to split the text into sentences or use other logic
-            segments = [
-                {
-                    "start": 0,
-                    "end": 10,  # Default duration if not provided
-                    "text": response.get("text", "")
-                }
-            ]
-        
-        # Return in the format expected by get_subtitles
-        return {
-            "segments": segments,
-            "text": response.get("text", "")
-        }
-    
-    except Exception as e:
-        print(f"Error in OpenAI API transcription: {str(e)}")
-        raise
+        transcript = load_transcript(args.transcript)
+    except (OSError, ValueError) as e:
+        print(f"Failed to read {args.transcript}: {e}")
+        sys.exit(1)
+
+    target = os.path.join(args.output_dir, f"{filename(args.transcript)}.{args.subtitle_format}")
+    if args.video is None and os.path.abspath(target) == os.path.abspath(args.transcript):
+        parser.error(f"rendering would overwrite {args.transcript}; choose another --output_dir")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    options = {
+        "subtitle_format": args.subtitle_format,
+        "ass_style": args.ass_style,
+        "output_mode": args.output_mode,
+        "encoder_profile": args.encoder_profile,
+        "segmented_burn": args.segmented_burn,
+        "burn_segments": args.burn_segments,
+        "preview": args.preview,
+        "preview_start": args.preview_start,
+        "preview_seconds": args.preview_seconds,
+    }
+    try:
+        path, _ = rerender(transcript, args.output_dir, options, args.video, name=args.transcript)
+    except ffmpeg.Error as e:
+        print(f"Failed to add subtitles to {args.video}: {e}")
+        print("stderr:", (e.stderr or b"").decode('utf8'))
+        sys.exit(1)
+    except MediaError as e:
+        print(f"Failed to add subtitles to {args.video}: {e}")
+        sys.exit(1)
+    print(f"Saved to {os.path.abspath(path)}")
+
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "worker":
+        return worker_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == "live":
+        return live_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == "render":
+        return render_main(sys.argv[2:])
+
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument("video", nargs="+", type=str,
-                        help="paths to video files to transcribe")
+                        help="paths to video (or audio) files to transcribe")
+    parser.add_argument("--backend", type=str, default=DEFAULT_BACKEND, choices=list(BACKENDS),
+                        help="transcription backend: the OpenAI API, Whisper on the local CPU, or a deterministic fake for testing (AUTO_SUBTITLE_BACKEND)")
     parser.add_argument("--model", default="whisper-1",
-                        help="name of the OpenAI Whisper model to use (default: whisper-1)")
+                        help="name of the Whisper model to use; with the local backend, a model size such as 'base' or 'small' (default: whisper-1)")
     parser.add_argument("--output_dir", "-o", type=str,
                         default=".", help="directory to save the outputs")
     parser.add_argument("--subtitle_format", type=str, default="ass",
                         choices=["srt", "ass"], help="subtitle format to generate")
     parser.add_argument("--ass_style", type=str, default="default",
-                        choices=["default", "highlight"], help="ASS subtitle style template")
+                        choices=["default", "highlight", "karaoke"],
+                        help="ASS subtitle style template; 'karaoke' highlights words with one event per line, which renders much faster than 'highlight'")
     parser.add_argument("--output_srt", type=str2bool, default=False,
                         help="whether to output the .srt file along with the video files")
+    parser.add_argument("--output_transcript", type=str2bool, default=False,
+                        help="also save the transcript as a .transcript file, for `auto_subtitle render`")
     parser.add_argument("--srt_only", type=str2bool, default=False,
                         help="only generate the .srt file and not create overlayed video")
+    parser.add_argument("--output_mode", type=str, default="burn", choices=OUTPUT_MODES,
+                        help="'burn' renders the subtitles into the picture (re-encodes the video); 'mux' copies video and audio and adds the subtitles as a track (ASS -> .mkv, SRT -> .mp4)")
+    parser.add_argument("--encoder_profile", type=str, default=DEFAULT_ENCODER_PROFILE, choices=list(ENCODER_PROFILES),
+                        help="x264 settings for burning: 'fast' (veryfast), 'balanced' (medium) or 'archive' (slow, higher quality)")
+    parser.add_argument("--segmented_burn", type=str2bool, default=False,
+                        help="split the video at keyframes and burn the segments in parallel processes")
+    parser.add_argument("--burn_segments", type=int, default=DEFAULT_BURN_SEGMENTS,
+                        help="number of segments to burn in parallel in segmented mode (AUTO_SUBTITLE_BURN_SEGMENTS, default: number of cores)")
+    parser.add_argument("--preview", type=str2bool, default=False,
+                        help="only burn a short low-resolution excerpt, and keep the transcript for the full encode with `auto_subtitle render`")
+    parser.add_argument("--preview_start", type=float, default=0.0,
+                        help="second of the video the preview starts at")
+    parser.add_argument("--preview_seconds", type=float, default=PREVIEW_SECONDS,
+                        help="length of the preview (AUTO_SUBTITLE_PREVIEW_SECONDS)")
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+                        help="number of videos each pipeline stage (extract, transcribe, burn) works on at once")
     parser.add_argument("--verbose", type=str2bool, default=False,
                         help="whether to print out the progress and debug messages")
+    parser.add_argument("--progress", type=str2bool, default=sys.stderr.isatty(),
+                        help="show percent complete, speed and ETA of the burn-in on stderr (default: on a terminal)")
+    parser.add_argument("--no-cache", "--no_cache", dest="no_cache", action="store_true",
+                        help="always call the transcription API instead of reusing cached transcripts")
+    parser.add_argument("--audio_format", type=str, default=DEFAULT_AUDIO_FORMAT, choices=list(AUDIO_FORMATS),
+                        help="format of the audio sent for transcription; compressed formats are kept in memory")
+    parser.add_argument("--chunked", type=str2bool, default=False,
+                        help="split the audio at pauses and transcribe the chunks in parallel (always on for audio over the API upload limit)")
+    parser.add_argument("--chunk_seconds", type=float, default=DEFAULT_CHUNK_SECONDS,
+                        help="maximum duration of a chunk in chunked mode")
+    parser.add_argument("--chunk_workers", type=int, default=DEFAULT_CHUNK_WORKERS,
+                        help="number of chunks to transcribe concurrently")
+    parser.add_argument("--vad", type=str2bool, default=False,
+                        help="cut silence and music out of the audio before transcription")
 
     parser.add_argument("--task", type=str, default="transcribe", choices=[
                         "transcribe", "translate"], help="whether to perform X->X speech recognition ('transcribe') or X->English translation ('translate')")
@@ -113,108 +239,66 @@ def main():
     srt_only: bool = args.pop("srt_only")
     language: str = args.pop("language")
     task: str = args.pop("task")
-    
+    verbose: bool = args.pop("verbose")
+    logging.basicConfig(format="%(message)s")
+    logging.getLogger("auto_subtitle").setLevel(logging.DEBUG if verbose else logging.INFO)
+    # Per-video timing records are only of interest when asked for
+    logging.getLogger("auto_subtitle.metrics").setLevel(logging.INFO if verbose else logging.WARNING)
+    options = {
+        "backend": args.pop("backend"),
+        "model": model_name,
+        "task": task,
+        "language": language,
+        "subtitle_format": subtitle_format,
+        "ass_style": ass_style,
+        "srt_only": srt_only,
+        "output_mode": args.pop("output_mode"),
+        "encoder_profile": args.pop("encoder_profile"),
+        "segmented_burn": args.pop("segmented_burn"),
+        "burn_segments": args.pop("burn_segments"),
+        "cache": not args.pop("no_cache"),
+        "chunked": args.pop("chunked"),
+        "chunk_seconds": args.pop("chunk_seconds"),
+        "chunk_workers": args.pop("chunk_workers"),
+        "vad": args.pop("vad"),
+        "audio_format": args.pop("audio_format"),
+        "preview": args.pop("preview"),
+        "preview_start": args.pop("preview_start"),
+        "preview_seconds": args.pop("preview_seconds"),
+    }
+    # The full encode after a preview reuses the transcript
+    options["save_transcript"] = args.pop("output_transcript") or options["preview"]
+
     os.makedirs(output_dir, exist_ok=True)
-    
-    audios = get_audio(args.pop("video"))
-    subtitles = get_subtitles(
-        audios, output_srt or srt_only, output_dir, subtitle_format, ass_style,
-        lambda audio_path: transcribe_with_openai_api(audio_path, model_name, task, language)
-    )
-
-    if srt_only:
-        return
-
-    for path, sub_path in subtitles.items():
-        out_path = os.path.join(output_dir, f"{filename(path)}_subtitled.mp4")
-
-        print(f"Burning subtitles into {filename(path)}...")
-
-        # Get video stream info
-        probe = ffmpeg.probe(path)
-        video_info = next(s for s in probe['streams'] if s['codec_type'] == 'video')
-        width = int(video_info['width'])
-        height = int(video_info['height'])
-
-        # Set up ffmpeg inputs
-        video = ffmpeg.input(path)
-        audio = video.audio
-
-        if subtitle_format == "srt":
-            # For SRT, use subtitles filter
-            video_with_subs = video.filter('subtitles', sub_path, force_style="OutlineColour=&H40000000,BorderStyle=3")
-        else:
-            # For ASS, use ass filter which properly handles all styling
-            video_with_subs = video.filter('ass', sub_path)
-
-        # Hard encode the subtitles
-        try:
-            (
-                ffmpeg
-                .concat(video_with_subs, audio, v=1, a=1)
-                .output(
-                    out_path,
-                    acodec='aac',
-                    vcodec='h264',
-                    crf=23,  # Adjust quality (18-28 is good range, lower is better)
-                    preset='medium'  # Adjust encoding speed/quality trade-off
-                )
-                .overwrite_output()
-                .run(capture_stdout=True, capture_stderr=True)
-            )
-            print(f"Successfully saved subtitled video to {os.path.abspath(out_path)}")
-        except ffmpeg.Error as e:
-            print("An error occurred while encoding the video:")
-            print("stdout:", e.stdout.decode('utf8'))
-            print("stderr:", e.stderr.decode('utf8'))
-            raise e
-
-
-def get_audio(paths):
-    temp_dir = tempfile.gettempdir()
-
-    audio_paths = {}
-
-    for path in paths:
-        print(f"Extracting audio from {filename(path)}...")
-        output_path = os.path.join(temp_dir, f"{filename(path)}.wav")
-
-        ffmpeg.input(path).output(
-            output_path,
-            acodec="pcm_s16le", ac=1, ar="16k"
-        ).run(quiet=True, overwrite_output=True)
-
-        audio_paths[path] = output_path
-
-    return audio_paths
-
-
-def get_subtitles(audio_paths: dict, output_srt: bool, output_dir: str, 
-                  subtitle_format: str, ass_style: str, transcribe: callable):
-    subtitles_path = {}
-    ass_generator = AssGenerator()
-
-    for path, audio_path in audio_paths.items():
-        # Always save subtitle files in the output directory
-        sub_path = os.path.join(output_dir, f"{filename(path)}.{subtitle_format}")
-        
-        print(
-            f"Generating subtitles for {filename(path)}... This might take a while."
-        )
 
-        result = transcribe(audio_path)
+    def report_failure(item):
+        if item["error"] is None:
+            return
+        print(f"Failed to {item['failed_stage']} {filename(item['video'])}: {item['error']}")
+        if isinstance(item["error"], ffmpeg.Error):
+            print("stdout:", (item["error"].stdout or b"").decode('utf8'))
+            print("stderr:", (item["error"].stderr or b"").decode('utf8'))
 
-        if subtitle_format == "srt":
-            write_srt(result["segments"], sub_path)
-        else:
-            with open(sub_path, "w", encoding="utf-8") as f:
-                f.write(ass_generator.generate_ass(result["segments"], ass_style))
+    progress_bar = ProgressBar() if args.pop("progress") else None
 
-        subtitles_path[path] = sub_path
+    def report_progress(video, snapshot):
+        progress_bar.update(filename(video), snapshot)
+
+    try:
+        results = run_pipeline(
+            args.pop("video"), output_dir, options, args.pop("jobs"), on_done=report_failure,
+            on_progress=report_progress if progress_bar else None
+        )
+    finally:
+        if progress_bar:
+            progress_bar.close()
 
-        print(f"Saved subtitles to {os.path.abspath(sub_path)}.")
+    if verbose and options["cache"]:
+        stats = get_transcript_cache().stats()
+        print(f"Transcript cache: {stats['hits']} hits, {stats['misses']} misses")
 
-    return subtitles_path
+    if any(item["error"] is not None for item in results):
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,214 @@
+import os
+import tempfile
+import threading
+import subprocess
+from werkzeug.sansio.multipart import MultipartDecoder, Field, File, Data, Epilogue, NeedData
+from .audio import AUDIO_FORMATS, DEFAULT_AUDIO_FORMAT, DEFAULT_SPOOL_BYTES, READ_BLOCK_SIZE
+
+# Form fields other than the uploaded file are small; cap what we keep in memory
+# (the decoder's buffer, and all the fields together)
+MAX_FORM_MEMORY_SIZE = 1024 * 1024
+
+
+def extractor_args(audio_format: str = DEFAULT_AUDIO_FORMAT):
+    """ffmpeg arguments extracting audio from a video fed to stdin.
+
+    Returns ``(args, output_path, name)``: the "wav" format is written to
+    ``output_path`` (``name`` is None), compressed formats go to stdout and
+    are named ``name`` (``output_path`` is None).
+    """
+    codec = AUDIO_FORMATS[audio_format]
+
+    # -xerror makes ffmpeg fail on demuxing errors instead of writing empty output
+    args = ["ffmpeg", "-xerror", "-loglevel", "error", "-i", "pipe:0", "-vn", "-ac", "1", "-ar", "16k"]
+    if codec is None:
+        # WAV needs a seekable output to get a valid header
+        fd, output_path = tempfile.mkstemp(prefix="stream-", suffix=".wav")
+        os.close(fd)
+        return args + ["-acodec", "pcm_s16le", "-y", output_path], output_path, None
+
+    args += ["-acodec", codec["acodec"], "-b:a", codec["audio_bitrate"], "-fflags", "+bitexact",
+             "-f", codec["format"], "pipe:1"]
+    return args, None, f"audio.{codec['extension']}"
+
+
+class StreamingAudioExtractor:
+    """ffmpeg process extracting audio from a video that is fed to its stdin.
+
+    Input that ffmpeg can't demux from a pipe (such as MP4 files with the moov
+    atom at the end) makes ffmpeg exit early; ``finish()`` then returns None
+    and the caller falls back to extracting from the saved file.
+    """
+
+    def __init__(self, audio_format: str = DEFAULT_AUDIO_FORMAT, spool_bytes: int = DEFAULT_SPOOL_BYTES):
+        self.audio_format = audio_format
+        self.failed = False
+
+        args, self.output_path, self.name = extractor_args(audio_format)
+        self.buffer = tempfile.SpooledTemporaryFile(max_size=spool_bytes) if self.output_path is None else None
+
+        self.process = subprocess.Popen(
+            args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE if self.buffer is not None else subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+
+        # Drain ffmpeg's output pipes so it never blocks on them
+        self.stderr = b""
+        self._threads = [threading.Thread(target=self._read_stderr, daemon=True)]
+        if self.buffer is not None:
+            self._threads.append(threading.Thread(target=self._read_stdout, daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def _read_stdout(self):
+        for block in iter(lambda: self.process.stdout.read(READ_BLOCK_SIZE), b""):
+            self.buffer.write(block)
+
+    def _read_stderr(self):
+        self.stderr = self.process.stderr.read()
+
+    def feed(self, data: bytes):
+        if self.failed:
+            return
+        try:
+            self.process.stdin.write(data)
+        except (BrokenPipeError, OSError):
+            # ffmpeg gave up on the input; keep saving the upload regardless
+            self.failed = True
+
+    def finish(self):
+        """Wait for ffmpeg and return the extracted audio, or None if extraction failed"""
+        try:
+            self.process.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+        returncode = self.process.wait()
+        for thread in self._threads:
+            thread.join()
+
+        if returncode != 0 or self.failed:
+            self.abort()
+            return None
+
+        if self.buffer is None:
+            return self.output_path
+
+        self.buffer.seek(0)
+        return (self.name, self.buffer)
+
+    def abort(self):
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        if self.buffer is not None:
+            self.buffer.close()
+        if self.output_path is not None and os.path.exists(self.output_path):
+            os.remove(self.output_path)
+
+
+class StreamingUpload:
+    """A multipart upload saved to disk while its audio is extracted.
+
+    Reads the request body incrementally instead of letting werkzeug spool it
+    first. The bytes of the ``file_field`` part are written to the path
+    returned by ``make_path(filename)`` and at the same time piped into a
+    ``StreamingAudioExtractor``, so the audio is ready as soon as the upload
+    ends. ``make_path`` may raise ValueError to reject a file name.
+    """
+
+    def __init__(self, stream, boundary: bytes, file_field: str, make_path,
+                 audio_format: str = DEFAULT_AUDIO_FORMAT):
+        self.stream = stream
+        self.boundary = boundary
+        self.file_field = file_field
+        self.make_path = make_path
+        self.audio_format = audio_format
+
+        self.form = {}
+        self.filename = None
+        self.video_path = None
+        self.audio = None
+
+        # Parser state shared by the sync and async ``receive``
+        self._field_name = None
+        self._field_data = None
+        self._form_bytes = 0
+        self._video_file = None
+
+    def _handle(self, event):
+        """Apply a multipart event (other than NeedData and Epilogue) to the upload.
+
+        Opens ``video_path`` when the file part starts, writes its bytes and
+        collects the other text fields into ``form``, up to MAX_FORM_MEMORY_SIZE
+        bytes in all (ValueError past that). Other files are dropped. Returns
+        the bytes of the file part the event carried, for the audio extractor,
+        or None.
+        """
+        if isinstance(event, (File, Field)):
+            self._field_name = event.name
+            # Only text fields are kept in memory
+            self._field_data = [] if isinstance(event, Field) and event.name != self.file_field else None
+            if isinstance(event, File) and event.name == self.file_field and self._video_file is None:
+                if not event.filename:
+                    raise ValueError("No file selected")
+                self.filename = event.filename
+                self.video_path = self.make_path(event.filename)
+                self._video_file = open(self.video_path, "wb")
+        elif isinstance(event, Data):
+            if self._field_data is not None:
+                self._form_bytes += len(event.data)
+                if self._form_bytes > MAX_FORM_MEMORY_SIZE:
+                    raise ValueError(f"Form fields can be up to {MAX_FORM_MEMORY_SIZE} bytes")
+                self._field_data.append(event.data)
+                if not event.more_data:
+                    self.form[self._field_name] = b"".join(self._field_data).decode("utf-8", "replace")
+            elif self._field_name == self.file_field and self._video_file is not None and not self._video_file.closed:
+                self._video_file.write(event.data)
+                if not event.more_data:
+                    self._video_file.close()
+                return event.data
+        return None
+
+    def _close_video(self):
+        """Close the saved video at the end of the body. Raises ValueError if there was none."""
+        if self._video_file is None:
+            raise ValueError("No video file provided")
+        self._video_file.close()
+
+    def _discard_video(self):
+        if self._video_file is not None:
+            self._video_file.close()
+        if self.video_path is not None and os.path.exists(self.video_path):
+            os.remove(self.video_path)
+
+    def receive(self):
+        """Consume the request body. Raises ValueError if the upload is unusable."""
+        decoder = MultipartDecoder(self.boundary, max_form_memory_size=MAX_FORM_MEMORY_SIZE)
+        extractor = None
+
+        try:
+            while True:
+                event = decoder.next_event()
+                if isinstance(event, NeedData):
+                    chunk = self.stream.read(READ_BLOCK_SIZE)
+                    decoder.receive_data(chunk or None)
+                    continue
+                if isinstance(event, Epilogue):
+                    break
+
+                data = self._handle(event)
+                if extractor is None and self._video_file is not None:
+                    extractor = StreamingAudioExtractor(self.audio_format)
+                if data:
+                    extractor.feed(data)
+            self._close_video()
+        except BaseException:
+            if extractor is not None:
+                extractor.abort()
+            self._discard_video()
+            raise
+
+        self.audio = extractor.finish()
+        return self
@@ -0,0 +1,362 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import signal
+import socket
+import sqlite3
+import tempfile
+import threading
+import traceback
+import multiprocessing
+from contextlib import contextmanager
+from .metrics import JobTiming
+
+# Default location of the job store. Keep it on a local disk shared by the web
+# and worker processes of one machine: SQLite's locking is unreliable on
+# network filesystems such as NFS.
+DEFAULT_JOBS_DIR = os.getenv(
+    "AUTO_SUBTITLE_JOBS_DIR", os.path.join(tempfile.gettempdir(), "auto_subtitle_jobs")
+)
+
+# Seconds between heartbeats of a running job, and how old a heartbeat may get
+# before the job is considered abandoned (e.g. the worker was killed).
+HEARTBEAT_INTERVAL = 15
+STALE_AFTER = 120
+MAX_ATTEMPTS = 3
+
+# Finished and failed jobs are deleted, with their directory, this many
+# seconds after they finished; workers check every EXPIRE_INTERVAL seconds
+JOB_TTL = float(os.getenv("AUTO_SUBTITLE_JOB_TTL", 24 * 3600))
+EXPIRE_INTERVAL = 300
+
+# Progress of a running job is written to the store at most this often
+PROGRESS_INTERVAL = 1.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    options TEXT NOT NULL,
+    input_path TEXT NOT NULL,
+    output_path TEXT,
+    download_name TEXT,
+    error TEXT,
+    worker TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    heartbeat_at REAL,
+    progress TEXT,
+    media TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at);
+"""
+
+
+class JobQueue:
+    """Durable job queue backed by a SQLite database on local disk.
+
+    Every job gets its own directory under ``jobs_dir`` holding the uploaded
+    input and the generated output, so jobs survive process restarts and can
+    be picked up by any worker that sees the same directory. Jobs are
+    deleted ``JOB_TTL`` seconds after they finish (see ``expire``).
+    """
+
+    def __init__(self, jobs_dir: str = DEFAULT_JOBS_DIR):
+        self.jobs_dir = jobs_dir
+        self.db_path = os.path.join(jobs_dir, "jobs.db")
+        os.makedirs(jobs_dir, exist_ok=True)
+
+        with self._connection() as conn:
+            conn.executescript(SCHEMA)
+            # Stores created before jobs reported their progress or kept their probe
+            columns = [row["name"] for row in conn.execute("PRAGMA table_info(jobs)")]
+            for column in ("progress", "media"):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} TEXT")
+
+    def _connect(self) -> sqlite3.Connection:
+        # Autocommit mode; write transactions are opened explicitly with
+        # BEGIN IMMEDIATE so that claiming a job is atomic across processes.
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @contextmanager
+    def _connection(self):
+        conn = self._connect()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def new_job(self) -> str:
+        """Allocate a job id and create its working directory"""
+        job_id = uuid.uuid4().hex
+        os.makedirs(self.job_dir(job_id), exist_ok=True)
+        return job_id
+
+    def job_dir(self, job_id: str) -> str:
+        return os.path.join(self.jobs_dir, job_id)
+
+    def submit(self, job_id: str, input_path: str, options: dict, media=None):
+        """Queue a job whose input has already been written to its directory.
+
+        ``media`` is the ``MediaInfo`` of the input, if it was probed on
+        submission; the worker then doesn't probe it again.
+        """
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, status, options, input_path, created_at, media) "
+                "VALUES (?, 'queued', ?, ?, ?, ?)",
+                (job_id, json.dumps(options), input_path, time.time(),
+                 json.dumps(media.probe) if media is not None else None),
+            )
+
+    def get(self, job_id: str):
+        with self._connection() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return _row_to_job(row) if row else None
+
+    def claim(self, worker: str):
+        """Atomically move the oldest queued job to running and return it"""
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+
+            now = time.time()
+            conn.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, attempts = attempts + 1, "
+                "started_at = ?, heartbeat_at = ?, progress = NULL WHERE id = ?",
+                (worker, now, now, row["id"]),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+        job = _row_to_job(row)
+        job["status"] = "running"
+        job["attempts"] += 1
+        return job
+
+    def heartbeat(self, job_id: str):
+        with self._connection() as conn:
+            conn.execute(
+                "UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND status = 'running'",
+                (time.time(), job_id),
+            )
+
+    def set_progress(self, job_id: str, progress: dict):
+        with self._connection() as conn:
+            conn.execute(
+                "UPDATE jobs SET progress = ? WHERE id = ? AND status = 'running'",
+                (json.dumps(progress), job_id),
+            )
+
+    def complete(self, job_id: str, output_path: str, download_name: str):
+        with self._connection() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'done', output_path = ?, download_name = ?, "
+                "error = NULL, finished_at = ? WHERE id = ?",
+                (output_path, download_name, time.time(), job_id),
+            )
+
+    def fail(self, job_id: str, error: str):
+        with self._connection() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, finished_at = ? WHERE id = ?",
+                (error, time.time(), job_id),
+            )
+
+    def retry(self, job_id: str, error: str):
+        """Return a failed job to the queue for another attempt"""
+        with self._connection() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', worker = NULL, error = ?, progress = NULL "
+                "WHERE id = ? AND status = 'running'",
+                (error, job_id),
+            )
+
+    def requeue_stale(self, stale_after: float = STALE_AFTER) -> int:
+        """Return abandoned running jobs to the queue, or fail them after MAX_ATTEMPTS"""
+        cutoff = time.time() - stale_after
+        with self._connection() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', error = 'worker lost too many times', finished_at = ? "
+                "WHERE status = 'running' AND heartbeat_at < ? AND attempts >= ?",
+                (time.time(), cutoff, MAX_ATTEMPTS),
+            )
+            cursor = conn.execute(
+                "UPDATE jobs SET status = 'queued', worker = NULL "
+                "WHERE status = 'running' AND heartbeat_at < ?",
+                (cutoff,),
+            )
+        return cursor.rowcount
+
+    def expire(self, ttl: float = JOB_TTL) -> int:
+        """Delete jobs that finished more than ``ttl`` seconds ago, and job
+        directories left without a job (e.g. by an upload that failed before
+        it was queued). Returns the number of jobs deleted."""
+        cutoff = time.time() - ttl
+        with self._connection() as conn:
+            expired = [row["id"] for row in conn.execute(
+                "SELECT id FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?", (cutoff,)
+            )]
+            for job_id in expired:
+                shutil.rmtree(self.job_dir(job_id), ignore_errors=True)
+                conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+            for entry in os.scandir(self.jobs_dir):
+                try:
+                    if not entry.is_dir() or entry.stat().st_mtime >= cutoff:
+                        continue
+                except FileNotFoundError:
+                    continue
+                if conn.execute("SELECT 1 FROM jobs WHERE id = ?", (entry.name,)).fetchone() is None:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+        return len(expired)
+
+
+def _row_to_job(row) -> dict:
+    job = dict(row)
+    job["options"] = json.loads(job["options"])
+    job["progress"] = json.loads(job["progress"]) if job.get("progress") else None
+    job["media"] = json.loads(job["media"]) if job.get("media") else None
+    return job
+
+
+def process_job(queue: JobQueue, job: dict):
+    """Run the subtitle pipeline for a claimed job and record the outcome"""
+    from .pipeline import process_video, rerender, transcript_path
+    from .transcript import load_transcript
+    from .probe import MediaInfo
+
+    job_id = job["id"]
+    timing = JobTiming(job["input_path"], job_id)
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(HEARTBEAT_INTERVAL):
+            queue.heartbeat(job_id)
+
+    heartbeat_thread = threading.Thread(target=beat, daemon=True)
+    heartbeat_thread.start()
+
+    last_report = {"stage": None, "at": 0.0}
+
+    def report_progress(snapshot):
+        # Every new stage is written, progress within a stage at most every PROGRESS_INTERVAL
+        now = time.monotonic()
+        if snapshot["stage"] == last_report["stage"] and now - last_report["at"] < PROGRESS_INTERVAL:
+            return
+        last_report.update(stage=snapshot["stage"], at=now)
+        try:
+            queue.set_progress(job_id, snapshot)
+        except sqlite3.OperationalError:
+            # Progress is only informative; a busy database shouldn't fail the encode
+            pass
+
+    # The input stays until the job is done or has failed for good, so a
+    # retry (or another worker, if this one dies) can start over
+    finished = False
+    try:
+        media = MediaInfo(job["input_path"], job["media"]) if job["media"] else None
+        stored_transcript = transcript_path(queue.job_dir(job_id), job["input_path"])
+        if os.path.exists(stored_transcript):
+            # Queued from a preview, or transcribed by an earlier attempt
+            output_path, download_name = rerender(
+                load_transcript(stored_transcript), queue.job_dir(job_id), job["options"], job["input_path"],
+                timing=timing, on_progress=report_progress, media=media
+            )
+        else:
+            # The transcript is kept so the job can be rendered again without transcribing
+            output_path, download_name = process_video(
+                job["input_path"], queue.job_dir(job_id), dict(job["options"], save_transcript=True),
+                timing=timing, on_progress=report_progress, media=media
+            )
+        queue.complete(job_id, output_path, download_name)
+        finished = True
+        print(f"Job {job_id} finished: {output_path}")
+    except Exception as e:
+        traceback.print_exc()
+        # Invalid input or options fail the same way every time
+        if isinstance(e, ValueError) or job["attempts"] >= MAX_ATTEMPTS:
+            queue.fail(job_id, str(e))
+            finished = True
+        else:
+            queue.retry(job_id, str(e))
+    finally:
+        timing.log()
+        stop.set()
+        heartbeat_thread.join()
+        if finished and os.path.exists(job["input_path"]):
+            os.remove(job["input_path"])
+
+
+def worker_loop(jobs_dir: str = DEFAULT_JOBS_DIR, poll_interval: float = 1.0, stop_event=None):
+    """Claim and process jobs until ``stop_event`` is set"""
+    if stop_event is not None:
+        # Child of run_worker: shutdown is coordinated by the parent through
+        # stop_event, so a terminal Ctrl-C must not abort the job in progress.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    queue = JobQueue(jobs_dir)
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    print(f"Worker {worker} polling {queue.db_path}")
+    last_expired = 0.0
+
+    while stop_event is None or not stop_event.is_set():
+        if time.monotonic() - last_expired >= EXPIRE_INTERVAL:
+            expired = queue.expire()
+            if expired:
+                print(f"Worker {worker} deleted {expired} expired jobs")
+            last_expired = time.monotonic()
+        queue.requeue_stale()
+        job = queue.claim(worker)
+        if job is None:
+            time.sleep(poll_interval)
+            continue
+
+        print(f"Worker {worker} processing job {job['id']} (attempt {job['attempts']})")
+        process_job(queue, job)
+
+
+def run_worker(jobs_dir: str = DEFAULT_JOBS_DIR, concurrency: int = 1, poll_interval: float = 1.0):
+    """Run ``concurrency`` worker processes against the job store"""
+    if concurrency <= 1:
+        try:
+            worker_loop(jobs_dir, poll_interval)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    stop_event = multiprocessing.Event()
+    processes = [
+        multiprocessing.Process(target=worker_loop, args=(jobs_dir, poll_interval, stop_event))
+        for _ in range(concurrency)
+    ]
+    for process in processes:
+        process.start()
+
+    # Stop claiming new jobs on SIGTERM/SIGINT and let running jobs finish
+    def shutdown(signum, frame):
+        print("Shutting down workers after their current job...")
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    for process in processes:
+        process.join()
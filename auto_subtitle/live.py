@@ -0,0 +1,385 @@
+import os
+import json
+import queue
+import logging
+import threading
+import subprocess
+from collections import deque
+import numpy as np
+from .audio import SAMPLE_RATE, encode_wav
+from .backends import get_backend, DEFAULT_BACKEND
+from .utils import format_timestamp
+
+logger = logging.getLogger(__name__)
+
+# Seconds of new audio between transcriptions
+DEFAULT_STEP = float(os.getenv("AUTO_SUBTITLE_LIVE_STEP", 2.0))
+# Text in the last seconds of a window may still change when more audio
+# arrives, so it is only finalized once a later window confirms it
+DEFAULT_HOLDBACK = float(os.getenv("AUTO_SUBTITLE_LIVE_HOLDBACK", 2.0))
+# Audio further behind the live edge than this is finalized regardless
+DEFAULT_MAX_DELAY = float(os.getenv("AUTO_SUBTITLE_LIVE_MAX_DELAY", 8.0))
+# A growing file that stops growing for this long has ended
+DEFAULT_IDLE_TIMEOUT = float(os.getenv("AUTO_SUBTITLE_LIVE_IDLE_TIMEOUT", 10.0))
+
+# Named sources the web service may open, as "name=url,name=path"
+LIVE_SOURCES = dict(
+    item.split("=", 1) for item in os.getenv("AUTO_SUBTITLE_LIVE_SOURCES", "").split(",") if "=" in item
+)
+
+CUE_HISTORY = 1000
+KEEPALIVE_SECONDS = 15
+# A broadcast keeps transcribing this long after its last subscriber left, so
+# clients that reconnect (e.g. when their event stream reaches its maximum
+# length) find it running and resume with Last-Event-ID
+LINGER_SECONDS = float(os.getenv("AUTO_SUBTITLE_LIVE_LINGER", 30))
+
+BYTES_PER_SECOND = SAMPLE_RATE * 2
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def source_args(source: str, idle_timeout: float = DEFAULT_IDLE_TIMEOUT):
+    """ffmpeg input arguments for a pipe ("-"), a stream URL or a file that may still be growing"""
+    if source == "-":
+        return ["-i", "pipe:0"]
+    if "://" in source:
+        return ["-i", source]
+    # Keep reading at the end of the file until it stops growing
+    return ["-follow", "1", "-rw_timeout", str(int(idle_timeout * 1e6)), "-i", f"file:{os.path.abspath(source)}"]
+
+
+class LiveTranscriber:
+    """Subtitles for audio that is still arriving.
+
+    ffmpeg decodes the source to 16 kHz PCM as it is read. Every ``step``
+    seconds of new audio, everything after the last finalized cue is
+    transcribed again. Segments that end at least ``holdback`` seconds before
+    the live edge are final and passed to ``on_cue``; the rest is passed to
+    ``on_partial`` and revised by the next window. Audio more than
+    ``max_delay`` seconds behind the live edge is finalized regardless, so a
+    cue appears at most ``max_delay + step`` seconds plus one transcription
+    after its speech. With ``keep_up``, audio is skipped when transcription
+    falls behind the source instead of letting the delay grow.
+    """
+
+    def __init__(self, source: str, options: dict, on_cue, on_partial=None,
+                 step: float = DEFAULT_STEP, holdback: float = DEFAULT_HOLDBACK,
+                 max_delay: float = DEFAULT_MAX_DELAY, keep_up: bool = True,
+                 idle_timeout: float = DEFAULT_IDLE_TIMEOUT):
+        self.source = source
+        self.options = options
+        self.on_cue = on_cue
+        self.on_partial = on_partial
+        self.step = step
+        self.holdback = min(holdback, max_delay)
+        self.max_delay = max_delay
+        self.keep_up = keep_up
+        self.idle_timeout = idle_timeout
+        self.backend = get_backend(options.get("backend") or DEFAULT_BACKEND)
+
+        self.cue_count = 0
+        self.last_cue = None
+        self.process = None
+        self._stopped = False
+
+        # PCM from ``self._base`` seconds onwards; older audio is dropped once finalized
+        self._pcm = bytearray()
+        self._base = 0.0
+        self._ended = False
+        self._changed = threading.Condition()
+
+    def _available(self) -> float:
+        return self._base + len(self._pcm) / BYTES_PER_SECOND
+
+    def _read(self):
+        for block in iter(lambda: self.process.stdout.read(int(BYTES_PER_SECOND * 0.1)), b""):
+            with self._changed:
+                self._pcm += block
+                self._changed.notify_all()
+        with self._changed:
+            self._ended = True
+            self._changed.notify_all()
+
+    def _drop_before(self, time: float):
+        drop = int((time - self._base) * SAMPLE_RATE) * 2
+        if drop > 0:
+            del self._pcm[:drop]
+            self._base += drop / BYTES_PER_SECOND
+
+    def _emit(self, start: float, end: float, text: str):
+        text = text.strip()
+        if not text:
+            return
+        # The first segment of a window can repeat the cue just before it
+        if self.last_cue and _normalize(text) == _normalize(self.last_cue["text"]) \
+                and start < self.last_cue["end"] + 1.0:
+            return
+        self.cue_count += 1
+        self.last_cue = {"id": self.cue_count, "start": round(start, 3), "end": round(max(end, start), 3), "text": text}
+        self.on_cue(self.last_cue)
+
+    def _transcribe(self, start: float, end: float) -> list:
+        with self._changed:
+            first = int((start - self._base) * SAMPLE_RATE) * 2
+            last = int((end - self._base) * SAMPLE_RATE) * 2
+            samples = np.frombuffer(bytes(self._pcm[first:last]), dtype=np.int16)
+
+        result = self.backend.transcribe(
+            ("live.wav", encode_wav(samples, SAMPLE_RATE)),
+            self.options.get("model", "whisper-1"),
+            self.options.get("task", "transcribe"),
+            self.options.get("language", "auto")
+        )
+        segments = []
+        for segment in result["segments"]:
+            segment = dict(segment, start=segment["start"] + start, end=min(segment["end"] + start, end))
+            if segment.get("words"):
+                segment["words"] = [
+                    dict(word, start=word["start"] + start, end=min(word["end"] + start, end))
+                    for word in segment["words"]
+                ]
+            segments.append(segment)
+        return segments
+
+    def _finalize(self, segments, committed: float, cutoff: float, force: float) -> float:
+        """Emit the segments that are final and return the time up to which audio is done"""
+        pending = []
+        for segment in segments:
+            if segment["end"] <= cutoff and not pending:
+                self._emit(segment["start"], segment["end"], segment.get("text", ""))
+                committed = segment["end"]
+            else:
+                pending.append(segment)
+
+        if committed < force and pending:
+            # Too far behind: finalize what was heard so far instead of waiting for the segment to end
+            segment = pending.pop(0)
+            words = [word for word in segment.get("words") or [] if word["end"] <= cutoff]
+            if words:
+                self._emit(words[0]["start"], words[-1]["end"], " ".join(w["word"].strip() for w in words))
+                committed = words[-1]["end"]
+                rest = [word for word in segment["words"] if word["end"] > cutoff]
+                if rest:
+                    pending.insert(0, dict(segment, start=rest[0]["start"], words=rest,
+                                           text=" ".join(w["word"].strip() for w in rest)))
+            else:
+                self._emit(segment["start"], segment["end"], segment.get("text", ""))
+                committed = segment["end"]
+
+        if committed < force and not pending:
+            # Nothing but silence in the window
+            committed = force
+
+        if self.on_partial is not None and pending:
+            self.on_partial({
+                "start": round(pending[0]["start"], 3),
+                "end": round(pending[-1]["end"], 3),
+                "text": " ".join(segment.get("text", "").strip() for segment in pending),
+            })
+        return committed
+
+    def run(self):
+        """Read and transcribe the source until it ends or ``stop()`` is called"""
+        args = ["ffmpeg", "-loglevel", "error"] + source_args(self.source, self.idle_timeout) + \
+            ["-vn", "-ac", "1", "-ar", str(SAMPLE_RATE), "-f", "s16le", "pipe:1"]
+        self.process = subprocess.Popen(
+            args,
+            stdin=None if self.source == "-" else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+        )
+        reader = threading.Thread(target=self._read, daemon=True)
+        reader.start()
+
+        committed = 0.0
+        processed = 0.0
+        window = self.max_delay + self.step
+        try:
+            while not self._stopped:
+                with self._changed:
+                    self._changed.wait_for(
+                        lambda: self._ended or self._stopped or self._available() >= processed + self.step
+                    )
+                    ended = self._ended
+                    available = self._available()
+                if self._stopped:
+                    break
+
+                if self.keep_up and available - committed > 2 * window:
+                    logger.warning("Transcription is falling behind; skipping %.1fs of audio",
+                                   available - window - committed)
+                    committed = available - window
+
+                # Catch up on audio that is already there one window at a time
+                end = min(available, committed + window)
+                if end - committed >= 0.1:
+                    segments = self._transcribe(committed, end)
+                    final = ended and end == available
+                    cutoff = end if final else end - self.holdback
+                    force = end if final else end - self.max_delay
+                    committed = self._finalize(segments, committed, cutoff, force)
+                    with self._changed:
+                        self._drop_before(committed)
+                processed = end
+
+                if ended and end >= available:
+                    break
+        finally:
+            self.stop()
+            reader.join()
+
+    def stop(self):
+        with self._changed:
+            self._stopped = True
+            self._changed.notify_all()
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+
+
+class CueWriter:
+    """Writes cues to a file as they are finalized, as SRT or WebVTT"""
+
+    def __init__(self, file, subtitle_format: str = "srt"):
+        self.file = file
+        self.subtitle_format = subtitle_format
+        if subtitle_format == "vtt":
+            self.file.write("WEBVTT\n\n")
+            self.file.flush()
+
+    def write(self, cue: dict):
+        decimal_marker = "." if self.subtitle_format == "vtt" else ","
+        start = format_timestamp(cue["start"], always_include_hours=True, decimal_marker=decimal_marker)
+        end = format_timestamp(cue["end"], always_include_hours=True, decimal_marker=decimal_marker)
+        self.file.write(f"{cue['id']}\n{start} --> {end}\n{cue['text'].replace('-->', '->')}\n\n")
+        self.file.flush()
+
+
+def sse_event(event: str, data: dict, event_id=None) -> str:
+    """Format a Server-Sent Event"""
+    lines = [f"id: {event_id}"] if event_id is not None else []
+    lines += [f"event: {event}", f"data: {json.dumps(data)}"]
+    return "\n".join(lines) + "\n\n"
+
+
+class LiveBroadcast:
+    """One live transcription shared by every subscriber to a source.
+
+    The transcriber runs while there are subscribers, and for ``linger``
+    seconds after the last one leaves. Recent cues are kept so a reconnecting
+    client can pass the id of the last cue it saw and receive the ones it
+    missed. Subscribers come and go under ``lock``, which a registry of
+    broadcasts shares so that it never hands out a broadcast that is closing;
+    ``on_close`` is called with it held.
+    """
+
+    def __init__(self, source: str, options: dict, on_close=None, lock=None, linger: float = LINGER_SECONDS):
+        self.source = source
+        self.options = options
+        self.on_close = on_close
+        self.linger = linger
+        self.history = deque(maxlen=CUE_HISTORY)
+        # Cues are renumbered here: a transcriber restarted within ``linger``
+        # counts from 1 again, but the ids in ``history`` must keep increasing
+        self._cue_id = 0
+        self._subscribers = set()
+        self._membership = lock or threading.Lock()
+        self._lock = threading.Lock()
+        self._transcriber = None
+        self._closer = None
+
+    def _publish(self, item):
+        with self._lock:
+            if item is not None and item[0] == "cue":
+                self._cue_id += 1
+                item = ("cue", dict(item[1], id=self._cue_id))
+                self.history.append(item[1])
+            for subscriber in self._subscribers:
+                subscriber.put(item)
+
+    def _run(self, transcriber):
+        try:
+            transcriber.run()
+        except Exception:
+            logger.exception("Live transcription of %s failed", self.source)
+        finally:
+            with self._lock:
+                # Otherwise it was stopped because everyone unsubscribed
+                ended = self._transcriber is transcriber
+                if ended:
+                    self._transcriber = None
+            if ended:
+                self._publish(None)
+
+    def subscribe(self, last_event_id: int = None) -> queue.Queue:
+        """A queue of ``(event, data)`` tuples, ending with None when the source ends"""
+        subscriber = queue.Queue()
+        with self._membership, self._lock:
+            if last_event_id is not None:
+                for cue in self.history:
+                    if cue["id"] > last_event_id:
+                        subscriber.put(("cue", cue))
+            self._subscribers.add(subscriber)
+
+            if self._closer is not None:
+                self._closer.cancel()
+                self._closer = None
+            if self._transcriber is None:
+                self._transcriber = LiveTranscriber(
+                    self.source, self.options,
+                    on_cue=lambda cue: self._publish(("cue", cue)),
+                    on_partial=lambda partial: self._publish(("partial", partial)),
+                )
+                threading.Thread(target=self._run, args=(self._transcriber,), name="live", daemon=True).start()
+        return subscriber
+
+    def unsubscribe(self, subscriber: queue.Queue):
+        with self._membership:
+            with self._lock:
+                self._subscribers.discard(subscriber)
+                if self._subscribers or self._closer is not None:
+                    return
+            self._closer = threading.Timer(self.linger, self._close)
+            self._closer.daemon = True
+            self._closer.start()
+
+    def _close(self):
+        with self._membership:
+            with self._lock:
+                # Someone subscribed again in the meantime
+                if self._subscribers or self._closer is None:
+                    return
+                self._closer = None
+                transcriber, self._transcriber = self._transcriber, None
+            if self.on_close is not None:
+                self.on_close(self)
+
+        if transcriber is not None:
+            transcriber.stop()
+
+
+# Broadcasts with subscribers, by source and options
+_broadcasts = {}
+# Reentrant, because subscribe() takes it again
+_broadcasts_lock = threading.RLock()
+
+
+def subscribe_broadcast(source: str, options: dict, last_event_id: int = None):
+    """Subscribe to the process-wide broadcast of ``source`` transcribed with
+    ``options``. Returns the broadcast and the subscriber's queue (see
+    ``LiveBroadcast.subscribe``)."""
+    key = (source, json.dumps(options, sort_keys=True))
+
+    def forget(broadcast):
+        # Called by the closing broadcast with _broadcasts_lock held
+        if _broadcasts.get(key) is broadcast:
+            del _broadcasts[key]
+
+    # Looked up and subscribed to in one go, so the broadcast can't close in between
+    with _broadcasts_lock:
+        broadcast = _broadcasts.get(key)
+        if broadcast is None:
+            broadcast = _broadcasts[key] = LiveBroadcast(source, options, on_close=forget, lock=_broadcasts_lock)
+        return broadcast, broadcast.subscribe(last_event_id)
@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import logging
+from contextlib import contextmanager
+from prometheus_client import (
+    CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+)
+from prometheus_client import multiprocess
+
+logger = logging.getLogger(__name__)
+
+# Stage durations range from milliseconds (rendering) to many minutes (burning long videos)
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+STAGE_DURATION = Histogram(
+    "auto_subtitle_stage_duration_seconds", "Time spent in each processing stage",
+    ["stage"], buckets=DURATION_BUCKETS
+)
+STAGE_BYTES_IN = Counter("auto_subtitle_stage_bytes_in", "Bytes read by each processing stage", ["stage"])
+STAGE_BYTES_OUT = Counter("auto_subtitle_stage_bytes_out", "Bytes written by each processing stage", ["stage"])
+STAGE_IN_PROGRESS = Gauge(
+    "auto_subtitle_stage_in_progress", "Work currently in each processing stage",
+    ["stage"], multiprocess_mode="livesum"
+)
+STAGE_ERRORS = Counter("auto_subtitle_stage_errors", "Failures of each processing stage", ["stage"])
+
+FFMPEG_FPS = Histogram(
+    "auto_subtitle_ffmpeg_fps", "Frames per second of ffmpeg runs",
+    ["stage"], buckets=(5, 10, 25, 50, 100, 200, 400, 800, 1600)
+)
+FFMPEG_SPEED = Histogram(
+    "auto_subtitle_ffmpeg_speed", "Media seconds processed per second by ffmpeg runs",
+    ["stage"], buckets=(0.25, 0.5, 1, 2, 4, 8, 16, 32, 64, 128)
+)
+
+VAD_AUDIO_SECONDS = Counter("auto_subtitle_vad_audio_seconds", "Seconds of audio checked for speech")
+VAD_TRIMMED_SECONDS = Counter(
+    "auto_subtitle_vad_trimmed_seconds", "Seconds of silence or music cut before transcription"
+)
+
+
+def observe_ffmpeg(stage: str, fps: float = None, speed: float = None):
+    """Record the fps and speed an ffmpeg run finished with"""
+    if fps:
+        FFMPEG_FPS.labels(stage).observe(fps)
+    if speed:
+        FFMPEG_SPEED.labels(stage).observe(speed)
+
+
+class StageRecord:
+    """Bytes of one stage run; set ``bytes_in`` and ``bytes_out`` while it runs"""
+
+    def __init__(self):
+        self.bytes_in = None
+        self.bytes_out = None
+        self.seconds = None
+
+
+@contextmanager
+def stage(name: str, timing=None):
+    """Time a processing stage, count its bytes and errors, and add it to ``timing``"""
+    record = StageRecord()
+    STAGE_IN_PROGRESS.labels(name).inc()
+    started = time.perf_counter()
+    try:
+        yield record
+    except BaseException:
+        STAGE_ERRORS.labels(name).inc()
+        if timing is not None:
+            timing.failed_stage = name
+        raise
+    finally:
+        record.seconds = time.perf_counter() - started
+        STAGE_IN_PROGRESS.labels(name).dec()
+        STAGE_DURATION.labels(name).observe(record.seconds)
+        if record.bytes_in:
+            STAGE_BYTES_IN.labels(name).inc(record.bytes_in)
+        if record.bytes_out:
+            STAGE_BYTES_OUT.labels(name).inc(record.bytes_out)
+        if timing is not None:
+            timing.stages[name] = record
+
+
+class JobTiming:
+    """Per-job stage timings and ``stats``, logged as one JSON record when the job ends"""
+
+    def __init__(self, video: str, job_id: str = None):
+        self.video = video
+        self.job_id = job_id
+        self.stages = {}
+        self.stats = {}
+        self.failed_stage = None
+        self.started = time.perf_counter()
+
+    def stage(self, name: str):
+        return stage(name, self)
+
+    def record(self) -> dict:
+        return {
+            "event": "job_timing",
+            "job_id": self.job_id,
+            "video": os.path.basename(self.video) if self.video else None,
+            "status": "failed" if self.failed_stage else "done",
+            "failed_stage": self.failed_stage,
+            "total_seconds": round(time.perf_counter() - self.started, 3),
+            "stages": {
+                name: {
+                    "seconds": round(record.seconds, 3),
+                    "bytes_in": record.bytes_in,
+                    "bytes_out": record.bytes_out,
+                }
+                for name, record in self.stages.items()
+            },
+            "stats": self.stats,
+        }
+
+    def log(self):
+        logger.info(json.dumps(self.record()))
+
+
+def render_metrics():
+    """Return the metrics in Prometheus text format and its content type.
+
+    With PROMETHEUS_MULTIPROC_DIR set, the metrics of every process sharing
+    that directory (web workers and job workers) are aggregated.
+    """
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
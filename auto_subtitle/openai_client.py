@@ -0,0 +1,307 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+from collections import deque
+from concurrent.futures import as_completed, wait
+import openai
+from .audio import read_audio, audio_duration
+
+logger = logging.getLogger(__name__)
+
+# Limits apply per process; divide them by the number of worker processes
+MAX_CONNECTIONS = int(os.getenv("AUTO_SUBTITLE_OPENAI_MAX_CONNECTIONS", 16))
+MAX_CONCURRENCY = int(os.getenv("AUTO_SUBTITLE_OPENAI_MAX_CONCURRENCY", 8))
+REQUESTS_PER_MINUTE = float(os.getenv("AUTO_SUBTITLE_OPENAI_RPM", 50))
+# 0 disables the audio limit
+AUDIO_MINUTES_PER_MINUTE = float(os.getenv("AUTO_SUBTITLE_OPENAI_AUDIO_MINUTES_PER_MINUTE", 0))
+
+MAX_ATTEMPTS = int(os.getenv("AUTO_SUBTITLE_OPENAI_MAX_ATTEMPTS", 5))
+DEADLINE_SECONDS = float(os.getenv("AUTO_SUBTITLE_OPENAI_DEADLINE", 300))
+CONNECT_TIMEOUT = 5.0
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+
+# Hedging sends a second copy of a request that is slower than the p95 of
+# recent requests, uses whichever answers first and cancels the other
+HEDGE = os.getenv("AUTO_SUBTITLE_OPENAI_HEDGE", "false").lower() == "true"
+HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+
+RETRYABLE_STATUS = {408, 409, 429}
+
+
+class TokenBucket:
+    """Allows ``rate`` units per second on average, in bursts of up to ``capacity``"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self, amount: float) -> float:
+        """Take ``amount`` tokens if available, or return how long until they will be"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return 0.0
+            return (amount - self.tokens) / self.rate
+
+    def try_acquire(self, amount: float = 1.0) -> bool:
+        return self._take(min(amount, self.capacity)) == 0.0
+
+    def acquire(self, amount: float = 1.0, deadline: float = None) -> float:
+        """Block until ``amount`` tokens are taken and return the time spent waiting.
+        Raises TimeoutError if that would take past ``deadline`` (a time.monotonic() value)."""
+        # More than the capacity would never become available
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            delay = self._take(amount)
+            if delay == 0.0:
+                return waited
+            if deadline is not None and time.monotonic() + delay > deadline:
+                raise TimeoutError("Rate limit wait would exceed the request deadline")
+            time.sleep(delay)
+            waited += delay
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, openai.APIConnectionError):  # Includes timeouts
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS or error.status_code >= 500
+    return False
+
+
+def retry_delay(attempt: int, error: Exception = None) -> float:
+    """Jittered exponential backoff, or the server's Retry-After if it sent one"""
+    response = getattr(error, "response", None)
+    if response is not None:
+        try:
+            return min(BACKOFF_MAX, float(response.headers.get("retry-after")))
+        except (TypeError, ValueError):
+            pass
+
+    base = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1))
+    return base / 2 + random.uniform(0, base / 2)
+
+
+class TranscriptionClient:
+    """Shared OpenAI client for transcription calls.
+
+    Reuses one pooled HTTP client, limits requests and audio minutes with
+    token buckets, caps concurrent requests, retries transient failures with
+    jittered exponential backoff within a per-call deadline, and optionally
+    hedges slow requests. Hedged requests are sent with the async client on
+    an event loop thread of their own, so the loser of a race can be
+    cancelled, which closes its connection and frees its slot.
+    """
+
+    def __init__(self, max_connections: int = MAX_CONNECTIONS, max_concurrency: int = MAX_CONCURRENCY,
+                 requests_per_minute: float = REQUESTS_PER_MINUTE,
+                 audio_minutes_per_minute: float = AUDIO_MINUTES_PER_MINUTE,
+                 max_attempts: int = MAX_ATTEMPTS, deadline: float = DEADLINE_SECONDS, hedge: bool = HEDGE):
+        self.max_connections = max_connections
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.hedge = hedge
+
+        self.requests = TokenBucket(requests_per_minute / 60, max(1.0, requests_per_minute / 6)) \
+            if requests_per_minute > 0 else None
+        self.audio_minutes = TokenBucket(audio_minutes_per_minute / 60, max(1.0, audio_minutes_per_minute / 6)) \
+            if audio_minutes_per_minute > 0 else None
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+
+        self._lock = threading.Lock()
+        self._client = None
+        self._async_client = None
+        self._loop = None
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._stats = {
+            "requests": 0,
+            "retries": 0,
+            "failures": 0,
+            "hedges": 0,
+            "hedge_wins": 0,
+            "throttled_seconds": 0.0,
+        }
+
+    def _count(self, name: str, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def _http_options(self) -> dict:
+        # Built from the SDK's own classes, whichever HTTP library it uses
+        return {
+            "limits": type(openai.DEFAULT_CONNECTION_LIMITS)(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_connections
+            ),
+            "timeout": openai.Timeout(self.deadline, connect=CONNECT_TIMEOUT),
+        }
+
+    def client(self) -> openai.OpenAI:
+        with self._lock:
+            if self._client is None:
+                self._client = openai.OpenAI(
+                    api_key=openai.api_key or os.getenv("OPENAI_API_KEY"),
+                    # Retries are handled here, within the call's deadline
+                    max_retries=0,
+                    http_client=openai.DefaultHttpxClient(**self._http_options())
+                )
+            return self._client
+
+    def async_client(self):
+        """The async client for hedged requests, and the event loop it runs on"""
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="openai-hedge", daemon=True).start()
+                self._async_client = openai.AsyncOpenAI(
+                    api_key=openai.api_key or os.getenv("OPENAI_API_KEY"),
+                    max_retries=0,
+                    http_client=openai.DefaultAsyncHttpxClient(**self._http_options())
+                )
+            return self._async_client, self._loop
+
+    def hedge_delay(self):
+        """p95 latency of recent requests, or None if hedging is off or there is too little data"""
+        with self._lock:
+            if not self.hedge or len(self._latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            latencies = sorted(self._latencies)
+        return latencies[int(len(latencies) * 0.95) - 1]
+
+    def _take_slot(self, deadline):
+        """Wait for a concurrency slot, raising TimeoutError if none is free before ``deadline``"""
+        if not self._slots.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            raise TimeoutError("No request slot was free before the deadline")
+
+    def _send(self, create, file, params, deadline):
+        self._take_slot(deadline)
+        try:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("Transcription request deadline exceeded")
+
+            self._count("requests")
+            started = time.monotonic()
+            response = create(file=file, timeout=remaining, **params)
+        finally:
+            self._slots.release()
+
+        with self._lock:
+            self._latencies.append(time.monotonic() - started)
+        return response
+
+    async def _send_async(self, create, file, params, deadline):
+        """``_send`` for a hedged request, whose slot the caller has taken already"""
+        try:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("Transcription request deadline exceeded")
+
+            self._count("requests")
+            started = time.monotonic()
+            response = await create(file=file, timeout=remaining, **params)
+        finally:
+            # Also when the request lost a race and was cancelled
+            self._slots.release()
+
+        with self._lock:
+            self._latencies.append(time.monotonic() - started)
+        return response
+
+    def _attempt(self, task, file, params, deadline):
+        delay = self.hedge_delay()
+        if delay is None:
+            return self._send(_endpoint(self.client(), task), file, params, deadline)
+
+        client, loop = self.async_client()
+        create = _endpoint(client, task)
+        self._take_slot(deadline)
+        primary = asyncio.run_coroutine_threadsafe(self._send_async(create, file, params, deadline), loop)
+        hedge = None
+        try:
+            done, _ = wait([primary], timeout=delay)
+            if done:
+                return primary.result()
+            # Only hedge with a free slot and spare request budget, so hedges
+            # can't deepen an overload
+            if not self._slots.acquire(blocking=False):
+                return primary.result()
+            if self.requests is not None and not self.requests.try_acquire():
+                self._slots.release()
+                return primary.result()
+
+            self._count("hedges")
+            hedge = asyncio.run_coroutine_threadsafe(self._send_async(create, file, params, deadline), loop)
+            error = None
+            for future in as_completed([primary, hedge]):
+                if future.exception() is None:
+                    if future is hedge:
+                        self._count("hedge_wins")
+                    return future.result()
+                error = error or future.exception()
+            raise error
+        finally:
+            # Cancelling the loser closes its connection and releases its slot
+            for future in (primary, hedge):
+                if future is not None and not future.done():
+                    future.cancel()
+
+    def create(self, task: str, audio, **params):
+        """Send a transcription (or, for task "translate", translation) request for ``audio``"""
+        # Keep the upload in memory so retries and hedges can resend it
+        name = audio if isinstance(audio, str) else audio[0]
+        file = (os.path.basename(name), read_audio(audio))
+        minutes = audio_duration(audio) / 60
+
+        deadline = time.monotonic() + self.deadline
+
+        attempt = 1
+        while True:
+            try:
+                for bucket, amount in ((self.requests, 1), (self.audio_minutes, minutes)):
+                    if bucket is not None:
+                        self._count("throttled_seconds", bucket.acquire(amount, deadline))
+                return self._attempt(task, file, params, deadline)
+            except Exception as e:
+                delay = retry_delay(attempt, e)
+                if not is_retryable(e) or attempt >= self.max_attempts or time.monotonic() + delay >= deadline:
+                    self._count("failures")
+                    raise
+                self._count("retries")
+                logger.warning("Transcription request failed (%s), retrying in %.1fs", e, delay)
+                time.sleep(delay)
+                attempt += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
+
+
+def _endpoint(client, task: str):
+    return client.audio.transcriptions.create if task == "transcribe" else client.audio.translations.create
+
+
+# Created on first use so that importing the module has no side effects
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_openai_client() -> TranscriptionClient:
+    """Return the process-wide transcription client"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = TranscriptionClient()
+    return _client
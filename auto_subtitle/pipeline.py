@@ -0,0 +1,484 @@
+import os
+import queue
+import copyreg
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import ffmpeg
+from .utils import filename
+from .transcript import Transcript, render, save_transcript, TRANSCRIPT_EXTENSION
+from .burn import (
+    create_subtitled_video, burn_segmented, create_preview, DEFAULT_BURN_SEGMENTS, DEFAULT_ENCODER_PROFILE,
+    PREVIEW_SECONDS
+)
+from .audio import get_audio, audio_size, release_audio, DEFAULT_AUDIO_FORMAT
+from .probe import probe_media
+from .cache import TranscriptCache
+from .backends import get_backend, DEFAULT_BACKEND
+from .metrics import JobTiming
+from .progress import run_ffmpeg, media_duration, Progress
+from .chunking import transcribe_chunked, DEFAULT_CHUNK_SECONDS, DEFAULT_CHUNK_WORKERS
+from .vad import transcribe_speech
+
+# How subtitles are added to the video: burned into the picture (re-encoding
+# it), or muxed as a subtitle track next to the copied video and audio
+OUTPUT_MODES = ["burn", "mux"]
+
+# Container and subtitle codec used by the mux output mode per subtitle format
+MUX_FORMATS = {
+    "ass": ("mkv", "ass"),
+    "srt": ("mp4", "mov_text"),
+}
+
+# Created on first use so that importing the module has no side effects
+_transcript_cache = None
+_transcript_cache_lock = threading.Lock()
+
+
+def render_subtitles(video_path, transcript, output_dir, subtitle_format, ass_style):
+    """Write the subtitle file for a transcript"""
+    # Save subtitle file in the output directory
+    sub_path = os.path.join(output_dir, f"{filename(video_path)}.{subtitle_format}")
+
+    with open(sub_path, "w", encoding="utf-8") as f:
+        render(transcript, subtitle_format, f, ass_style)
+
+    return sub_path
+
+def transcript_path(output_dir, video_path):
+    """Where the transcript of a video is kept with the "save_transcript" option"""
+    return os.path.join(output_dir, f"{filename(video_path)}.{TRANSCRIPT_EXTENSION}")
+
+def render_transcript(video_path, result, output_dir, options):
+    """Write the subtitle file for a transcription result, keeping its transcript if asked to"""
+    transcript = Transcript.from_result(result)
+    if options.get("save_transcript"):
+        save_transcript(transcript, transcript_path(output_dir, video_path))
+    return render_subtitles(video_path, transcript, output_dir, options["subtitle_format"], options["ass_style"])
+
+def mux_subtitles(video_path, sub_path, output_dir, subtitle_format, on_progress=None, probe=None):
+    """Add the subtitles as a soft subtitle track, copying video and audio without re-encoding"""
+    extension, subtitle_codec = MUX_FORMATS[subtitle_format]
+    out_path = os.path.join(output_dir, f"{filename(video_path)}_subtitled.{extension}")
+
+    video = ffmpeg.input(video_path)
+    subtitles = ffmpeg.input(sub_path)
+
+    # Copying is fast; only probe for the duration if someone is watching
+    if probe is None and on_progress is not None:
+        probe = ffmpeg.probe(video_path)
+    duration = media_duration(probe) if probe is not None else None
+    run_ffmpeg(
+        ffmpeg
+        .output(
+            video['v'],
+            video['a?'],
+            subtitles,
+            out_path,
+            c='copy',
+            **{'c:s': subtitle_codec}
+        )
+        .overwrite_output(),
+        "mux", duration, on_progress
+    )
+
+    return out_path
+
+def output_stage(options):
+    """Name of the stage that adds the subtitles to the video"""
+    return "preview" if options.get("preview") else options.get("output_mode", "burn")
+
+def add_subtitles(video_path, sub_path, output_dir, options, on_progress=None, probe=None):
+    """Burn the subtitles into the video, or add them as a track in "mux" output mode.
+
+    With the "preview" option, only ``preview_seconds`` from ``preview_start``
+    are burned, downscaled and encoded for speed. ``probe`` is the output of
+    ``ffmpeg.probe`` for the video, so it isn't probed again.
+    """
+    if options.get("preview"):
+        return create_preview(
+            video_path, sub_path, output_dir, options["subtitle_format"],
+            options.get("preview_start") or 0.0, options.get("preview_seconds") or PREVIEW_SECONDS,
+            on_progress=on_progress, probe=probe
+        )
+    if options.get("output_mode", "burn") == "mux":
+        return mux_subtitles(video_path, sub_path, output_dir, options["subtitle_format"], on_progress, probe)
+    profile = options.get("encoder_profile") or DEFAULT_ENCODER_PROFILE
+    if options.get("segmented_burn"):
+        return burn_segmented(
+            video_path, sub_path, output_dir, options["subtitle_format"],
+            options.get("burn_segments") or DEFAULT_BURN_SEGMENTS, profile, on_progress, probe
+        )
+    return create_subtitled_video(
+        video_path, sub_path, output_dir, options["subtitle_format"], profile, on_progress, probe
+    )
+
+def get_transcript_cache():
+    """Return the process-wide transcript cache"""
+    global _transcript_cache
+    with _transcript_cache_lock:
+        if _transcript_cache is None:
+            _transcript_cache = TranscriptCache()
+    return _transcript_cache
+
+def transcribe_audio(audio_path, options, timing=None):
+    """Transcribe audio with the requested options, reusing cached transcripts unless disabled.
+
+    With the "vad" option only the speech is sent to the backend; how much
+    audio was cut is added to the stats of ``timing``.
+    """
+    model_name, task, language = options["model"], options["task"], options["language"]
+    backend = get_backend(options.get("backend") or DEFAULT_BACKEND)
+
+    def transcribe_single(audio):
+        return backend.transcribe(audio, model_name, task, language)
+
+    def transcribe_all(audio_path):
+        # Long audio would exceed the backend's upload limit in one request
+        limit = backend.max_upload_bytes
+        if options.get("chunked") or (limit is not None and audio_size(audio_path) > limit):
+            return transcribe_chunked(
+                audio_path,
+                transcribe_single,
+                max_chunk_seconds=options.get("chunk_seconds") or DEFAULT_CHUNK_SECONDS,
+                max_workers=options.get("chunk_workers") or DEFAULT_CHUNK_WORKERS
+            )
+        return transcribe_single(audio_path)
+
+    def transcribe(audio_path):
+        if options.get("vad"):
+            return transcribe_speech(audio_path, transcribe_all, timing)
+        return transcribe_all(audio_path)
+
+    if not options.get("cache", True):
+        return transcribe(audio_path)
+
+    # Cutting silence shifts what the model hears, so cache those transcripts separately
+    model_id = backend.model_id(model_name) + ("+vad" if options.get("vad") else "")
+    return get_transcript_cache().transcribe(audio_path, model_id, task, language, transcribe)
+
+def process_video(video_path, output_dir, options, audio=None, timing=None, on_progress=None, media=None):
+    """Run extraction, transcription and burn-in for one video.
+
+    Returns a ``(path, download_name)`` tuple for the generated file. ``options``
+    holds the request parameters (backend, model, subtitle_format, ass_style,
+    task, language, srt_only, output_mode, encoder_profile, segmented_burn,
+    burn_segments, cache, chunked, chunk_seconds, vad, audio_format,
+    save_transcript, preview, preview_start, preview_seconds). Audio that
+    was already extracted, e.g. while the video was uploaded, can be passed as
+    ``audio`` and is released afterwards. The video is probed once up
+    front, unless its ``MediaInfo`` is passed as ``media``; the probe picks
+    the extraction fast path and the burn reuses it. Audio-only inputs stop
+    after the subtitle file. Stage timings are added to ``timing``; without
+    one, they are logged when the video is done. ``on_progress`` is called
+    with a ``Progress`` snapshot as each stage starts and while ffmpeg adds
+    the subtitles.
+    """
+    subtitle_format = options["subtitle_format"]
+    log_timing = timing is None
+    timing = timing or JobTiming(video_path)
+
+    def report(stage_name):
+        if on_progress is not None:
+            on_progress(Progress(stage_name).snapshot(0.0))
+
+    try:
+        if media is None:
+            with timing.stage("probe"):
+                media = probe_media(video_path)
+
+        audio_path = audio
+        if audio_path is None:
+            report("extract")
+            with timing.stage("extract") as record:
+                record.bytes_in = os.path.getsize(video_path)
+                audio_path = get_audio(
+                    video_path, options.get("audio_format", DEFAULT_AUDIO_FORMAT), media=media
+                )
+                record.bytes_out = audio_size(audio_path)
+
+        try:
+            report("transcribe")
+            with timing.stage("transcribe") as record:
+                record.bytes_in = audio_size(audio_path)
+                result = transcribe_audio(audio_path, options, timing)
+        finally:
+            release_audio(audio_path)
+
+        report("render")
+        with timing.stage("render") as record:
+            sub_path = render_transcript(video_path, result, output_dir, options)
+            record.bytes_out = os.path.getsize(sub_path)
+
+        if options["srt_only"] or not media.has_video:
+            return sub_path, f"{filename(video_path)}.{subtitle_format}"
+
+        report(output_stage(options))
+        with timing.stage(output_stage(options)) as record:
+            record.bytes_in = os.path.getsize(video_path)
+            output_video_path = add_subtitles(video_path, sub_path, output_dir, options, on_progress, media.probe)
+            record.bytes_out = os.path.getsize(output_video_path)
+        return output_video_path, os.path.basename(output_video_path)
+    finally:
+        if log_timing:
+            timing.log()
+
+def rerender(transcript, output_dir, options, video_path=None, name=None, timing=None, on_progress=None,
+             media=None):
+    """Render a stored transcript again, and add it to ``video_path`` if given, without transcribing.
+
+    The subtitle file is named after the video, or ``name`` without one.
+    ``media`` is the ``MediaInfo`` of the video if it was already probed.
+    Returns a ``(path, download_name)`` tuple like ``process_video``.
+    """
+    log_timing = timing is None
+    timing = timing or JobTiming(video_path)
+
+    try:
+        with timing.stage("render") as record:
+            sub_path = render_subtitles(
+                video_path or name, transcript, output_dir, options["subtitle_format"], options["ass_style"]
+            )
+            record.bytes_out = os.path.getsize(sub_path)
+
+        if video_path is None or options.get("srt_only"):
+            return sub_path, os.path.basename(sub_path)
+
+        if media is None:
+            with timing.stage("probe"):
+                media = probe_media(video_path, require_audio=False)
+        if not media.has_video:
+            return sub_path, os.path.basename(sub_path)
+
+        if on_progress is not None:
+            on_progress(Progress(output_stage(options)).snapshot(0.0))
+        with timing.stage(output_stage(options)) as record:
+            record.bytes_in = os.path.getsize(video_path)
+            output_video_path = add_subtitles(video_path, sub_path, output_dir, options, on_progress, media.probe)
+            record.bytes_out = os.path.getsize(output_video_path)
+        return output_video_path, os.path.basename(output_video_path)
+    finally:
+        if log_timing:
+            timing.log()
+
+
+# Marks the end of the input of a pipeline stage
+_STOP = object()
+
+
+def _reduce_ffmpeg_error(error):
+    return (ffmpeg.Error, ("ffmpeg", error.stdout, error.stderr))
+
+# ffmpeg.Error can't be rebuilt from its pickled args, which would break the
+# process pool when a stage fails; pickle it from its output instead
+copyreg.pickle(ffmpeg.Error, _reduce_ffmpeg_error)
+
+
+def _extract_stage(video_path, audio_format, media=None):
+    """Extract audio in a pool process, returning something that can be pickled back"""
+    audio = get_audio(video_path, audio_format, media=media)
+    if isinstance(audio, str):
+        return audio
+
+    name, data = audio
+    try:
+        return (name, data.read())
+    finally:
+        data.close()
+
+
+def _burn_stage(video_path, sub_path, output_dir, options, progress_queue=None, probe=None):
+    on_progress = None
+    if progress_queue is not None:
+        def on_progress(snapshot):
+            progress_queue.put((video_path, snapshot))
+    return add_subtitles(video_path, sub_path, output_dir, options, on_progress, probe)
+
+
+class PipelineCancelled(Exception):
+    """The video was skipped because the pipeline was cancelled"""
+
+
+class _Stage:
+    """Worker threads moving items from a bounded inbox to the next stage's inbox"""
+
+    def __init__(self, name, func, workers, inbox, outbox, cancel=None):
+        self.name = name
+        self.func = func
+        self.inbox = inbox
+        self.outbox = outbox
+        self.cancel = cancel
+        self.threads = [threading.Thread(target=self._run, daemon=True) for _ in range(workers)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        """Signal the end of input and wait for the items in flight"""
+        for _ in self.threads:
+            self.inbox.put(_STOP)
+        for thread in self.threads:
+            thread.join()
+
+    def _run(self):
+        while True:
+            item = self.inbox.get()
+            if item is _STOP:
+                return
+
+            if item["error"] is None and self.cancel is not None and self.cancel.is_set():
+                item["error"] = PipelineCancelled("Cancelled")
+                item["failed_stage"] = self.name
+
+            # Failed items skip the remaining stages
+            if item["error"] is None:
+                try:
+                    self.func(item)
+                except Exception as e:
+                    item["error"] = e
+                    # The timing knows the step within the stage, e.g. the probe before extraction
+                    item["failed_stage"] = item["timing"].failed_stage or self.name
+            self.outbox.put(item)
+
+
+def run_pipeline(video_paths, output_dir, options, jobs=1, on_done=None, on_progress=None, cancel=None):
+    """Subtitle many videos with the stages of different videos overlapping.
+
+    Extraction, transcription, rendering and burn-in run as separate stages
+    connected by bounded queues, each with ``jobs`` workers. The ffmpeg-bound
+    stages (extraction and burn-in) run in a process pool and transcription
+    runs on threads, so network waits and encodes of different videos
+    overlap. Each input is probed before its audio is extracted, and
+    audio-only inputs skip the burn-in. Returns one dict per video with
+    ``video``, ``media``, ``sub_path``, ``output``, ``error`` (an exception,
+    or None on success) and ``timing``.
+    ``on_done(item)`` is called as each video finishes, and
+    ``on_progress(video, snapshot)`` with the ``Progress`` of its burn-in
+    (and ``None`` when the burn-in is over). Once the ``cancel`` event is
+    set, no more videos are started and the waiting ones fail with
+    ``PipelineCancelled`` between stages.
+    """
+    audio_format = options.get("audio_format", DEFAULT_AUDIO_FORMAT)
+    results = []
+    results_lock = threading.Lock()
+
+    # Pool processes are started from stage threads, where forking is unsafe
+    context = multiprocessing.get_context("spawn")
+
+    # The burn-in runs in pool processes, which send their progress back through a managed queue
+    manager = progress_queue = progress_thread = None
+    if on_progress is not None:
+        manager = context.Manager()
+        progress_queue = manager.Queue()
+
+        def forward_progress():
+            for update in iter(progress_queue.get, None):
+                on_progress(*update)
+
+        progress_thread = threading.Thread(target=forward_progress, daemon=True)
+        progress_thread.start()
+
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=context) as processes:
+        def extract(item):
+            # Unreadable inputs fail here, before any work is done on them
+            with item["timing"].stage("probe"):
+                item["media"] = probe_media(item["video"])
+            print(f"Extracting audio from {filename(item['video'])}...")
+            with item["timing"].stage("extract") as record:
+                record.bytes_in = os.path.getsize(item["video"])
+                item["audio"] = processes.submit(
+                    _extract_stage, item["video"], audio_format, item["media"]
+                ).result()
+                record.bytes_out = audio_size(item["audio"])
+
+        def transcribe(item):
+            print(f"Generating subtitles for {filename(item['video'])}... This might take a while.")
+            try:
+                with item["timing"].stage("transcribe") as record:
+                    record.bytes_in = audio_size(item["audio"])
+                    item["result"] = transcribe_audio(item["audio"], options, item["timing"])
+            finally:
+                release_audio(item["audio"])
+                item["audio"] = None
+
+        def render(item):
+            with item["timing"].stage("render") as record:
+                item["sub_path"] = render_transcript(item["video"], item["result"], output_dir, options)
+                record.bytes_out = os.path.getsize(item["sub_path"])
+            item["result"] = None
+            print(f"Saved subtitles to {os.path.abspath(item['sub_path'])}.")
+
+        def burn(item):
+            if options["srt_only"] or not item["media"].has_video:
+                return
+            if options.get("preview"):
+                print(f"Rendering preview of {filename(item['video'])}...")
+            elif options.get("output_mode", "burn") == "mux":
+                print(f"Adding subtitle track to {filename(item['video'])}...")
+            else:
+                print(f"Burning subtitles into {filename(item['video'])}...")
+            with item["timing"].stage(output_stage(options)) as record:
+                record.bytes_in = os.path.getsize(item["video"])
+                try:
+                    item["output"] = processes.submit(
+                        _burn_stage, item["video"], item["sub_path"], output_dir, options, progress_queue,
+                        item["media"].probe
+                    ).result()
+                finally:
+                    if on_progress is not None:
+                        on_progress(item["video"], None)
+                record.bytes_out = os.path.getsize(item["output"])
+            print(f"Successfully saved subtitled video to {os.path.abspath(item['output'])}")
+
+        def finish(item):
+            # Items cancelled after extraction never reached the transcribe
+            # stage that releases their audio
+            if item["audio"] is not None:
+                release_audio(item["audio"])
+                item["audio"] = None
+            item["timing"].log()
+            with results_lock:
+                results.append(item)
+            if on_done is not None:
+                on_done(item)
+
+        # Each queue holds at most a few items, so a fast stage can't run far
+        # ahead of a slow one (e.g. extract every video before any is transcribed)
+        queues = [queue.Queue(maxsize=jobs) for _ in range(4)]
+        stages = [
+            _Stage("extract", extract, jobs, queues[0], queues[1], cancel),
+            _Stage("transcribe", transcribe, jobs, queues[1], queues[2], cancel),
+            _Stage("render", render, 1, queues[2], queues[3], cancel),
+            _Stage("burn", burn, jobs, queues[3], _Collector(finish), cancel),
+        ]
+        for stage in stages:
+            stage.start()
+
+        for video_path in video_paths:
+            if cancel is not None and cancel.is_set():
+                break
+            queues[0].put({
+                "video": video_path, "media": None, "audio": None, "result": None,
+                "sub_path": None, "output": None, "error": None, "failed_stage": None,
+                "timing": JobTiming(video_path),
+            })
+
+        for stage in stages:
+            stage.stop()
+
+    if manager is not None:
+        progress_queue.put(None)
+        progress_thread.join()
+        manager.shutdown()
+    return results
+
+
+class _Collector:
+    """Queue-like sink handing finished items to a callback"""
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def put(self, item):
+        self.callback(item)
@@ -0,0 +1,85 @@
+import os
+import ffmpeg
+from .progress import media_duration
+
+# Inputs longer than this many seconds are rejected before any work is done;
+# 0 accepts any length
+MAX_MEDIA_SECONDS = float(os.getenv("AUTO_SUBTITLE_MAX_MEDIA_SECONDS", 0))
+
+
+class MediaError(ValueError):
+    """An input that can't be subtitled: unreadable, without audio, or too long"""
+
+
+class MediaInfo:
+    """The streams and duration of an input, from a single ``ffmpeg.probe``.
+
+    ``probe`` is the raw probe output, which can be stored (e.g. with a job)
+    and turned back into a ``MediaInfo`` without probing again. Cover art
+    in audio files doesn't count as video.
+    """
+
+    def __init__(self, path: str, probe: dict):
+        self.path = path
+        self.probe = probe
+        streams = probe.get("streams", [])
+        self.video = next(
+            (s for s in streams
+             if s.get("codec_type") == "video" and not s.get("disposition", {}).get("attached_pic")),
+            None
+        )
+        self.audio = next((s for s in streams if s.get("codec_type") == "audio"), None)
+        self.duration = media_duration(probe)
+
+    @property
+    def has_video(self) -> bool:
+        return self.video is not None
+
+    @property
+    def audio_codec(self):
+        return self.audio.get("codec_name") if self.audio else None
+
+    def audio_bytes(self):
+        """Size of the audio track in bytes, or None if it can't be told without reading it"""
+        if self.audio is None:
+            return None
+        bit_rate = self.audio.get("bit_rate")
+        if bit_rate not in (None, "N/A") and self.duration:
+            return int(int(bit_rate) * self.duration / 8)
+        if not self.has_video and len(self.probe.get("streams", [])) == 1:
+            return os.path.getsize(self.path)
+        return None
+
+
+def media_error(path: str, error) -> MediaError:
+    """The ``MediaError`` for an input ffprobe failed on with ``error`` (an ``ffmpeg.Error``)"""
+    # The last line is the actual error; it names the file by its full path
+    name = os.path.basename(path)
+    lines = (error.stderr or b"").decode("utf-8", "replace").strip().splitlines()
+    reason = lines[-1].replace(path, name) if lines else "not a media file"
+    return MediaError(f"Can't read {name}: {reason}")
+
+
+def check_media(media: MediaInfo, max_seconds: float = MAX_MEDIA_SECONDS, require_audio: bool = True) -> MediaInfo:
+    """Return ``media`` if it can be subtitled, or raise ``MediaError``.
+
+    Without ``require_audio``, as when burning a stored transcript, a video
+    without audio is accepted too.
+    """
+    name = os.path.basename(media.path)
+    if media.audio is None and (require_audio or not media.has_video):
+        raise MediaError(f"{name} has no audio track to transcribe")
+    if require_audio and media.audio_codec in (None, "none"):
+        raise MediaError(f"The audio track of {name} uses a codec that can't be decoded")
+    if max_seconds and media.duration and media.duration > max_seconds:
+        raise MediaError(f"{name} is {media.duration:.0f} seconds long; the limit is {max_seconds:.0f} seconds")
+    return media
+
+
+def probe_media(path: str, max_seconds: float = MAX_MEDIA_SECONDS, require_audio: bool = True) -> MediaInfo:
+    """Probe an input once and check that it can be subtitled (see ``check_media``)"""
+    try:
+        media = MediaInfo(path, ffmpeg.probe(path))
+    except ffmpeg.Error as e:
+        raise media_error(path, e)
+    return check_media(media, max_seconds, require_audio)
@@ -0,0 +1,171 @@
+import sys
+import time
+import shutil
+import threading
+import subprocess
+import ffmpeg
+from .metrics import observe_ffmpeg
+
+# Only the end of ffmpeg's stderr is kept, for the error of a failed run
+STDERR_TAIL_BYTES = 64 * 1024
+
+
+def media_duration(probe):
+    """Duration in seconds from the output of ``ffmpeg.probe``, or None if unknown"""
+    duration = probe.get("format", {}).get("duration")
+    if duration in (None, "N/A"):
+        return None
+    return float(duration)
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class Progress:
+    """Percent complete, speed and ETA of work on ``duration`` seconds of media"""
+
+    def __init__(self, stage: str, duration: float = None):
+        self.stage = stage
+        self.duration = duration
+        self.started = time.monotonic()
+
+    def snapshot(self, out_seconds: float, fps: float = None, speed: float = None, done: bool = False) -> dict:
+        if done and self.duration:
+            out_seconds = self.duration
+        elapsed = time.monotonic() - self.started
+        if not speed and elapsed > 0:
+            speed = out_seconds / elapsed
+
+        percent = eta = None
+        if self.duration:
+            percent = round(min(100.0, 100.0 * out_seconds / self.duration), 1)
+            if speed:
+                eta = round(max(0.0, self.duration - out_seconds) / speed, 1)
+        return {
+            "stage": self.stage,
+            "percent": percent,
+            "out_seconds": round(out_seconds, 3),
+            "duration": round(self.duration, 3) if self.duration else None,
+            "fps": fps,
+            "speed": round(speed, 2) if speed else None,
+            "eta_seconds": 0.0 if done else eta,
+        }
+
+
+def run_ffmpeg(stream, stage: str, duration: float = None, on_progress=None):
+    """Run an ffmpeg-python output stream, reporting its progress as it encodes.
+
+    ffmpeg writes its progress to a pipe, which is parsed as it arrives and
+    passed to ``on_progress`` as a ``Progress`` snapshot about twice a
+    second. Only the last STDERR_TAIL_BYTES of stderr are kept; a failed run
+    raises ``ffmpeg.Error`` with them. The final fps and speed are recorded
+    in the metrics of ``stage``. If ``on_progress`` raises, ffmpeg is killed.
+    """
+    args = stream.compile()
+    args = args[:1] + ["-nostats", "-progress", "pipe:1"] + args[1:]
+    process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    tail = bytearray()
+
+    def drain_stderr():
+        for chunk in iter(lambda: process.stderr.read(4096), b""):
+            tail.extend(chunk)
+            del tail[:-STDERR_TAIL_BYTES]
+
+    stderr_thread = threading.Thread(target=drain_stderr, daemon=True)
+    stderr_thread.start()
+
+    progress = Progress(stage, duration)
+    fields = {}
+    last = None
+    try:
+        for line in process.stdout:
+            key, _, value = line.decode("utf-8", "replace").strip().partition("=")
+            fields[key] = value
+            if key != "progress":
+                continue
+            # out_time_ms is in microseconds too
+            out_us = _number(fields.get("out_time_us")) or _number(fields.get("out_time_ms")) or 0.0
+            last = progress.snapshot(
+                max(0.0, out_us / 1e6),
+                _number(fields.get("fps")),
+                _number(fields.get("speed", "").rstrip("x")),
+                done=value == "end"
+            )
+            if on_progress is not None:
+                on_progress(last)
+    except BaseException:
+        # E.g. on_progress failed: don't leave ffmpeg writing the output behind
+        process.kill()
+        process.wait()
+        stderr_thread.join()
+        process.stdout.close()
+        raise
+
+    returncode = process.wait()
+    stderr_thread.join()
+    if returncode != 0:
+        raise ffmpeg.Error("ffmpeg", b"", bytes(tail))
+
+    if last is not None:
+        observe_ffmpeg(stage, last["fps"], last["speed"])
+    return last
+
+
+def _clock(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}" if seconds >= 3600 \
+        else f"{seconds // 60}:{seconds % 60:02d}"
+
+
+def format_progress(name: str, snapshot: dict, width: int = 20) -> str:
+    """One line such as ``video burn [#####-----] 50.0% 2.1x ETA 0:31``"""
+    parts = [name, snapshot["stage"]]
+    if snapshot.get("percent") is not None:
+        filled = int(width * snapshot["percent"] / 100)
+        parts.append(f"[{'#' * filled}{'-' * (width - filled)}] {snapshot['percent']:5.1f}%")
+    else:
+        parts.append(_clock(snapshot.get("out_seconds") or 0))
+    if snapshot.get("speed"):
+        parts.append(f"{snapshot['speed']:.1f}x")
+    if snapshot.get("eta_seconds") is not None:
+        parts.append(f"ETA {_clock(snapshot['eta_seconds'])}")
+    return " ".join(parts)
+
+
+class ProgressBar:
+    """A status line on a terminal with the progress of every video in flight"""
+
+    def __init__(self, file=sys.stderr):
+        self.file = file
+        self.active = {}
+        self.finished = set()
+        self.lock = threading.Lock()
+
+    def update(self, name: str, snapshot):
+        """Show the latest ``snapshot`` for ``name``; None removes it for good"""
+        with self.lock:
+            if name in self.finished:
+                return
+            if snapshot is None:
+                self.finished.add(name)
+                self.active.pop(name, None)
+            else:
+                self.active[name] = snapshot
+            self._render()
+
+    def _render(self):
+        line = " | ".join(format_progress(name, snapshot) for name, snapshot in self.active.items())
+        columns = shutil.get_terminal_size().columns
+        self.file.write("\r\033[K" + line[:columns - 1])
+        self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.active.clear()
+            self.file.write("\r\033[K")
+            self.file.flush()
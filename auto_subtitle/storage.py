@@ -0,0 +1,160 @@
+import os
+import time
+import uuid
+import shutil
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OUTPUT_TTL = float(os.getenv("AUTO_SUBTITLE_OUTPUT_TTL", 3600))
+DEFAULT_OUTPUT_MAX_BYTES = int(os.getenv("AUTO_SUBTITLE_OUTPUT_MAX_BYTES", 5 * 1024 * 1024 * 1024))
+DEFAULT_SWEEP_INTERVAL = float(os.getenv("AUTO_SUBTITLE_SWEEP_INTERVAL", 60))
+
+# Workspaces are removed when their request ends; older ones were left behind
+# by a process that died mid-request, or are resumable uploads abandoned by
+# their client
+WORKSPACE_STALE_AFTER = 24 * 3600
+
+
+def _tree_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except FileNotFoundError:
+                pass
+    return total
+
+
+class OutputStore:
+    """Generated files kept for download until they expire.
+
+    Each output is stored as ``<root>/<output_id>/<name>``. The mtime of the
+    output's directory records when it was last added or downloaded; outputs
+    unused for ``ttl`` seconds are deleted, and once all outputs take up more
+    than ``max_bytes`` the least recently used ones are evicted. Requests do
+    their work in a private workspace under ``workspaces_dir``, so concurrent
+    uploads of files with the same name never share paths.
+    """
+
+    def __init__(self, root: str, workspaces_dir: str, ttl: float = DEFAULT_OUTPUT_TTL,
+                 max_bytes: int = DEFAULT_OUTPUT_MAX_BYTES):
+        self.root = root
+        self.workspaces_dir = workspaces_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+        os.makedirs(workspaces_dir, exist_ok=True)
+
+        self._sweeper = None
+
+    def new_workspace(self, prefix: str = "job-") -> str:
+        """A new directory under ``workspaces_dir``, removed by the sweeper once it is
+        untouched for WORKSPACE_STALE_AFTER"""
+        return tempfile.mkdtemp(prefix=prefix, dir=self.workspaces_dir)
+
+    @contextmanager
+    def workspace(self):
+        """A new directory for the files of one request, removed with everything in it afterwards"""
+        path = self.new_workspace()
+        try:
+            yield path
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def add(self, path: str, name: str) -> str:
+        """Move a finished file into the store as ``name`` and return its output id"""
+        output_id = uuid.uuid4().hex
+        output_dir = os.path.join(self.root, output_id)
+        os.makedirs(output_dir)
+        shutil.move(path, os.path.join(output_dir, name))
+
+        self.sweep(keep=output_id)
+        return output_id
+
+    def get(self, output_id: str, name: str):
+        """Path of a stored output, or None if it doesn't exist or has expired"""
+        # Ids are generated hex strings; anything else could point outside the store
+        if not output_id.isalnum() or os.path.basename(name) != name:
+            return None
+
+        output_dir = os.path.join(self.root, output_id)
+        path = os.path.join(output_dir, name)
+        try:
+            if time.time() - os.stat(output_dir).st_mtime > self.ttl or not os.path.isfile(path):
+                return None
+            # Refresh the mtime so eviction treats this output as recently used
+            os.utime(output_dir)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def _remove(self, path: str):
+        # Files being downloaded stay readable until the download closes them
+        shutil.rmtree(path, ignore_errors=True)
+
+    def sweep(self, keep: str = None) -> int:
+        """Delete expired outputs and evict the least recently used ones over
+        ``max_bytes``, except ``keep``. Returns the number of outputs deleted."""
+        now = time.time()
+        entries = []
+        total = 0
+        removed = 0
+        for entry in os.scandir(self.root):
+            if not entry.is_dir() or entry.name == keep:
+                continue
+            try:
+                mtime = entry.stat().st_mtime
+            except FileNotFoundError:
+                continue
+
+            if now - mtime > self.ttl:
+                self._remove(entry.path)
+                removed += 1
+                continue
+
+            size = _tree_size(entry.path)
+            entries.append((mtime, size, entry.path))
+            total += size
+
+        if keep is not None:
+            total += _tree_size(os.path.join(self.root, keep))
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            removed += 1
+            total -= size
+
+        for entry in os.scandir(self.workspaces_dir):
+            try:
+                if entry.is_dir() and now - entry.stat().st_mtime > WORKSPACE_STALE_AFTER:
+                    self._remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+        return removed
+
+    def start_sweeper(self, interval: float = DEFAULT_SWEEP_INTERVAL):
+        """Sweep every ``interval`` seconds in a background thread"""
+        if self._sweeper is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    removed = self.sweep()
+                    if removed:
+                        logger.info("Removed %d expired or evicted outputs", removed)
+                except Exception:
+                    logger.exception("Output sweep failed")
+
+        self._sweeper = threading.Thread(target=run, name="output-sweeper", daemon=True)
+        self._sweeper.start()
@@ -0,0 +1,229 @@
+import sys
+import json
+import math
+import struct
+from array import array
+from typing import TextIO
+from .utils import write_srt, write_vtt
+from .ass_generator import AssGenerator
+
+# Formats a transcript can be rendered to
+RENDER_FORMATS = ["srt", "vtt", "ass", "json"]
+
+TRANSCRIPT_EXTENSION = "transcript"
+
+# Binary file: magic, version, segment count, word count, then the columns
+MAGIC = b"ASTR"
+VERSION = 1
+HEADER = struct.Struct("<4sHII")
+# Offsets are stored as unsigned 32-bit integers whatever the platform's C int is
+OFFSET_TYPECODE = next(code for code in "IL" if array(code).itemsize == 4)
+
+
+class Word:
+    """A timed word of a transcript segment"""
+    __slots__ = ("word", "start", "end")
+
+    def __init__(self, word: str, start: float, end: float):
+        self.word = word
+        self.start = start
+        self.end = end
+
+    def to_dict(self) -> dict:
+        return {"word": self.word, "start": self.start, "end": self.end}
+
+
+def _offsets(texts) -> array:
+    offsets = array(OFFSET_TYPECODE, [0])
+    for text in texts:
+        offsets.append(offsets[-1] + len(text))
+    return offsets
+
+
+class Transcript:
+    """A transcript reduced to what subtitles are made of, stored in columns.
+
+    Segment and word times are ``array('d')`` columns. The texts are
+    concatenated into one string each, sliced by unsigned 32-bit offset
+    columns, and
+    ``word_bounds[i]:word_bounds[i + 1]`` are the words of segment ``i``.
+    Everything else a backend returns (tokens, log probabilities, ...) is
+    dropped.
+    """
+    __slots__ = (
+        "language", "starts", "ends", "text", "text_offsets",
+        "word_bounds", "word_starts", "word_ends", "words_text", "word_offsets",
+    )
+
+    def __init__(self, language=None, starts=None, ends=None, text="", text_offsets=None,
+                 word_bounds=None, word_starts=None, word_ends=None, words_text="", word_offsets=None):
+        self.language = language
+        self.starts = starts if starts is not None else array("d")
+        self.ends = ends if ends is not None else array("d")
+        self.text = text
+        self.text_offsets = text_offsets if text_offsets is not None else array(OFFSET_TYPECODE, [0])
+        self.word_bounds = word_bounds if word_bounds is not None else array(OFFSET_TYPECODE, [0] * (len(self.starts) + 1))
+        self.word_starts = word_starts if word_starts is not None else array("d")
+        self.word_ends = word_ends if word_ends is not None else array("d")
+        self.words_text = words_text
+        self.word_offsets = word_offsets if word_offsets is not None else array(OFFSET_TYPECODE, [0])
+
+    @classmethod
+    def from_result(cls, result: dict) -> "Transcript":
+        """Build a transcript from a backend result (or its JSON rendering)"""
+        segments = result.get("segments") or []
+        texts = [segment.get("text", "") for segment in segments]
+        words = [segment.get("words") or [] for segment in segments]
+        flat_words = [word for segment_words in words for word in segment_words]
+        word_texts = [word.get("word", "") for word in flat_words]
+        return cls(
+            language=result.get("language"),
+            starts=array("d", (segment["start"] for segment in segments)),
+            ends=array("d", (segment["end"] for segment in segments)),
+            text="".join(texts),
+            text_offsets=_offsets(texts),
+            word_bounds=_offsets([None] * len(segment_words) for segment_words in words),
+            word_starts=array("d", (word["start"] for word in flat_words)),
+            word_ends=array("d", (word["end"] for word in flat_words)),
+            words_text="".join(word_texts),
+            word_offsets=_offsets(word_texts),
+        )
+
+    def check_times(self):
+        """Raise ValueError unless every segment and word has finite times with 0 <= start <= end.
+
+        Backend results aren't checked; transcripts read from files are, so
+        the subtitle writers never see times they can't format.
+        """
+        for starts, ends in ((self.starts, self.ends), (self.word_starts, self.word_ends)):
+            for start, end in zip(starts, ends):
+                if not (math.isfinite(start) and math.isfinite(end) and 0 <= start <= end):
+                    raise ValueError(f"Invalid transcript times {start} to {end}")
+
+    def __len__(self):
+        return len(self.starts)
+
+    def segment_text(self, index: int) -> str:
+        return self.text[self.text_offsets[index]:self.text_offsets[index + 1]]
+
+    def words(self, index: int) -> list:
+        """The words of segment ``index``"""
+        offsets = self.word_offsets
+        return [
+            Word(self.words_text[offsets[i]:offsets[i + 1]], self.word_starts[i], self.word_ends[i])
+            for i in range(self.word_bounds[index], self.word_bounds[index + 1])
+        ]
+
+    def cues(self):
+        """Segments without their words, for the SRT and WebVTT writers"""
+        for i in range(len(self)):
+            yield {"start": self.starts[i], "end": self.ends[i], "text": self.segment_text(i)}
+
+    def segments(self):
+        """Segments in the shape of a backend result"""
+        for i in range(len(self)):
+            segment = {"start": self.starts[i], "end": self.ends[i], "text": self.segment_text(i)}
+            if self.word_bounds[i + 1] > self.word_bounds[i]:
+                segment["words"] = [word.to_dict() for word in self.words(i)]
+            yield segment
+
+    def to_result(self) -> dict:
+        return {"language": self.language, "text": self.text, "segments": list(self.segments())}
+
+    def to_bytes(self) -> bytes:
+        columns = [self.starts, self.ends, self.text_offsets, self.word_bounds,
+                   self.word_starts, self.word_ends, self.word_offsets]
+        if sys.byteorder == "big":
+            columns = [array(column.typecode, column) for column in columns]
+            for column in columns:
+                column.byteswap()
+        strings = [value.encode("utf-8") for value in (self.text, self.words_text, self.language or "")]
+        return b"".join(
+            [HEADER.pack(MAGIC, VERSION, len(self.starts), len(self.word_starts))]
+            + [column.tobytes() for column in columns]
+            + [struct.pack("<III", *(len(value) for value in strings))]
+            + strings
+        )
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "Transcript":
+        """Read what ``to_bytes`` wrote; raises ValueError on anything else, truncated files included"""
+        try:
+            magic, version, n_segments, n_words = HEADER.unpack_from(data)
+        except struct.error:
+            raise ValueError("Not a transcript file")
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a transcript file")
+
+        position = HEADER.size
+        columns = []
+        for typecode, count in (("d", n_segments), ("d", n_segments), (OFFSET_TYPECODE, n_segments + 1),
+                                (OFFSET_TYPECODE, n_segments + 1), ("d", n_words), ("d", n_words),
+                                (OFFSET_TYPECODE, n_words + 1)):
+            column = array(typecode)
+            size = column.itemsize * count
+            if position + size > len(data):
+                raise ValueError("Truncated transcript file")
+            column.frombytes(data[position:position + size])
+            if sys.byteorder == "big":
+                column.byteswap()
+            columns.append(column)
+            position += size
+
+        try:
+            lengths = struct.unpack_from("<III", data, position)
+        except struct.error:
+            raise ValueError("Truncated transcript file")
+        position += 12
+        if position + sum(lengths) > len(data):
+            raise ValueError("Truncated transcript file")
+        strings = []
+        for length in lengths:
+            try:
+                strings.append(data[position:position + length].decode("utf-8"))
+            except UnicodeDecodeError:
+                raise ValueError("Corrupt transcript file")
+            position += length
+
+        starts, ends, text_offsets, word_bounds, word_starts, word_ends, word_offsets = columns
+        text, words_text, language = strings
+        for offsets, end in ((text_offsets, len(text)), (word_bounds, n_words), (word_offsets, len(words_text))):
+            if offsets[0] != 0 or offsets[-1] != end or any(a > b for a, b in zip(offsets, offsets[1:])):
+                raise ValueError("Corrupt transcript file")
+        transcript = cls(language or None, starts, ends, text, text_offsets,
+                         word_bounds, word_starts, word_ends, words_text, word_offsets)
+        transcript.check_times()
+        return transcript
+
+
+def save_transcript(transcript: Transcript, path: str):
+    with open(path, "wb") as f:
+        f.write(transcript.to_bytes())
+
+
+def load_transcript(path: str) -> Transcript:
+    """Read a binary transcript file, or a transcript rendered as JSON"""
+    with open(path, "rb") as f:
+        data = f.read()
+    if data.startswith(MAGIC):
+        return Transcript.from_bytes(data)
+    try:
+        transcript = Transcript.from_result(json.loads(data))
+    except (ValueError, KeyError, TypeError, AttributeError):
+        raise ValueError("Not a transcript file")
+    transcript.check_times()
+    return transcript
+
+
+def render(transcript: Transcript, subtitle_format: str, file: TextIO, ass_style: str = "default"):
+    """Write a transcript to ``file`` as SRT, WebVTT, ASS (in ``ass_style``) or JSON"""
+    if subtitle_format == "srt":
+        write_srt(transcript.cues(), file)
+    elif subtitle_format == "vtt":
+        write_vtt(transcript.cues(), file)
+    elif subtitle_format == "ass":
+        AssGenerator().write_ass(transcript.segments(), file, ass_style)
+    elif subtitle_format == "json":
+        json.dump(transcript.to_result(), file, ensure_ascii=False)
+    else:
+        raise ValueError(f"Unknown subtitle format {subtitle_format}. Use one of {', '.join(RENDER_FORMATS)}")
@@ -0,0 +1,184 @@
+import os
+import json
+import time
+import uuid
+import base64
+import fcntl
+import shutil
+import hashlib
+from contextlib import contextmanager
+from .audio import READ_BLOCK_SIZE
+
+CHECKSUM_ALGORITHMS = {"md5", "sha1", "sha256"}
+
+
+class UploadNotFound(LookupError):
+    pass
+
+
+class OffsetMismatch(ValueError):
+    """A chunk doesn't start where the upload currently ends"""
+
+    def __init__(self, offset: int):
+        super().__init__(f"Upload is at offset {offset}")
+        self.offset = offset
+
+
+class ChecksumMismatch(ValueError):
+    pass
+
+
+def parse_checksum(value: str):
+    """Parse an ``"<algorithm> <base64 digest>"`` checksum into ``(algorithm, digest)``"""
+    try:
+        algorithm, encoded = value.strip().split(" ", 1)
+        digest = base64.b64decode(encoded, validate=True)
+    except ValueError:
+        raise ValueError('Invalid checksum. Use "<algorithm> <base64 digest>"') from None
+    if algorithm not in CHECKSUM_ALGORITHMS:
+        raise ValueError(f"Unsupported checksum algorithm. Use one of: {', '.join(sorted(CHECKSUM_ALGORITHMS))}")
+    return algorithm, digest
+
+
+class UploadStore:
+    """Resumable uploads, received in chunks that are appended to a file on disk.
+
+    Each upload lives in ``<root>/upload-<id>/`` with its metadata and the
+    data received so far; the size of the data is the upload's offset. Chunks
+    must start at the current offset and may carry a checksum, and are
+    appended under a file lock so that processes sharing ``root`` can't
+    interleave them. Abandoned uploads are removed by the output store's
+    sweeper, which treats ``root`` as its workspace directory. No upload can
+    grow past ``max_bytes``, whatever length it declared.
+    """
+
+    def __init__(self, root: str, max_bytes: int = None):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def _dir(self, upload_id: str) -> str:
+        # Ids are generated hex strings; anything else could point outside the store
+        if not upload_id.isalnum():
+            raise UploadNotFound(upload_id)
+        return os.path.join(self.root, f"upload-{upload_id}")
+
+    @contextmanager
+    def _open(self, upload_id: str):
+        """The upload's data file, locked against other writers"""
+        data_path = os.path.join(self._dir(upload_id), "data")
+        try:
+            f = open(data_path, "r+b")
+        except FileNotFoundError:
+            raise UploadNotFound(upload_id) from None
+
+        with f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            # Finalized or deleted while we waited for the lock
+            if not os.path.exists(data_path):
+                raise UploadNotFound(upload_id)
+            yield f
+
+    def create(self, filename: str, length: int = None, options: dict = None) -> str:
+        """Start an upload of ``length`` bytes (None if unknown) and return its id"""
+        upload_id = uuid.uuid4().hex
+        upload_dir = self._dir(upload_id)
+        os.makedirs(upload_dir)
+        with open(os.path.join(upload_dir, "upload.json"), "w", encoding="utf-8") as f:
+            json.dump({"filename": filename, "length": length, "options": options or {},
+                       "created_at": time.time()}, f)
+        open(os.path.join(upload_dir, "data"), "wb").close()
+        return upload_id
+
+    def get(self, upload_id: str) -> dict:
+        """Metadata of an upload, with its current ``offset``"""
+        upload_dir = self._dir(upload_id)
+        try:
+            with open(os.path.join(upload_dir, "upload.json"), encoding="utf-8") as f:
+                upload = json.load(f)
+            upload["offset"] = os.path.getsize(os.path.join(upload_dir, "data"))
+        except FileNotFoundError:
+            raise UploadNotFound(upload_id) from None
+        upload["id"] = upload_id
+        return upload
+
+    def append(self, upload_id: str, offset: int, stream, checksum=None) -> int:
+        """Append the bytes of ``stream`` at ``offset`` and return the new offset.
+
+        With a ``(algorithm, digest)`` checksum, a chunk that doesn't match is
+        discarded and ChecksumMismatch raised. Without one, the bytes that
+        arrived before a dropped connection are kept, and the client resumes
+        after them.
+        """
+        upload = self.get(upload_id)
+        with self._open(upload_id) as f:
+            size = f.seek(0, os.SEEK_END)
+            if offset != size:
+                raise OffsetMismatch(size)
+
+            digest = hashlib.new(checksum[0]) if checksum else None
+            written = 0
+            try:
+                for block in iter(lambda: stream.read(READ_BLOCK_SIZE), b""):
+                    if upload["length"] is not None and size + written + len(block) > upload["length"]:
+                        raise ValueError("Chunk extends past the end of the upload")
+                    if self.max_bytes is not None and size + written + len(block) > self.max_bytes:
+                        raise ValueError(f"Uploads can be up to {self.max_bytes} bytes")
+                    f.write(block)
+                    written += len(block)
+                    if digest is not None:
+                        digest.update(block)
+
+                if digest is not None and digest.digest() != checksum[1]:
+                    raise ChecksumMismatch("Chunk checksum does not match")
+            except BaseException as e:
+                if digest is not None or isinstance(e, ValueError):
+                    f.truncate(size)
+                raise
+
+            f.flush()
+            os.fsync(f.fileno())
+
+        # The sweeper removes uploads whose directory hasn't changed for a long time
+        os.utime(self._dir(upload_id))
+        return size + written
+
+    def finalize(self, upload_id: str, dest_path: str, checksum=None, process=None) -> dict:
+        """Move a complete upload to ``dest_path`` and return its metadata.
+
+        ``checksum`` optionally verifies the whole file. Raises ValueError if
+        the upload is incomplete or doesn't match the checksum. ``process``
+        is called with ``dest_path`` before the upload is removed; if it
+        raises, the data is moved back, so the upload can be finalized again.
+        """
+        upload = self.get(upload_id)
+        with self._open(upload_id) as f:
+            size = f.seek(0, os.SEEK_END)
+            if upload["length"] is not None and size != upload["length"]:
+                raise OffsetMismatch(size)
+            if size == 0:
+                raise ValueError("Upload is empty")
+
+            if checksum is not None:
+                f.seek(0)
+                digest = hashlib.new(checksum[0])
+                for block in iter(lambda: f.read(READ_BLOCK_SIZE), b""):
+                    digest.update(block)
+                if digest.digest() != checksum[1]:
+                    raise ChecksumMismatch("Upload checksum does not match")
+
+            shutil.move(f.name, dest_path)
+            if process is not None:
+                try:
+                    process(dest_path)
+                except BaseException:
+                    shutil.move(dest_path, f.name)
+                    raise
+
+        shutil.rmtree(self._dir(upload_id), ignore_errors=True)
+        upload["offset"] = size
+        return upload
+
+    def delete(self, upload_id: str):
+        with self._open(upload_id):
+            shutil.rmtree(self._dir(upload_id), ignore_errors=True)
@@ -13,7 +13,7 @@ def str2bool(string):
             f"Expected one of {set(str2val.keys())}, got {string}")
 
 
-def format_timestamp(seconds: float, always_include_hours: bool = False):
+def format_timestamp(seconds: float, always_include_hours: bool = False, decimal_marker: str = ","):
     assert seconds >= 0, "non-negative timestamp expected"
     milliseconds = round(seconds * 1000.0)
 
@@ -27,18 +27,26 @@ def format_timestamp(seconds: float, always_include_hours: bool = False):
     milliseconds -= seconds * 1_000
 
     hours_marker = f"{hours:02d}:" if always_include_hours or hours > 0 else ""
-    return f"{hours_marker}{minutes:02d}:{seconds:02d},{milliseconds:03d}"
+    return f"{hours_marker}{minutes:02d}:{seconds:02d}{decimal_marker}{milliseconds:03d}"
 
 
 def write_srt(transcript: Iterator[dict], file: TextIO):
     for i, segment in enumerate(transcript, start=1):
-        print(
+        file.write(
             f"{i}\n"
             f"{format_timestamp(segment['start'], always_include_hours=True)} --> "
             f"{format_timestamp(segment['end'], always_include_hours=True)}\n"
-            f"{segment['text'].strip().replace('-->', '->')}\n",
-            file=file,
-            flush=True,
+            f"{segment['text'].strip().replace('-->', '->')}\n\n"
+        )
+
+
+def write_vtt(transcript: Iterator[dict], file: TextIO):
+    file.write("WEBVTT\n\n")
+    for segment in transcript:
+        file.write(
+            f"{format_timestamp(segment['start'], always_include_hours=True, decimal_marker='.')} --> "
+            f"{format_timestamp(segment['end'], always_include_hours=True, decimal_marker='.')}\n"
+            f"{segment['text'].strip().replace('-->', '->')}\n\n"
         )
 
 
@@ -0,0 +1,144 @@
+from bisect import bisect_left, bisect_right
+import numpy as np
+from .audio import load_pcm, audio_size, encode_audio
+from .chunking import frame_energy
+from .metrics import VAD_AUDIO_SECONDS, VAD_TRIMMED_SECONDS, stage
+
+FRAME_SECONDS = 0.02
+
+# A frame is speech if its energy is this far above the noise floor (the
+# quietest 10% of frames), and never below SILENCE_DB (relative to full scale)
+ENERGY_MARGIN_DB = 12.0
+SILENCE_DB = -55.0
+# Quieter frames with many zero crossings are unvoiced consonants (s, f, sh)
+UNVOICED_MARGIN_DB = 6.0
+UNVOICED_ZCR = 0.25
+
+# Pauses shorter than this stay in; shorter bursts of sound are dropped
+MIN_SILENCE_SECONDS = 0.5
+MIN_SPEECH_SECONDS = 0.2
+# Kept around every speech region so word onsets and endings aren't clipped
+PADDING_SECONDS = 0.2
+
+
+def _runs(mask):
+    """``(starts, ends)`` frame indices of the runs of True in a boolean array"""
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def speech_regions(samples, sample_rate: int, padding: float = PADDING_SECONDS,
+                   min_silence: float = MIN_SILENCE_SECONDS, min_speech: float = MIN_SPEECH_SECONDS):
+    """Sample ``(start, end)`` ranges that contain speech, padded and merged.
+
+    Classifies fixed-length frames by their energy and zero-crossing rate in
+    one vectorized pass.
+    """
+    frame_length = max(1, int(FRAME_SECONDS * sample_rate))
+    n_frames = len(samples) // frame_length
+    if n_frames == 0:
+        return []
+
+    energy_db = 10 * np.log10(frame_energy(samples, frame_length) / 32768.0 ** 2 + 1e-12)
+    frames = samples[:n_frames * frame_length].reshape(n_frames, frame_length)
+    zcr = np.count_nonzero(np.diff(np.signbit(frames), axis=1), axis=1) / frame_length
+
+    # Relative to the noise floor, but low enough that audio that is speech
+    # throughout (with no quiet frames) is still kept
+    floor_db = np.percentile(energy_db, 10)
+    threshold = max(SILENCE_DB, min(floor_db + ENERGY_MARGIN_DB, np.percentile(energy_db, 90) - 20))
+    speech = (energy_db > threshold) | (
+        (energy_db > threshold - UNVOICED_MARGIN_DB) & (energy_db > SILENCE_DB) & (zcr > UNVOICED_ZCR)
+    )
+
+    starts, ends = _runs(speech)
+    regions = []
+    for start, end in zip(starts, ends):
+        if regions and start - regions[-1][1] < min_silence / FRAME_SECONDS:
+            regions[-1][1] = end
+        else:
+            regions.append([start, end])
+
+    pad = int(padding / FRAME_SECONDS)
+    result = []
+    for start, end in regions:
+        if end - start < min_speech / FRAME_SECONDS:
+            continue
+        start = int(max(0, start - pad)) * frame_length
+        end = int(min(n_frames, end + pad)) * frame_length
+        if result and start <= result[-1][1]:
+            result[-1] = (result[-1][0], end)
+        else:
+            result.append((start, end))
+
+    # Keep the tail that didn't fill a whole frame with the last region
+    if result and result[-1][1] == n_frames * frame_length:
+        result[-1] = (result[-1][0], len(samples))
+    return result
+
+
+def remap_result(result: dict, regions, sample_rate: int) -> dict:
+    """Move the timestamps of a transcript of the spliced speech back onto the original timeline"""
+    source_starts = [start / sample_rate for start, _ in regions]
+    lengths = [(end - start) / sample_rate for start, end in regions]
+    spliced_starts = [0.0]
+    for length in lengths[:-1]:
+        spliced_starts.append(spliced_starts[-1] + length)
+
+    def remap(time, is_end):
+        # A time on the seam between two regions starts the later one and ends the earlier one
+        index = (bisect_left if is_end else bisect_right)(spliced_starts, time) - 1
+        index = min(max(index, 0), len(regions) - 1)
+        return source_starts[index] + min(max(time - spliced_starts[index], 0.0), lengths[index])
+
+    def remap_item(item):
+        item = dict(item)
+        if "start" in item:
+            item["start"] = remap(item["start"], False)
+        if "end" in item:
+            item["end"] = remap(item["end"], True)
+        return item
+
+    segments = []
+    for segment in result["segments"]:
+        segment = remap_item(segment)
+        if segment.get("words"):
+            segment["words"] = [remap_item(word) for word in segment["words"]]
+        segments.append(segment)
+    return dict(result, segments=segments)
+
+
+def transcribe_speech(audio, transcribe, timing=None):
+    """Transcribe only the speech in ``audio``, with timestamps on the original timeline.
+
+    Silence and music are cut out before ``transcribe`` is called with the
+    spliced audio, in the format of the original. The audio and speech
+    durations are added to the stats of ``timing``.
+    """
+    with stage("vad", timing) as record:
+        record.bytes_in = audio_size(audio)
+        samples, sample_rate = load_pcm(audio)
+        regions = speech_regions(samples, sample_rate)
+
+        audio_seconds = len(samples) / sample_rate
+        speech_seconds = sum(end - start for start, end in regions) / sample_rate
+        VAD_AUDIO_SECONDS.inc(audio_seconds)
+        VAD_TRIMMED_SECONDS.inc(audio_seconds - speech_seconds)
+        if timing is not None:
+            timing.stats["audio_seconds"] = round(audio_seconds, 3)
+            timing.stats["speech_seconds"] = round(speech_seconds, 3)
+            timing.stats["trimmed_seconds"] = round(audio_seconds - speech_seconds, 3)
+
+        if not regions:
+            record.bytes_out = 0
+            return {"segments": [], "text": ""}
+
+        name = audio if isinstance(audio, str) else audio[0]
+        if regions == [(0, len(samples))]:
+            # Nothing to cut; send the audio as it is
+            speech = audio
+        else:
+            speech = encode_audio(np.concatenate([samples[start:end] for start, end in regions]), sample_rate, name)
+        record.bytes_out = audio_size(speech)
+
+    return remap_result(transcribe(speech), regions, sample_rate)
@@ -7,8 +7,21 @@ setup(
     py_modules=["auto_subtitle"],
     author="Miguel Piedrafita",
     install_requires=[
-        'openai-whisper',
+        'openai',
+        'ffmpeg-python',
+        'flask',
+        'werkzeug',
+        'python-dotenv',
+        'numpy',
+        'prometheus_client',
     ],
+    extras_require={
+        # Transcription on the local CPU with --backend local
+        'local': ['faster-whisper'],
+        'whisper': ['openai-whisper'],
+        # Serving asgi.py, the asyncio version of the upload endpoints
+        'asgi': ['uvicorn'],
+    },
     description="Automatically generate and embed subtitles into your videos",
     entry_points={
         'console_scripts': ['auto_subtitle=auto_subtitle.cli:main'],
@@ -0,0 +1,78 @@
+"""Cut points and the stitching of overlapping chunk transcripts"""
+import numpy as np
+from auto_subtitle.chunking import find_split_points, stitch_results
+
+
+def word(text, start, end):
+    return {"word": text, "start": start, "end": end}
+
+
+def segment(text, start, end, words=None):
+    result = {"text": text, "start": start, "end": end}
+    if words is not None:
+        result["words"] = words
+    return result
+
+
+def result(*segments):
+    return {"segments": list(segments), "text": " ".join(s["text"] for s in segments)}
+
+
+def test_cuts_in_the_quietest_frame():
+    sample_rate = 1000
+    samples = np.full(25 * sample_rate, 1000, dtype=np.int16)
+    samples[8 * sample_rate:int(8.5 * sample_rate)] = 0
+
+    splits = find_split_points(samples, sample_rate, max_chunk_seconds=10, search_seconds=5)
+
+    assert splits[0] == 0 and splits[-1] == len(samples)
+    assert 8 * sample_rate <= splits[1] < 8.5 * sample_rate
+    assert all(end - start <= 10 * sample_rate for start, end in zip(splits, splits[1:]))
+
+
+def test_word_split_by_a_cut_is_kept_once():
+    # Cut at 10 s with 2 s of overlap: the second chunk starts at 8 s, and
+    # the chunks hand over at 9 s
+    first = result(segment("a b c", 7.0, 10.0, [word("a", 7.0, 7.5), word("b", 8.5, 9.2), word("c", 9.6, 10.0)]))
+    second = result(segment("b c d", 0.5, 3.0, [word("b", 0.5, 1.2), word("c", 1.6, 2.3), word("d", 2.5, 3.0)]))
+
+    stitched = stitch_results([first, second], [0.0, 8.0], overlap=2.0)
+
+    words = [w for s in stitched["segments"] for w in s["words"]]
+    assert [w["word"] for w in words] == ["a", "b", "c", "d"]
+    # "c" comes from the second chunk, which heard it whole
+    assert words[2]["end"] == 10.3
+    assert stitched["text"] == "a b c d"
+    assert [s["id"] for s in stitched["segments"]] == [0, 1]
+
+
+def test_duplicated_boundary_segment_is_dropped():
+    first = result(segment("Hello there.", 8.0, 9.8))
+    second = result(segment("hello  there.", 0.2, 1.0), segment("General Kenobi.", 1.5, 3.0))
+
+    stitched = stitch_results([first, second], [0.0, 10.0])
+
+    assert [s["text"] for s in stitched["segments"]] == ["Hello there.", "General Kenobi."]
+
+
+def test_words_before_the_previous_segment_ended_are_dropped():
+    first = result(segment("x", 9.5, 10.4, [word("x", 9.5, 10.4)]))
+    second = result(segment("x y", 0.1, 1.0, [word("x", 0.1, 0.4), word("y", 0.6, 1.0)]))
+
+    stitched = stitch_results([first, second], [0.0, 10.0])
+
+    last = stitched["segments"][-1]
+    assert last["text"] == "y"
+    assert [w["word"] for w in last["words"]] == ["y"]
+    assert last["start"] == 10.6
+
+
+def test_segments_without_words_go_to_the_chunk_holding_their_midpoint():
+    # The first chunk heard "the quick" cut off at 10 s; the second heard the whole segment
+    first = result(segment("Before.", 2.0, 6.0), segment("the quick", 8.4, 10.0))
+    second = result(segment("the quick brown fox", 0.4, 3.0), segment("After.", 3.5, 5.0))
+
+    stitched = stitch_results([first, second], [0.0, 8.0], overlap=2.0)
+
+    assert [s["text"] for s in stitched["segments"]] == ["Before.", "the quick brown fox", "After."]
+    assert [(s["start"], s["end"]) for s in stitched["segments"]] == [(2.0, 6.0), (8.4, 11.0), (11.5, 13.0)]
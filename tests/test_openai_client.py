@@ -0,0 +1,197 @@
+"""TranscriptionClient against a local stub of the transcription API"""
+import json
+import time
+import select
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import openai
+import pytest
+from auto_subtitle import openai_client
+from auto_subtitle.audio import encode_wav
+from auto_subtitle.openai_client import TranscriptionClient
+
+AUDIO = ("audio.wav", encode_wav(np.zeros(16000, dtype=np.int16), 16000))
+TRANSCRIPT = {"text": "hello", "language": "english", "duration": 1.0,
+              "segments": [{"id": 0, "start": 0.0, "end": 1.0, "text": "hello"}]}
+
+
+class StubAPI:
+    """Answers each request with the next ``(status, delay, headers)`` of ``responses``
+    (the last one repeats), and records what it saw"""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.disconnected = threading.Event()
+        self.lock = threading.Lock()
+
+    def next_response(self):
+        with self.lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            return self.responses.pop(0) if len(self.responses) > 1 else self.responses[0]
+
+    def done(self):
+        with self.lock:
+            self.in_flight -= 1
+
+
+def make_handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def client_closed(self, seconds):
+            """Wait up to ``seconds``; True if the client closed the connection meanwhile"""
+            readable, _, _ = select.select([self.connection], [], [], seconds)
+            return bool(readable) and not self.connection.recv(1)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            status, delay, headers = api.next_response()
+            try:
+                if delay and self.client_closed(delay):
+                    api.disconnected.set()
+                    self.close_connection = True
+                    return
+
+                body = json.dumps(TRANSCRIPT if status == 200 else {"error": {"message": "stub error"}}).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+            finally:
+                api.done()
+
+    return Handler
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    """Start a stub API with the given responses; the clients created afterwards use it"""
+    servers = []
+
+    def start(*responses):
+        api = StubAPI(responses)
+        server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(api))
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        monkeypatch.setenv("OPENAI_BASE_URL", f"http://127.0.0.1:{server.server_port}/v1")
+        monkeypatch.setenv("OPENAI_API_KEY", "test")
+        monkeypatch.setattr(openai, "api_key", None)
+        return api
+
+    monkeypatch.setattr(openai_client, "BACKOFF_BASE", 0.01)
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def transcribe(client):
+    return client.create("transcribe", AUDIO, model="whisper-1", response_format="verbose_json")
+
+
+def test_retries_transient_errors(stub):
+    api = stub((503, 0, {}), (500, 0, {}), (200, 0, {}))
+    client = TranscriptionClient(requests_per_minute=0)
+
+    assert transcribe(client).text == "hello"
+    assert api.requests == 3
+    assert client.stats()["retries"] == 2
+
+
+def test_waits_for_retry_after(stub):
+    stub((429, 0, {"Retry-After": "0.5"}), (200, 0, {}))
+    client = TranscriptionClient(requests_per_minute=0)
+
+    started = time.monotonic()
+    transcribe(client)
+    assert time.monotonic() - started >= 0.5
+
+
+def test_does_not_retry_client_errors(stub):
+    api = stub((400, 0, {}))
+    client = TranscriptionClient(requests_per_minute=0)
+
+    with pytest.raises(openai.BadRequestError):
+        transcribe(client)
+    assert api.requests == 1
+    assert client.stats()["failures"] == 1
+
+
+def test_gives_up_after_max_attempts(stub):
+    api = stub((503, 0, {}))
+    client = TranscriptionClient(requests_per_minute=0, max_attempts=3)
+
+    with pytest.raises(openai.InternalServerError):
+        transcribe(client)
+    assert api.requests == 3
+
+
+def test_limits_concurrent_requests(stub):
+    api = stub((200, 0.3, {}))
+    client = TranscriptionClient(requests_per_minute=0, max_concurrency=2)
+
+    threads = [threading.Thread(target=transcribe, args=(client,)) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert api.requests == 6
+    assert api.max_in_flight == 2
+
+
+def test_slot_wait_stops_at_the_deadline(stub):
+    api = stub((200, 0, {}))
+    client = TranscriptionClient(requests_per_minute=0, max_concurrency=1, deadline=0.3)
+    client._slots.acquire()
+
+    started = time.monotonic()
+    with pytest.raises(TimeoutError):
+        transcribe(client)
+    assert time.monotonic() - started < 1
+    assert api.requests == 0
+
+
+def test_hedge_wins_and_cancels_the_slow_request(stub):
+    api = stub((200, 10, {}), (200, 0, {}))
+    client = TranscriptionClient(requests_per_minute=0, max_concurrency=2, hedge=True)
+    # Recent requests took 50 ms, so a request is hedged after 50 ms
+    client._latencies.extend([0.05] * openai_client.HEDGE_MIN_SAMPLES)
+
+    started = time.monotonic()
+    assert transcribe(client).text == "hello"
+    assert time.monotonic() - started < 5
+
+    stats = client.stats()
+    assert stats["hedges"] == 1 and stats["hedge_wins"] == 1
+    # The loser's connection is closed, and both slots are free again (the
+    # loser's once its cancellation has run on the event loop)
+    assert api.disconnected.wait(5)
+    deadline = time.monotonic() + 5
+    for _ in range(2):
+        while not client._slots.acquire(blocking=False):
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+
+
+def test_does_not_hedge_without_a_free_slot(stub):
+    api = stub((200, 0.5, {}))
+    client = TranscriptionClient(requests_per_minute=0, max_concurrency=1, hedge=True)
+    client._latencies.extend([0.05] * openai_client.HEDGE_MIN_SAMPLES)
+
+    assert transcribe(client).text == "hello"
+    assert api.requests == 1
+    assert client.stats()["hedges"] == 0
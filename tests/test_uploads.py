@@ -0,0 +1,95 @@
+"""Resumable uploads: chunk offsets, checksums, the size cap and finalizing"""
+import io
+import os
+import base64
+import hashlib
+import pytest
+from auto_subtitle.uploads import (
+    UploadStore, UploadNotFound, OffsetMismatch, ChecksumMismatch, parse_checksum
+)
+
+
+def sha256(data):
+    return parse_checksum("sha256 " + base64.b64encode(hashlib.sha256(data).digest()).decode())
+
+
+@pytest.fixture
+def store(tmp_path):
+    return UploadStore(str(tmp_path / "uploads"), max_bytes=100)
+
+
+def test_chunks_are_appended_at_the_offset(store):
+    upload_id = store.create("video.mp4", 10)
+
+    assert store.append(upload_id, 0, io.BytesIO(b"abcd")) == 4
+    with pytest.raises(OffsetMismatch) as error:
+        store.append(upload_id, 2, io.BytesIO(b"cdef"))
+    assert error.value.offset == 4
+    assert store.append(upload_id, 4, io.BytesIO(b"efghij")) == 10
+    assert store.get(upload_id)["offset"] == 10
+
+
+def test_chunk_with_a_wrong_checksum_is_discarded(store):
+    upload_id = store.create("video.mp4", 8)
+    store.append(upload_id, 0, io.BytesIO(b"abcd"))
+
+    with pytest.raises(ChecksumMismatch):
+        store.append(upload_id, 4, io.BytesIO(b"efgh"), sha256(b"other"))
+    assert store.get(upload_id)["offset"] == 4
+    assert store.append(upload_id, 4, io.BytesIO(b"efgh"), sha256(b"efgh")) == 8
+
+
+def test_uploads_cannot_grow_past_max_bytes(store):
+    upload_id = store.create("video.mp4")
+
+    store.append(upload_id, 0, io.BytesIO(b"x" * 60))
+    with pytest.raises(ValueError):
+        store.append(upload_id, 60, io.BytesIO(b"x" * 60))
+    assert store.get(upload_id)["offset"] == 60
+
+
+def test_chunks_cannot_pass_the_declared_length(store):
+    upload_id = store.create("video.mp4", 5)
+
+    with pytest.raises(ValueError):
+        store.append(upload_id, 0, io.BytesIO(b"abcdef"))
+    assert store.get(upload_id)["offset"] == 0
+
+
+def test_finalize_checks_length_and_checksum(store, tmp_path):
+    upload_id = store.create("video.mp4", 8)
+    store.append(upload_id, 0, io.BytesIO(b"abcd"))
+    dest = str(tmp_path / "video.mp4")
+
+    with pytest.raises(OffsetMismatch):
+        store.finalize(upload_id, dest)
+    store.append(upload_id, 4, io.BytesIO(b"efgh"))
+    with pytest.raises(ChecksumMismatch):
+        store.finalize(upload_id, dest, sha256(b"other"))
+
+    upload = store.finalize(upload_id, dest, sha256(b"abcdefgh"))
+    assert upload["offset"] == 8
+    with open(dest, "rb") as f:
+        assert f.read() == b"abcdefgh"
+    with pytest.raises(UploadNotFound):
+        store.get(upload_id)
+
+
+def test_failed_processing_keeps_the_upload(store, tmp_path):
+    upload_id = store.create("video.mp4", 4)
+    store.append(upload_id, 0, io.BytesIO(b"abcd"))
+    dest = str(tmp_path / "video.mp4")
+
+    def reject(path):
+        assert os.path.exists(path)
+        raise ValueError("Not a video")
+
+    with pytest.raises(ValueError):
+        store.finalize(upload_id, dest, process=reject)
+    assert not os.path.exists(dest)
+    assert store.get(upload_id)["offset"] == 4
+
+    processed = []
+    store.finalize(upload_id, dest, process=processed.append)
+    assert processed == [dest]
+    assert os.path.exists(dest)
@@ -0,0 +1,71 @@
+"""Speech detection and the remapping of spliced-audio timestamps"""
+import numpy as np
+from auto_subtitle.vad import speech_regions, remap_result
+
+SAMPLE_RATE = 16000
+
+
+def audio(*parts):
+    """Concatenate ``(seconds, is_speech)`` parts: a 200 Hz tone for speech, zeros for silence"""
+    pieces = []
+    for seconds, is_speech in parts:
+        n = int(seconds * SAMPLE_RATE)
+        if is_speech:
+            pieces.append((10000 * np.sin(2 * np.pi * 200 * np.arange(n) / SAMPLE_RATE)).astype(np.int16))
+        else:
+            pieces.append(np.zeros(n, dtype=np.int16))
+    return np.concatenate(pieces)
+
+
+def test_all_silence_has_no_speech():
+    assert speech_regions(audio((3, False)), SAMPLE_RATE) == []
+    assert speech_regions(np.zeros(0, dtype=np.int16), SAMPLE_RATE) == []
+
+
+def test_speech_is_padded():
+    regions = speech_regions(audio((1, False), (1, True), (1, False)), SAMPLE_RATE)
+
+    assert regions == [(int(0.8 * SAMPLE_RATE), int(2.2 * SAMPLE_RATE))]
+
+
+def test_short_pauses_are_merged():
+    regions = speech_regions(audio((1, False), (1, True), (0.3, False), (1, True), (1, False)), SAMPLE_RATE)
+
+    assert len(regions) == 1
+
+
+def test_last_region_includes_the_tail():
+    # 7 samples past the last whole frame
+    samples = audio((1, False), (2, True))
+    samples = np.concatenate([samples, samples[-7:]])
+
+    regions = speech_regions(samples, SAMPLE_RATE)
+
+    assert regions[-1][1] == len(samples)
+
+
+def test_times_on_a_seam_start_the_later_region_and_end_the_earlier_one():
+    # 1-3 s and 5-6 s of the original are spliced together; their seam is at 2 s
+    regions = [(1 * SAMPLE_RATE, 3 * SAMPLE_RATE), (5 * SAMPLE_RATE, 6 * SAMPLE_RATE)]
+    result = {"text": "a b", "segments": [
+        {"text": "a", "start": 0.5, "end": 2.0, "words": [{"word": "a", "start": 0.5, "end": 2.0}]},
+        {"text": "b", "start": 2.0, "end": 2.5, "words": [{"word": "b", "start": 2.0, "end": 2.5}]},
+    ]}
+
+    remapped = remap_result(result, regions, SAMPLE_RATE)
+
+    first, second = remapped["segments"]
+    assert (first["start"], first["end"]) == (1.5, 3.0)
+    assert (second["start"], second["end"]) == (5.0, 5.5)
+    assert (first["words"][0]["start"], first["words"][0]["end"]) == (1.5, 3.0)
+    assert (second["words"][0]["start"], second["words"][0]["end"]) == (5.0, 5.5)
+    assert remapped["text"] == "a b"
+
+
+def test_times_past_the_speech_stay_in_the_last_region():
+    regions = [(1 * SAMPLE_RATE, 3 * SAMPLE_RATE), (5 * SAMPLE_RATE, 6 * SAMPLE_RATE)]
+    result = {"text": "c", "segments": [{"text": "c", "start": 2.8, "end": 4.0}]}
+
+    segment = remap_result(result, regions, SAMPLE_RATE)["segments"][0]
+
+    assert (segment["start"], segment["end"]) == (5.8, 6.0)